@@ -0,0 +1,99 @@
+import asyncio
+import os
+import zlib
+
+import pytest
+
+from webvpn.gateway.compression import (
+    TunnelCodec, ZlibCodec, RAW, COMPRESSED, MIN_SIZE, SAMPLE_SIZE, MAX_SKIP, negotiate, parse_codecs,
+)
+
+TEXT = b"GET /index.html HTTP/1.1\r\nHost: example.com\r\n\r\n" * 64
+
+
+def test_round_trip():
+    sender, receiver = TunnelCodec("zlib"), TunnelCodec("zlib")
+    body = sender.encode(TEXT)
+    assert body[:1] == COMPRESSED
+    assert len(body) < len(TEXT)
+    assert receiver.decode(body) == TEXT
+    assert sender.get_stats()["sent_bytes"] == len(TEXT)
+    assert receiver.get_stats()["received_bytes"] == len(TEXT)
+
+
+def test_small_and_empty_bodies():
+    codec = TunnelCodec("zlib")
+    assert codec.encode(b"") == b""
+    assert codec.decode(b"") == b""
+    small = b"a" * (MIN_SIZE - 1)
+    assert codec.encode(small) == RAW + small
+    assert codec.decode(RAW + small) == small
+
+
+def test_incompressible_bodies_back_off():
+    codec = TunnelCodec("zlib")
+    noise = os.urandom(1024)
+
+    assert codec.encode(noise) == RAW + noise
+    assert (codec.skip, codec.backoff) == (1, 2)
+    # The next body goes raw without being tried, then compression resumes.
+    assert codec.encode(TEXT)[:1] == RAW
+    assert codec.skip == 0
+
+    assert codec.encode(noise)[:1] == RAW
+    assert (codec.skip, codec.backoff) == (2, 4)
+    assert codec.encode(TEXT)[:1] == RAW
+    assert codec.encode(TEXT)[:1] == RAW
+    assert codec.skipped == 2
+
+    # A body that compresses well resets the backoff.
+    assert codec.encode(TEXT)[:1] == COMPRESSED
+    assert codec.backoff == 1
+
+
+def test_backoff_is_bounded():
+    codec = TunnelCodec("zlib")
+    for _ in range(10):
+        codec.skip = 0
+        codec.encode(os.urandom(1024))
+    assert codec.backoff == MAX_SKIP
+
+
+def test_large_bodies_judged_on_prefix():
+    codec = TunnelCodec("zlib")
+    body = os.urandom(SAMPLE_SIZE) + b"\x00" * (4 * SAMPLE_SIZE)
+    assert codec.encode(body) == RAW + body
+    assert codec.skipped == 1
+
+
+def test_bad_bodies():
+    codec = TunnelCodec("zlib")
+    with pytest.raises(ValueError):
+        codec.decode(COMPRESSED + b"not zlib")
+    with pytest.raises(ValueError):
+        codec.decode(b"\x07data")
+    with pytest.raises(ValueError):
+        ZlibCodec().decompress(zlib.compress(b"\x00" * 1024), 100)
+
+
+def test_decode_stream():
+    async def chunks(body: bytes):
+        for i in range(0, len(body), 100):
+            yield body[i:i + 100]
+
+    async def decode(body: bytes) -> bytes:
+        codec = TunnelCodec("zlib")
+        return b"".join([data async for data in codec.decode_stream(chunks(body))])
+
+    sender = TunnelCodec("zlib")
+    assert asyncio.run(decode(sender.encode(TEXT))) == TEXT
+    noise = os.urandom(1024)
+    assert asyncio.run(decode(sender.encode(noise))) == noise
+
+
+def test_negotiate():
+    assert parse_codecs(" zlib, unknown ") == ["zlib"]
+    assert parse_codecs(None) == []
+    assert negotiate("unknown,zlib", ["zlib"]) == "zlib"
+    assert negotiate("zlib", []) is None
+    assert negotiate(None, ["zlib"]) is None
@@ -0,0 +1,106 @@
+from typing import Optional
+import asyncio
+import time
+
+from webvpn.gateway.gateway import Gateway, Connection, EXPIRED
+
+
+class Idle(Connection):
+    __slots__ = ()
+
+    async def push(self, data: bytes, seq: Optional[int] = None):
+        ...
+
+    async def pull(self, n: int, hold: Optional[float] = None) -> bytes:
+        return b""
+
+    async def close(self):
+        self.closed = True
+
+
+class Tunnels(Gateway):
+    def open_connection(self, conn) -> Optional[str]:
+        return super().open_connection(conn)
+
+    async def drain(self, timeout: float):
+        ...
+
+
+def test_only_due_tokens_expire():
+    async def main():
+        gateway = Tunnels(expire_time=10.0)
+        due, kept = Idle(), Idle()
+        due.updated_at -= 11
+        due_token = gateway.open_connection(due)
+        kept_token = gateway.open_connection(kept)
+
+        await gateway.expire()
+        assert due.closed and due_token not in gateway.connections
+        assert kept_token in gateway.connections
+        assert [token for _, token in gateway.expiry] == [kept_token]
+
+    asyncio.run(main())
+
+
+def test_used_tokens_are_rescheduled():
+    async def main():
+        gateway = Tunnels(expire_time=10.0)
+        conn = Idle()
+        conn.updated_at -= 11
+        token = gateway.open_connection(conn)
+
+        # Used since it was scheduled: its entry comes up early and moves back.
+        conn.update()
+        await gateway.expire()
+        assert not conn.closed
+        assert gateway.expiry == [(conn.scheduled, token)]
+        assert conn.scheduled == conn.updated_at + 10.0
+
+    asyncio.run(main())
+
+
+def test_stale_entries_are_skipped():
+    async def main():
+        gateway = Tunnels(expire_time=10.0)
+        conn = Idle()
+        token = gateway.open_connection(conn)
+        # A shorter ttl pushes a second entry; the first is superseded.
+        conn.ttl = 1.0
+        conn.updated_at -= 2
+        gateway._schedule(token, conn)
+        assert len(gateway.expiry) == 2
+
+        expired = EXPIRED.value
+        await gateway.expire()
+        assert conn.closed
+        assert EXPIRED.value == expired + 1
+        assert len(gateway.expiry) == 1
+
+        # Entries of tokens closed meanwhile are dropped when they come up.
+        closed = Idle()
+        closed.updated_at -= 11
+        await gateway.close(gateway.open_connection(closed))
+        await gateway.expire()
+        assert EXPIRED.value == expired + 1
+        assert len(gateway.expiry) == 1
+
+    asyncio.run(main())
+
+
+def test_clean_wakes_for_earlier_deadlines():
+    async def main():
+        gateway = Tunnels(expire_time=10.0)
+        task = asyncio.ensure_future(gateway.clean())
+        await asyncio.sleep(0.01)
+
+        # clean() sleeps a full period on an empty heap, but a token due sooner
+        # wakes it.
+        conn = Idle(ttl=0.05)
+        gateway.open_connection(conn)
+        started_at = time.monotonic()
+        while not conn.closed and time.monotonic() - started_at < 1:
+            await asyncio.sleep(0.01)
+        assert conn.closed
+        task.cancel()
+
+    asyncio.run(main())
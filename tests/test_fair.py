@@ -0,0 +1,111 @@
+import asyncio
+import time
+
+from webvpn.gateway.fair import FairScheduler, TokenBucket, OTHER_USERS
+
+QUANTUM = 64 * 1024
+
+
+def test_users_share_by_weight():
+    async def main():
+        scheduler = FairScheduler("pull", rate=100e6, quantum=QUANTUM, weights={"a": 2})
+        flows = {name: scheduler.flow(name) for name in ("a", "b")}
+        order = []
+
+        async def take(name: str):
+            await flows[name].acquire(QUANTUM, partial=False)
+            order.append(name)
+
+        await asyncio.gather(*[take(name) for name in "aaaaaa" + "bbb"])
+        # Deficit round robin: two quanta for `a` per turn of `b`.
+        assert order == list("aabaabaab")
+        scheduler.close()
+
+    asyncio.run(main())
+
+
+def test_user_rate_is_capped():
+    async def main():
+        scheduler = FairScheduler("push", user_rate=1e6, user_burst=QUANTUM, quantum=QUANTUM)
+        flow = scheduler.flow("a")
+        started_at = time.monotonic()
+        for _ in range(3):
+            assert await flow.acquire(QUANTUM, partial=False) == QUANTUM
+        # The first comes out of the burst; the other two wait ~65ms each.
+        assert time.monotonic() - started_at > 0.12
+        assert scheduler.users["a"].throttled > 0.1
+
+    asyncio.run(main())
+
+
+def test_interactive_transfers_skip_the_wait():
+    async def main():
+        scheduler = FairScheduler("push", user_rate=1e6, user_burst=QUANTUM, quantum=QUANTUM)
+        flow = scheduler.flow("a")
+        await flow.acquire(QUANTUM, partial=False)
+        started_at = time.monotonic()
+        assert await flow.acquire(100) == 100
+        assert time.monotonic() - started_at < 0.01
+        # It is still charged.
+        assert flow.user.bucket.available() < 0
+
+    asyncio.run(main())
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=1000, burst=100)
+    assert bucket.delay(50) == 0
+    bucket.take(150)
+    assert 0.14 < bucket.delay(100) <= 0.15
+    # Waits are for at most a full bucket.
+    assert bucket.delay(10 ** 6) <= 0.15
+
+
+def test_users_are_dropped_with_their_last_tunnel():
+    scheduler = FairScheduler("pull")
+    flows = [scheduler.flow("a"), scheduler.flow("a")]
+    user = scheduler.users["a"]
+    flows[0].close()
+    flows[0].close()
+    assert scheduler.users["a"] is user
+    flows[1].close()
+    assert "a" not in scheduler.users
+
+
+def test_queued_users_are_dropped_once_served():
+    async def main():
+        scheduler = FairScheduler("pull", rate=100e6, quantum=QUANTUM)
+        flow = scheduler.flow("a")
+        taken = asyncio.ensure_future(flow.acquire(QUANTUM, partial=False))
+        await asyncio.sleep(0)
+        flow.close()
+        assert "a" in scheduler.users
+        assert await taken == QUANTUM
+        await asyncio.sleep(0)
+        assert "a" not in scheduler.users
+        scheduler.close()
+
+    asyncio.run(main())
+
+
+def test_user_labels_are_capped():
+    scheduler = FairScheduler("pull", max_user_labels=2, weights={"vip": 2})
+    labels = {}
+    for name in ("u1", "u2", "u3", "vip", "u4"):
+        flow = scheduler.flow(name)
+        labels[name] = dict(flow.user.bytes_total.labels)["user"]
+        flow.close()
+    assert labels == {"u1": "u1", "u2": "u2", "u3": OTHER_USERS, "vip": "vip", "u4": OTHER_USERS}
+    # A user seen before keeps their label when they come back.
+    assert dict(scheduler.flow("u1").user.bytes_total.labels)["user"] == "u1"
+
+
+def test_scheduler_can_be_built_outside_a_loop():
+    scheduler = FairScheduler("pull", rate=100e6, quantum=QUANTUM)
+    flow = scheduler.flow("a")
+
+    async def main():
+        assert await flow.acquire(QUANTUM, partial=False) == QUANTUM
+        scheduler.close()
+
+    asyncio.run(main())
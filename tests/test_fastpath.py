@@ -0,0 +1,107 @@
+import asyncio
+
+from webvpn.dataplane import FastPath
+
+
+class Plane:
+    def __init__(self):
+        self.calls = []
+
+    async def pull(self, token, n, seq, hold, ack):
+        self.calls.append(("pull", token, n, seq, hold, ack))
+        return 200, {"X-Seq": "3"}, b"data"
+
+    async def push(self, token, chunks, seq):
+        self.calls.append(("push", token, b"".join([chunk async for chunk in chunks]), seq))
+        return 200, {}, b"ok"
+
+    def release(self, tokens):
+        self.calls.append(("release", tokens))
+
+
+class App:
+    def __init__(self):
+        self.scopes = []
+
+    async def __call__(self, scope, receive, send):
+        self.scopes.append(scope)
+
+
+def call(app, method: str, path: str, query: bytes = b"", messages=()):
+    scope = {"type": "http", "method": method, "path": path, "query_string": query}
+    messages = list(messages) or [{"type": "http.request", "body": b""}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(app(scope, receive, send))
+    return sent
+
+
+def test_data_plane_routes_are_served():
+    plane = Plane()
+    sent = call(FastPath(App(), plane), "GET", "/pull", b"token=t&n=10&hold=0.5")
+    assert plane.calls == [("pull", "t", 10, None, 0.5, None)]
+    assert sent[0]["status"] == 200
+    assert dict(sent[0]["headers"]) == {b"content-length": b"4", b"x-seq": b"3"}
+    assert sent[1]["body"] == b"data"
+
+
+def test_push_body_is_streamed():
+    plane = Plane()
+    messages = [
+        {"type": "http.request", "body": b"ab", "more_body": True},
+        {"type": "http.request", "body": b"cd"},
+    ]
+    sent = call(FastPath(App(), plane), "POST", "/push", b"token=t&seq=1", messages)
+    assert plane.calls == [("push", "t", b"abcd", 1)]
+    assert sent[1]["body"] == b"ok"
+
+
+def test_bad_parameters_are_422():
+    for query in (b"", b"token=t&n=many", b"token=t&hold=soon"):
+        plane = Plane()
+        sent = call(FastPath(App(), plane), "GET", "/pull", query)
+        assert sent[0]["status"] == 422
+        assert not plane.calls
+
+
+def test_other_requests_pass_through():
+    app = App()
+    fast = FastPath(app, Plane())
+    assert call(fast, "GET", "/token", b"username=a") == []
+    assert call(fast, "POST", "/pull") == []
+    asyncio.run(fast({"type": "lifespan"}, None, None))
+    assert [scope.get("path") for scope in app.scopes] == ["/token", "/pull", None]
+
+
+def test_disconnected_client_gets_no_response():
+    class Disconnecting(Plane):
+        async def push(self, token, chunks, seq):
+            async for _ in chunks:
+                ...
+
+    messages = [{"type": "http.disconnect"}]
+    assert call(FastPath(App(), Disconnecting()), "POST", "/push", b"token=t", messages) == []
+
+
+
+def test_forwarded_requests():
+    async def body(*chunks):
+        for chunk in chunks:
+            yield chunk
+
+    async def main():
+        plane = Plane()
+        fast = FastPath(App(), plane)
+        assert await fast.serve_forwarded("POST", "/push", {"token": "t"}, body(b"ab", b"cd")) == (200, {}, b"ok")
+        assert await fast.serve_forwarded("POST", "/shard/release", {}, body(b"t1\nt2")) == (200, {}, b"")
+        assert (await fast.serve_forwarded("GET", "/pull", {}, body()))[0] == 422
+        assert (await fast.serve_forwarded("GET", "/token", {}, body()))[0] == 404
+        assert plane.calls == [("push", "t", b"abcd", None), ("release", ["t1", "t2"])]
+
+    asyncio.run(main())
@@ -0,0 +1,44 @@
+import asyncio
+
+import aiohttp
+from yarl import URL
+
+from webvpn.login import get_cookie_jar_path, save_cookie_jar, load_cookie_jar, snapshot_cookie_jar
+
+LOGIN_URL = "http://127.0.0.1:8080/sso/login"
+
+
+def test_cookie_files_are_per_user(monkeypatch, tmp_path):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    alice = get_cookie_jar_path(LOGIN_URL, "alice")
+    assert alice != get_cookie_jar_path(LOGIN_URL, "bob")
+    assert alice != get_cookie_jar_path(LOGIN_URL)
+    assert get_cookie_jar_path(LOGIN_URL, "a/b").parent == alice.parent
+
+
+def test_snapshot_is_not_changed_by_later_cookies():
+    async def main():
+        jar = aiohttp.CookieJar(unsafe=True)
+        jar.update_cookies({"session": "old"}, URL(LOGIN_URL))
+        snapshot = snapshot_cookie_jar(jar)
+        jar.update_cookies({"session": "new", "other": "1"}, URL(LOGIN_URL))
+        jar.update_cookies({"session": "x"}, URL("http://127.0.0.2/"))
+        assert {cookie.key: cookie.value for cookie in snapshot} == {"session": "old"}
+
+    asyncio.run(main())
+
+
+def test_save_and_load(monkeypatch, tmp_path):
+    monkeypatch.setenv("HOME", str(tmp_path))
+
+    async def main():
+        jar = aiohttp.CookieJar(unsafe=True)
+        jar.update_cookies({"session": "alice"}, URL(LOGIN_URL))
+        await save_cookie_jar(jar, LOGIN_URL, "alice")
+        assert not await load_cookie_jar(aiohttp.CookieJar(unsafe=True), LOGIN_URL, "bob")
+
+        loaded = aiohttp.CookieJar(unsafe=True)
+        assert await load_cookie_jar(loaded, LOGIN_URL, "alice")
+        assert {cookie.key: cookie.value for cookie in loaded} == {"session": "alice"}
+
+    asyncio.run(main())
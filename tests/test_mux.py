@@ -0,0 +1,139 @@
+from typing import Optional
+import asyncio
+import time
+from collections import defaultdict
+
+from webvpn.gateway import mux
+from webvpn.gateway.gateway import Chunk, InvalidToken
+from webvpn.gateway.mux import (
+    MuxScheduler, Frame, FrameType, PULL_SIZE, encode_frames, decode_frames, handle_frames,
+)
+
+
+class Upstream:
+    # Stands in for the server gateway: a pull waits up to its hold for data queued
+    # for its token.
+    def __init__(self):
+        self.queues = defaultdict(asyncio.Queue)
+        self.seq = 0
+        self.pushed = []
+        self.closed = set()
+
+    def check(self, token: str):
+        if token == "unknown":
+            raise InvalidToken()
+
+    async def push(self, token: str, data: bytes, seq: int) -> bool:
+        self.check(token)
+        self.pushed.append((token, data, seq))
+        return token not in self.closed
+
+    def get_send_window(self, token: str) -> int:
+        return 4096
+
+    async def keep_alive(self, token: str) -> bool:
+        self.check(token)
+        return token not in self.closed
+
+    async def pull_chunk(self, token: str, rid: int, n: int, hold: float, ack) -> Optional[Chunk]:
+        self.check(token)
+        if token in self.closed:
+            return None
+        try:
+            data = await asyncio.wait_for(self.queues[token].get(), hold)
+        except asyncio.TimeoutError:
+            return Chunk(-1, b"")
+        self.seq += 1
+        return Chunk(self.seq, data)
+
+    async def request(self, body: bytes, hold: float) -> bytes:
+        return encode_frames(await handle_frames(self, decode_frames(body), hold))
+
+
+def pull(token: str, rid: int) -> Frame:
+    return Frame(FrameType.PULL, token, rid, -1, PULL_SIZE.pack(1024))
+
+
+async def pull_data(scheduler: MuxScheduler, token: str, rid: int) -> bytes:
+    # Pulls again on an empty answer, as PullWindow does.
+    while True:
+        frame = await scheduler.call(pull(token, rid))
+        if frame.payload:
+            return frame.payload
+        rid += 1
+
+
+def test_frames_round_trip():
+    frames = [
+        Frame(FrameType.PUSH, "a1", 3, -1, b"data"),
+        Frame(FrameType.PULL, "b2", 4, 7, PULL_SIZE.pack(1024)),
+        Frame(FrameType.KEEP_ALIVE, "", 5),
+        Frame(FrameType.DATA, "tökén", 6, 2**40, b"\x00" * 70000),
+    ]
+    assert decode_frames(encode_frames(frames)) == frames
+    assert decode_frames(b"") == []
+
+
+def test_handle_frames():
+    async def main():
+        upstream = Upstream()
+        upstream.closed.add("gone")
+        upstream.queues["ready"].put_nowait(b"answer")
+        frames = [
+            Frame(FrameType.PULL, "ready", 0, 5, PULL_SIZE.pack(1024)),
+            Frame(FrameType.PUSH, "a", 1, -1, b"one"),
+            Frame(FrameType.PUSH, "gone", 2, -1, b"two"),
+            Frame(FrameType.KEEP_ALIVE, "a", 3),
+            Frame(FrameType.PULL, "idle", 4, -1, PULL_SIZE.pack(1024)),
+            Frame(FrameType.PULL, "gone", 5, -1, PULL_SIZE.pack(1024)),
+            Frame(FrameType.PUSH, "unknown", 6, -1, b"three"),
+        ]
+        responses = await asyncio.wait_for(handle_frames(upstream, frames, 5.0), 1)
+
+        # One answer per frame, in order; pushes applied in request order.
+        assert [(frame.type, frame.rid) for frame in responses] == [
+            (FrameType.DATA, 0),
+            (FrameType.ACK, 1),
+            (FrameType.CLOSED, 2),
+            (FrameType.ACK, 3),
+            (FrameType.DATA, 4),
+            (FrameType.CLOSED, 5),
+            (FrameType.INVALID, 6),
+        ]
+        assert upstream.pushed == [("a", b"one", 1), ("gone", b"two", 2)]
+        assert responses[0].payload == b"answer"
+        # A push ACK carries the send window.
+        assert responses[1].seq == 4096
+        # The idle pull is cut short once another had an answer, and comes back empty.
+        assert (responses[4].seq, responses[4].payload) == (-1, b"")
+
+    asyncio.run(main())
+
+
+def test_pull_not_stuck_behind_held_batches(monkeypatch):
+    monkeypatch.setattr(mux, "HOLD_TIME", 1.0)
+
+    async def main():
+        upstream = Upstream()
+        scheduler = MuxScheduler(upstream.request, max_inflight=2)
+
+        # An idle tunnel's long-poll takes the only held slot.
+        idle = asyncio.ensure_future(scheduler.call(pull("idle", 0)))
+        await asyncio.sleep(0.05)
+
+        # A busy tunnel's pull rides along with its push, and comes back empty.
+        push = Frame(FrameType.PUSH, "busy", 0, -1, b"data")
+        ack, empty = await asyncio.gather(scheduler.call(push), scheduler.call(pull("busy", 0)))
+        assert (ack.type, empty.payload) == (FrameType.ACK, b"")
+
+        # Its next pull must not wait for the idle one's hold to run out.
+        started_at = time.monotonic()
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.1, upstream.queues["busy"].put_nowait, b"answer")
+        assert await asyncio.wait_for(pull_data(scheduler, "busy", 1), 2) == b"answer"
+        assert time.monotonic() - started_at < 0.5
+
+        scheduler.close()
+        idle.cancel()
+
+    asyncio.run(main())
@@ -0,0 +1,80 @@
+import asyncio
+
+from webvpn.gateway.gateway import ConnectionClosedError
+from webvpn.gateway.pipeline import PullWindow, MIN_PULL_SIZE
+
+
+class Server:
+    # Answers pull `rid` with data seq `rid` after the delay given for it.
+    def __init__(self, delays=None):
+        self.delays = delays or {}
+        self.sizes = []
+
+    async def request(self, rid: int, n: int):
+        self.sizes.append(n)
+        await asyncio.sleep(self.delays.get(rid, 0))
+        return rid, b"%d" % rid
+
+
+def test_chunks_are_delivered_in_order():
+    async def main():
+        server = Server({0: 0.03, 1: 0.01})
+        window = PullWindow(server.request, min_window=3)
+        # The later chunks come first and wait for the first one.
+        assert [await window.get(32 * 1024) for _ in range(3)] == [b"0", b"1", b"2"]
+        assert server.sizes[:3] == [32 * 1024] * 3
+        window.close()
+
+    asyncio.run(main())
+
+
+def test_requests_are_bounded_by_credit():
+    async def main():
+        server = Server({0: 0.01, 1: 0.01})
+        window = PullWindow(server.request, min_window=4, recv_window=64 * 1024)
+        await window.get(32 * 1024)
+        assert server.sizes[:2] == [32 * 1024, 32 * 1024]
+        assert len(server.sizes) == 2
+        window.close()
+
+        # With no credit left and nothing in flight, one minimal pull still goes out.
+        server = Server()
+        window = PullWindow(server.request, recv_window=0)
+        assert await window.get(1024) == b"0"
+        assert server.sizes == [MIN_PULL_SIZE]
+        window.close()
+
+    asyncio.run(main())
+
+
+def test_feed_and_ack():
+    async def main():
+        window = PullWindow(Server().request)
+        window.feed(2, b"c")
+        assert window.ack == 0
+        window.feed(0, b"a")
+        assert window.ack == 1
+        assert window.credit == window.recv_window - 2
+        # Duplicates and empty chunks are ignored.
+        window.feed(0, b"x")
+        window.feed(1, b"")
+        assert await window.get(1024) == b"a"
+        assert window.ack == 1
+        window.feed(0, b"a")
+        window.feed(1, b"b")
+        assert [await window.get(1024) for _ in range(2)] == [b"b", b"c"]
+        window.close()
+
+    asyncio.run(main())
+
+
+def test_closed_connection_ends_the_stream():
+    async def closed(rid: int, n: int):
+        raise ConnectionClosedError()
+
+    async def main():
+        window = PullWindow(closed)
+        assert await window.get(1024) is None
+        assert window.closed
+
+    asyncio.run(main())
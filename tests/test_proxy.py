@@ -0,0 +1,104 @@
+import asyncio
+import struct
+
+import pytest
+
+from webvpn.proxy import (
+    ProxyClient, ProxyRequest, HandshakeReader, HandshakeError, split_host_port, socks_reply,
+    HTTP_BAD_REQUEST, HTTP_NOT_ALLOWED, SOCKS_BAD_ADDRESS, SOCKS_BAD_COMMAND,
+)
+
+
+class Writer:
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data: bytes):
+        self.data += data
+
+
+def handshake(data: bytes, eof: bool = True):
+    # (request, bytes written back, bytes left over for the tunnel)
+    async def main():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        if eof:
+            reader.feed_eof()
+        writer = Writer()
+        handshake = HandshakeReader(reader, limit=64)
+        client = ProxyClient(username="alice", password="", gateway=None)
+        request = await client.handshake(handshake, writer)
+        return request, bytes(writer.data), handshake.rest()
+
+    return asyncio.run(main())
+
+
+def socks5(address_type: int, address: bytes, port: int = 22, command: int = 1) -> bytes:
+    return b"\x05\x01\x00" + bytes([5, command, 0, address_type]) + address + struct.pack("!H", port)
+
+
+def test_socks5_requests():
+    request, written, rest = handshake(socks5(1, bytes([10, 0, 0, 1])) + b"SSH-2.0")
+    assert request == ProxyRequest("socks5", "10.0.0.1", 22)
+    assert written == b"\x05\x00"
+    assert rest == b"SSH-2.0"
+
+    request, _, _ = handshake(socks5(3, b"\x0bexample.com", 443))
+    assert request == ProxyRequest("socks5", "example.com", 443)
+    request, _, _ = handshake(socks5(4, bytes(15) + b"\x01", 80))
+    assert request == ProxyRequest("socks5", "::1", 80)
+
+
+def test_socks5_errors():
+    with pytest.raises(HandshakeError) as e:
+        handshake(b"\x05\x01\x02")    # username/password auth only
+    assert e.value.reply == b"\x05\xff"
+
+    with pytest.raises(HandshakeError) as e:
+        handshake(socks5(1, bytes(4), command=2))   # BIND
+    assert e.value.reply == socks_reply(SOCKS_BAD_COMMAND)
+
+    with pytest.raises(HandshakeError) as e:
+        handshake(b"\x05\x01\x00" + bytes([5, 1, 0, 9]))
+    assert e.value.reply == socks_reply(SOCKS_BAD_ADDRESS)
+
+    with pytest.raises(HandshakeError):
+        handshake(b"\x05\x01\x00" + bytes([4, 1, 0, 1]))
+
+    with pytest.raises(HandshakeError):
+        handshake(socks5(1, bytes(4))[:-1])
+
+
+def test_http_connect_requests():
+    request, written, rest = handshake(
+        b"CONNECT example.com:443 HTTP/1.1\r\nHost: example.com:443\r\n\r\n\x16\x03\x01"
+    )
+    assert request == ProxyRequest("http", "example.com", 443)
+    assert written == b""
+    assert rest == b"\x16\x03\x01"
+
+    request, _, _ = handshake(b"CONNECT [::1]:22 HTTP/1.0\n\n")
+    assert request == ProxyRequest("http", "::1", 22)
+
+
+def test_http_connect_errors():
+    with pytest.raises(HandshakeError) as e:
+        handshake(b"GET http://example.com/ HTTP/1.1\r\n\r\n")
+    assert e.value.reply == HTTP_NOT_ALLOWED
+
+    for line in (b"CONNECT example.com HTTP/1.1", b"CONNECT example.com:0 HTTP/1.1", b"CONNECT a:1"):
+        with pytest.raises(HandshakeError) as e:
+            handshake(line + b"\r\n\r\n")
+        assert e.value.reply == HTTP_BAD_REQUEST
+
+    # Headers without end are cut off past the limit.
+    with pytest.raises(HandshakeError, match="too large"):
+        handshake(b"CONNECT a:1 HTTP/1.1\r\nX-Pad: " + b"x" * 200, eof=False)
+
+
+def test_split_host_port():
+    assert split_host_port("example.com:80") == ("example.com", 80)
+    assert split_host_port("[fe80::1]:8080") == ("fe80::1", 8080)
+    for authority in ("example.com", ":80", "a:65536", "a:x"):
+        with pytest.raises(ValueError):
+            split_host_port(authority)
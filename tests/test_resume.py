@@ -0,0 +1,118 @@
+import asyncio
+import socket
+
+from webvpn.gateway.tcp import TCPConnection, UNACKED_EVICTED
+
+
+async def connect(**kwargs):
+    # A tunnel whose upstream is the other end of a local socket pair.
+    upstream, peer = socket.socketpair()
+    reader, writer = await asyncio.open_connection(sock=upstream)
+    return TCPConnection(reader, writer, "alice", **kwargs), peer
+
+
+async def pull(conn: TCPConnection, peer: socket.socket, data: bytes, seq: int, ack=None):
+    peer.sendall(data)
+    return await conn.pull_chunk(1024, seq, hold=1.0, ack=ack)
+
+
+async def close(conn: TCPConnection, peer: socket.socket):
+    peer.close()
+    await conn.close()
+
+
+def test_nothing_kept_before_first_ack():
+    async def main():
+        conn, peer = await connect()
+        chunk = await pull(conn, peer, b"a", 0)
+        assert (chunk.seq, chunk.data) == (0, b"a")
+        assert not conn.unacked
+        # An older client never acknowledges: it can only resume from where it is.
+        assert conn.resume(0) is None
+        assert conn.resume(1) == 0
+        await close(conn, peer)
+
+    asyncio.run(main())
+
+
+def test_ack_drops_acknowledged_chunks():
+    async def main():
+        conn, peer = await connect()
+        await pull(conn, peer, b"a", 0, ack=0)
+        await pull(conn, peer, b"bb", 1, ack=1)
+        await pull(conn, peer, b"ccc", 2)
+        assert list(conn.unacked) == [1, 2]
+        assert conn.unacked_size == 5
+
+        conn.ack(2)
+        assert list(conn.unacked) == [2]
+        assert conn.unacked_size == 3
+        assert conn.unacked_from == 2
+        # Acknowledging past what was pulled is bounded by it.
+        conn.ack(10)
+        assert not conn.unacked
+        assert conn.unacked_from == 3
+        await close(conn, peer)
+
+    asyncio.run(main())
+
+
+def test_resume_redelivers_unacked_chunks_in_order():
+    async def main():
+        conn, peer = await connect()
+        await pull(conn, peer, b"a", 0, ack=0)
+        await pull(conn, peer, b"b", 1)
+        await pull(conn, peer, b"c", 2)
+
+        # Past what was pulled, there is nothing to resume from.
+        assert conn.resume(4) is None
+
+        assert conn.resume(1) == 0
+        assert conn.resumes == 1
+        chunks = [await conn.pull_chunk(1024, seq, hold=0) for seq in (10, 11)]
+        assert [(chunk.seq, chunk.data) for chunk in chunks] == [(1, b"b"), (2, b"c")]
+
+        # Then new data follows on.
+        chunk = await pull(conn, peer, b"d", 12)
+        assert (chunk.seq, chunk.data) == (3, b"d")
+        await close(conn, peer)
+
+    asyncio.run(main())
+
+
+def test_resume_skips_chunks_acknowledged_since():
+    async def main():
+        conn, peer = await connect()
+        await pull(conn, peer, b"a", 0, ack=0)
+        await pull(conn, peer, b"b", 1)
+        await pull(conn, peer, b"c", 2)
+
+        assert conn.resume(0) == 0
+        # The old session acknowledged seq 1 after all.
+        chunk = await conn.pull_chunk(1024, 10, hold=0, ack=2)
+        assert (chunk.seq, chunk.data) == (2, b"c")
+        await close(conn, peer)
+
+    asyncio.run(main())
+
+
+def test_retain_evicts_oldest_past_resume_buffer():
+    async def main():
+        conn, peer = await connect(resume_buffer=4)
+        evicted = UNACKED_EVICTED.value
+        conn.ack(0)
+        for seq, data in enumerate((b"aa", b"bb", b"cc")):
+            await pull(conn, peer, data, seq)
+
+        assert list(conn.unacked) == [1, 2]
+        assert conn.unacked_size == 4
+        assert conn.unacked_from == 1
+        assert UNACKED_EVICTED.value == evicted + 1
+
+        # Resuming from before the evicted chunk would lose it.
+        assert conn.resume(0) is None
+        assert conn.resume(1) == 0
+        assert [chunk.seq for chunk in conn.redeliver] == [1, 2]
+        await close(conn, peer)
+
+    asyncio.run(main())
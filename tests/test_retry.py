@@ -0,0 +1,117 @@
+import asyncio
+import time
+
+import pytest
+
+from webvpn.gateway.gateway import ConnectionClosedError
+from webvpn.gateway.retry import (
+    CircuitBreaker, BreakerState, RetryPolicy, RetriesExhausted, HEDGES, HEDGE_WINS,
+)
+
+
+def test_breaker_opens_after_threshold():
+    breaker = CircuitBreaker(threshold=3, reset_timeout=10.0)
+    for _ in range(2):
+        breaker.on_failure()
+    assert breaker.state == BreakerState.CLOSED
+    breaker.on_success()
+    for _ in range(2):
+        breaker.on_failure()
+    # Failures count in a row only.
+    assert breaker.state == BreakerState.CLOSED
+    breaker.on_failure()
+    assert breaker.state == BreakerState.OPEN
+
+
+def test_breaker_probes_once_per_reset_timeout():
+    async def main():
+        breaker = CircuitBreaker(threshold=1, reset_timeout=0.05)
+        breaker.on_failure()
+
+        # Callers wait for the probe; one gets it, the others wait on its outcome.
+        started_at = time.monotonic()
+        first = await breaker.allow()
+        assert first and breaker.state == BreakerState.HALF_OPEN
+        assert time.monotonic() - started_at >= 0.04
+
+        waiter = asyncio.ensure_future(breaker.allow())
+        await asyncio.sleep(0.01)
+        assert not waiter.done()
+        breaker.on_success()
+        assert await waiter
+        assert breaker.state == BreakerState.CLOSED
+
+        # A failed probe opens it again.
+        breaker.on_failure()
+        assert await breaker.allow()
+        breaker.on_failure()
+        assert breaker.state == BreakerState.OPEN
+        # Of callers due at the same time, only one is let through.
+        assert sorted(await asyncio.gather(breaker.allow(), breaker.allow())) == [False, True]
+
+    asyncio.run(main())
+
+
+def test_breaker_can_be_built_outside_a_loop():
+    breaker = CircuitBreaker(threshold=1, reset_timeout=0.01)
+    breaker.on_failure()
+    assert asyncio.run(breaker.allow())
+    breaker.on_success()
+    breaker.on_failure()
+    assert asyncio.run(breaker.allow())
+
+
+async def answer(value, delay: float = 0.0, error: Exception = None):
+    await asyncio.sleep(delay)
+    if error is not None:
+        raise error
+    return value
+
+
+def test_hedge_not_sent_for_prompt_answers():
+    hedges = HEDGES.value
+    policy = RetryPolicy()
+    result = asyncio.run(policy.hedge(lambda: answer("primary"), lambda: answer("backup"), 0.1))
+    assert result == "primary"
+    assert HEDGES.value == hedges
+
+
+def test_hedge_wins_over_late_primary():
+    hedges, wins = HEDGES.value, HEDGE_WINS.value
+    policy = RetryPolicy()
+    result = asyncio.run(policy.hedge(lambda: answer("primary", 1.0), lambda: answer("backup"), 0.01))
+    assert result == "backup"
+    assert (HEDGES.value, HEDGE_WINS.value) == (hedges + 1, wins + 1)
+
+
+def test_hedge_errors():
+    policy = RetryPolicy()
+
+    # A call that got no answer leaves the other to answer.
+    unanswered = RetriesExhausted("pull", 0.0)
+    result = asyncio.run(policy.hedge(
+        lambda: answer(None, 0.02, unanswered), lambda: answer("backup", 0.05), 0.01
+    ))
+    assert result == "backup"
+
+    # An answer that the tunnel is gone is final.
+    with pytest.raises(ConnectionClosedError):
+        asyncio.run(policy.hedge(
+            lambda: answer(None, 0.02, ConnectionClosedError()), lambda: answer("backup", 0.05), 0.01
+        ))
+
+    # Neither answered.
+    with pytest.raises(RetriesExhausted):
+        asyncio.run(policy.hedge(
+            lambda: answer(None, 0.02, unanswered), lambda: answer(None, 0.0, unanswered), 0.01
+        ))
+
+
+def test_no_hedge_without_samples_or_while_open():
+    policy = RetryPolicy(breaker_threshold=1)
+    assert policy.get_hedge_delay(1.0) is None
+    for _ in range(16):
+        policy.rtt.observe(0.01)
+    assert policy.get_hedge_delay(1.0) == pytest.approx(1.05)
+    policy.breaker.on_failure()
+    assert policy.get_hedge_delay(1.0) is None
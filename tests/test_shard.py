@@ -0,0 +1,79 @@
+import asyncio
+
+from webvpn.shard import ShardRouter, get_shard
+
+
+async def start(tmp_path, handler):
+    owner = ShardRouter(1, 2, str(tmp_path))
+    await owner.serve(handler)
+    return ShardRouter(0, 2, str(tmp_path)), owner
+
+
+def test_tokens_are_routed_by_prefix():
+    router = ShardRouter(0, 3)
+    assert router.token_prefix == "0."
+    assert get_shard("2.abc") == 2
+    assert router.owner("2.abc") == 2
+    # Tokens of no known shard are left to the local gateway to reject.
+    assert router.owner("7.abc") == 0
+    assert router.owner("abc") == 0
+    assert ShardRouter().token_prefix == ""
+
+
+def test_forward(tmp_path):
+    seen = []
+
+    async def handler(method, path, params, chunks):
+        body = b"".join([chunk async for chunk in chunks])
+        seen.append((method, path, params, body))
+        return 200, {"X-Seq": "5"}, body.upper()
+
+    async def stream():
+        for chunk in (b"ab", b"", b"cd"):
+            yield chunk
+
+    async def main():
+        router, owner = await start(tmp_path, handler)
+        assert await router.forward(1, "POST", "/push", {"token": "1.t"}, b"data") == (200, {"X-Seq": "5"}, b"DATA")
+        assert await router.forward(1, "POST", "/push", {"token": "1.t"}, stream()) == (200, {"X-Seq": "5"}, b"ABCD")
+        assert await router.forward(1, "GET", "/keep-alive", {"token": "1.t"}, b"") == (200, {"X-Seq": "5"}, b"")
+        assert seen[0] == ("POST", "/push", {"token": "1.t"}, b"data")
+        # One connection, reused.
+        assert len(router._idle[1]) == 1
+        await router.close()
+        await owner.close()
+
+    asyncio.run(main())
+
+
+def test_unread_body_is_skipped(tmp_path):
+    async def handler(method, path, params, chunks):
+        return 400, {}, b""
+
+    async def main():
+        router, owner = await start(tmp_path, handler)
+        for _ in range(2):
+            assert await router.forward(1, "POST", "/push", {}, b"x" * 100000) == (400, {}, b"")
+        await router.close()
+        await owner.close()
+
+    asyncio.run(main())
+
+
+def test_cancelled_forward_drops_its_connection(tmp_path):
+    async def handler(method, path, params, chunks):
+        if path == "/pull":
+            await asyncio.sleep(10)
+        return 200, {}, b""
+
+    async def main():
+        router, owner = await start(tmp_path, handler)
+        pull = asyncio.ensure_future(router.forward(1, "GET", "/pull", {}, b""))
+        await asyncio.sleep(0.05)
+        pull.cancel()
+        assert await router.forward(1, "GET", "/keep-alive", {}, b"") == (200, {}, b"")
+        assert len(router._idle[1]) == 1
+        await router.close()
+        await owner.close()
+
+    asyncio.run(main())
@@ -0,0 +1,840 @@
+from typing import Optional, List, Dict, Tuple, Union
+from dataclasses import dataclass, asdict
+import asyncio
+import hashlib
+import itertools
+import logging
+import math
+import os
+import socket
+import struct
+import sys
+import time
+import tracemalloc
+
+import aiohttp
+
+from .gateway import buffered
+from .gateway.metrics import TIME_BUCKETS
+from .client import Client
+from .gateway import WebVPNGateway
+from .simulator import get_urls
+
+logger = logging.getLogger(__name__)
+
+# The bench target speaks a one-byte command followed by its arguments:
+#   E: echo everything back
+#   S: sink `length` bytes, then answer with their digest
+#   D: source `length` bytes
+LENGTH = struct.Struct("!Q")
+READ_SIZE = 256 * 1024
+
+MODES = {
+    "plain": {},
+    "mux": {"mux": True},
+    "exchange": {"exchange": True},
+    "compressed": {"compression": "zstd,zlib"},
+}
+
+
+@dataclass
+class BenchResult:
+    mode: str
+    chunk_size: int
+    tunnels: int
+    upload_bytes: int
+    upload_mbps: float
+    download_bytes: int
+    download_mbps: float
+    latency_p50_ms: float
+    latency_p99_ms: float
+    requests: int
+    requests_per_byte: float
+    errors: int
+
+
+@dataclass
+class RpsResult:
+    server: str
+    workers: int
+    route: str
+    concurrency: int
+    requests: int
+    errors: int
+    rps: float
+    server_cpu_seconds: float
+    requests_per_cpu_second: float
+
+
+@dataclass
+class IoResult:
+    io: str
+    side: str
+    read_size: int
+    total_bytes: int
+    mbps: float
+    reads: int
+    buffer_allocations: int
+    traced_peak_kb: float
+
+
+@dataclass
+class ScaleResult:
+    idle_tokens: int
+    active_tokens: int
+    lazy: bool
+    open_seconds: float
+    rss_base_mb: float
+    rss_mb: float
+    rss_per_token_kb: float
+    pulls: int
+    errors: int
+    pull_p50_ms: float
+    pull_p99_ms: float
+    idle_loop_lag_p99_ms: float
+    loop_lag_p50_ms: float
+    loop_lag_p99_ms: float
+
+
+# Server variants compared by the requests/sec benchmark.
+SERVERS = {
+    "fastapi": {"WEBVPN_FAST_PATH": "false"},
+    "fastpath": {"WEBVPN_FAST_PATH": "true"},
+}
+RPS_ROUTES = ("push", "pull", "keep-alive")
+
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def raise_fd_limit():
+    # Every tunnel costs several sockets in this process alone.
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def get_rss(pid: int) -> Optional[int]:
+    # Resident set size in bytes, from procfs where there is one.
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        ...
+    return None
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+
+def pattern(size: int) -> bytes:
+    return bytes(i % 251 for i in range(size))
+
+
+def source_digest(length: int) -> bytes:
+    # Of what the target's `D` command sends: `pattern(READ_SIZE)` over and over.
+    digest = hashlib.sha1()
+    block = pattern(READ_SIZE)
+    while length > 0:
+        digest.update(block[:length])
+        length -= min(length, len(block))
+    return digest.digest()
+
+
+async def target_handler(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        command = await reader.readexactly(1)
+        if command == b"E":
+            while True:
+                data = await reader.read(READ_SIZE)
+                if not data:
+                    break
+                writer.write(data)
+                await writer.drain()
+        elif command == b"S":
+            length, = LENGTH.unpack(await reader.readexactly(LENGTH.size))
+            digest = hashlib.sha1()
+            while length > 0:
+                data = await reader.read(min(length, READ_SIZE))
+                if not data:
+                    break
+                digest.update(data)
+                length -= len(data)
+            writer.write(digest.digest())
+            await writer.drain()
+        elif command == b"D":
+            length, = LENGTH.unpack(await reader.readexactly(LENGTH.size))
+            block = pattern(READ_SIZE)
+            while length > 0:
+                writer.write(block[:length])
+                length -= min(length, len(block))
+                await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        ...
+    finally:
+        writer.close()
+
+
+def read_stat(pid: Union[int, str]) -> Optional[List[str]]:
+    # The fields of /proc/<pid>/stat past the command name, from state on.
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read().rpartition(")")[2].split()
+    except OSError:
+        return None
+
+
+def get_cpu_time(pid: int) -> Optional[float]:
+    # utime + stime of a child process and of its own children (the workers of a
+    # sharded server), from procfs where there is one.
+    fields = read_stat(pid)
+    if fields is None:
+        return None
+    ticks = int(fields[11]) + int(fields[12])
+    for name in os.listdir("/proc"):
+        if name.isdigit():
+            child = read_stat(name)
+            if child is not None and child[1] == str(pid):
+                ticks += int(child[11]) + int(child[12])
+    return ticks / os.sysconf("SC_CLK_TCK")
+
+
+async def start_server(
+    port: int, verbose: bool = False, env: Optional[Dict[str, str]] = None, workers: int = 1
+) -> asyncio.subprocess.Process:
+    try:
+        import uvicorn     # noqa: F401
+    except ImportError:
+        raise RuntimeError("The benchmark needs the server dependencies: pip install fastapi uvicorn")
+
+    if workers > 1:
+        # Sharded as `webvpn serve` runs it, tokens forwarded between workers.
+        args = ["-m", "webvpn.cmd", "serve", "--workers", str(workers)]
+    else:
+        args = ["-m", "uvicorn", "webvpn.server:app", "--log-level", "warning"]
+    output = None if verbose else asyncio.subprocess.DEVNULL
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, *args, "--host", "127.0.0.1", "--port", str(port),
+        stdout=output, stderr=output, env={**os.environ, "WEBVPN_SENTRY": "false", **(env or {})},
+    )
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.returncode is not None:
+            break
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+        except OSError:
+            await asyncio.sleep(0.1)
+            continue
+        writer.close()
+        return process
+
+    process.kill()
+    raise RuntimeError("Failed to start the server")
+
+
+class Tunnel:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def open(cls, port: int, command: bytes, length: int = 0) -> "Tunnel":
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(command + (LENGTH.pack(length) if command != b"E" else b""))
+        return cls(reader, writer)
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            ...
+
+    async def ping(self, chunk: bytes, rounds: int) -> List[float]:
+        latencies = []
+        for _ in range(rounds):
+            started_at = time.perf_counter()
+            self.writer.write(chunk)
+            await self.writer.drain()
+            echo = await self.reader.readexactly(len(chunk))
+            latencies.append(time.perf_counter() - started_at)
+            if echo != chunk:
+                raise RuntimeError("Corrupted echo")
+        return latencies
+
+    async def upload(self, chunk: bytes, length: int):
+        digest = hashlib.sha1()
+        remaining = length
+        while remaining > 0:
+            data = chunk[:remaining]
+            digest.update(data)
+            self.writer.write(data)
+            await self.writer.drain()
+            remaining -= len(data)
+        if await self.reader.readexactly(digest.digest_size) != digest.digest():
+            raise RuntimeError("Corrupted upload")
+
+    async def download(self, length: int, expected: bytes):
+        digest = hashlib.sha1()
+        remaining = length
+        while remaining > 0:
+            data = await self.reader.read(min(remaining, READ_SIZE))
+            if not data:
+                raise RuntimeError("Short download")
+            digest.update(data)
+            remaining -= len(data)
+        if digest.digest() != expected:
+            raise RuntimeError("Corrupted download")
+
+
+class Bench:
+    def __init__(
+        self,
+        *,
+        server_port: int,
+        rounds: int = 20,
+        total_size: int = 16 * 1024 * 1024,
+        timeout: float = 120.0,
+        simulator_port: Optional[int] = None,
+        io: str = "stream",
+    ):
+        self.server_port = server_port
+        self.io = io
+        self.simulator_port = simulator_port
+        self.rounds = rounds
+        self.total_size = total_size
+        self.timeout = timeout
+
+    async def _gather(self, coros) -> Tuple[list, int]:
+        results = await asyncio.wait_for(
+            asyncio.gather(*coros, return_exceptions=True), timeout=self.timeout
+        )
+        errors = [r for r in results if isinstance(r, BaseException)]
+        for e in errors[:3]:
+            logger.error(f"Tunnel failed: {e!r}")
+        return [r for r in results if not isinstance(r, BaseException)], len(errors)
+
+    async def _open(self, port: int, tunnels: int, command: bytes, length: int = 0) -> Tuple[list, int]:
+        return await self._gather([Tunnel.open(port, command, length) for _ in range(tunnels)])
+
+    async def _close(self, opened: List[Tunnel]):
+        await asyncio.gather(*[t.close() for t in opened])
+
+    async def run_case(self, mode: str, chunk_size: int, tunnels: int) -> BenchResult:
+        if self.simulator_port is None:
+            endpoint = {"base_url": f"http://127.0.0.1:{self.server_port}", "require_login": False}
+        else:
+            urls = get_urls("127.0.0.1", self.simulator_port)
+            endpoint = {
+                "base_url": urls["BASE_URL"],
+                "login_url": urls["LOGIN_URL"],
+                "submit_url": urls["LOGIN_SUBMIT_URL"],
+            }
+        gateway = WebVPNGateway(**endpoint, **MODES[mode])
+        target = await asyncio.start_server(target_handler, "127.0.0.1", 0)
+        target_port = target.sockets[0].getsockname()[1]
+        client = Client(
+            host="127.0.0.1",
+            port=0,
+            rhost="127.0.0.1",
+            rport=target_port,
+            username="bench",
+            password="",
+            gateway=gateway,
+        )
+        tcp_server = await buffered.start_server(client.conn_handler, "127.0.0.1", 0, io=self.io)
+        port = tcp_server.sockets[0].getsockname()[1]
+
+        chunk = pattern(chunk_size)
+        length = max(self.total_size // tunnels, chunk_size)
+        errors = 0
+        try:
+            opened, failed = await self._open(port, tunnels, b"E")
+            errors += failed
+            results, failed = await self._gather([t.ping(chunk, self.rounds) for t in opened])
+            errors += failed
+            await self._close(opened)
+            latencies = [latency for result in results for latency in result]
+
+            opened, failed = await self._open(port, tunnels, b"S", length)
+            errors += failed
+            started_at = time.perf_counter()
+            results, failed = await self._gather([t.upload(chunk, length) for t in opened])
+            upload_time = time.perf_counter() - started_at
+            errors += failed
+            await self._close(opened)
+            upload_bytes = length * len(results)
+
+            opened, failed = await self._open(port, tunnels, b"D", length)
+            errors += failed
+            expected = source_digest(length)
+            started_at = time.perf_counter()
+            results, failed = await self._gather([t.download(length, expected) for t in opened])
+            download_time = time.perf_counter() - started_at
+            errors += failed
+            await self._close(opened)
+            download_bytes = length * len(results)
+        finally:
+            tcp_server.close()
+            target.close()
+            stats = gateway.get_pool_stats()
+            await gateway.shutdown()
+
+        # Requests per byte covers the whole case, handshakes and keep-alives included.
+        moved = upload_bytes + download_bytes + 2 * chunk_size * len(latencies)
+        return BenchResult(
+            mode=mode,
+            chunk_size=chunk_size,
+            tunnels=tunnels,
+            upload_bytes=upload_bytes,
+            upload_mbps=round(upload_bytes / upload_time / 1024 / 1024, 2),
+            download_bytes=download_bytes,
+            download_mbps=round(download_bytes / download_time / 1024 / 1024, 2),
+            latency_p50_ms=round(percentile(latencies, 50) * 1000, 2),
+            latency_p99_ms=round(percentile(latencies, 99) * 1000, 2),
+            requests=stats["requests"],
+            requests_per_byte=stats["requests"] / moved if moved else 0.0,
+            errors=errors,
+        )
+
+
+async def run_bench(
+    *,
+    modes: List[str],
+    chunk_sizes: List[int],
+    tunnels: List[int],
+    rounds: int = 20,
+    total_size: int = 16 * 1024 * 1024,
+    server_port: Optional[int] = None,
+    simulator_port: Optional[int] = None,
+    io: str = "stream",
+    verbose: bool = False,
+) -> List[Dict]:
+    raise_fd_limit()
+
+    process = None
+    if server_port is None:
+        server_port = get_free_port()
+        process = await start_server(server_port, verbose)
+
+    bench = Bench(
+        server_port=server_port,
+        rounds=rounds,
+        total_size=total_size,
+        simulator_port=simulator_port,
+        io=io,
+    )
+    results = []
+    try:
+        for mode in modes:
+            for chunk_size in chunk_sizes:
+                for n in tunnels:
+                    result = await bench.run_case(mode, chunk_size, n)
+                    logger.info(
+                        f"{mode} chunk={chunk_size} tunnels={n}: "
+                        f"up {result.upload_mbps} MB/s, down {result.download_mbps} MB/s, "
+                        f"p50 {result.latency_p50_ms} ms, p99 {result.latency_p99_ms} ms, "
+                        f"{result.requests} requests, {result.errors} errors"
+                    )
+                    results.append(asdict(result))
+    finally:
+        if process is not None:
+            process.terminate()
+            await process.wait()
+
+    return results
+
+
+class RpsBench:
+    # Small requests against one server, so the cost measured is the per-request
+    # overhead of the HTTP stack rather than the tunnel.
+    def __init__(self, *, server_port: int, duration: float = 5.0, payload_size: int = 64):
+        self.base_url = f"http://127.0.0.1:{server_port}"
+        self.duration = duration
+        self.payload = pattern(payload_size)
+
+    async def _open_token(self, session: aiohttp.ClientSession, target_port: int) -> str:
+        params = {"username": "bench", "host": "127.0.0.1", "port": target_port}
+        async with session.get(self.base_url + "/token", params=params) as rsp:
+            data = await rsp.json()
+        if data["code"] != 0:
+            raise RuntimeError(data["message"])
+        token = data["data"]["token"]
+
+        # Turn the target into a sink that outlasts the run.
+        async with session.post(
+            self.base_url + "/push", params={"token": token}, data=b"S" + LENGTH.pack(2 ** 62)
+        ) as rsp:
+            rsp.raise_for_status()
+        return token
+
+    def _request(self, session: aiohttp.ClientSession, route: str, token: str):
+        if route == "push":
+            return session.post(self.base_url + "/push", params={"token": token}, data=self.payload)
+        if route == "pull":
+            return session.get(self.base_url + "/pull", params={"token": token, "hold": 0})
+        return session.get(self.base_url + "/keep-alive", params={"token": token})
+
+    async def run_case(
+        self, server: str, workers: int, route: str, concurrency: int, target_port: int, pid: Optional[int]
+    ) -> RpsResult:
+        connector = aiohttp.TCPConnector(limit=concurrency)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            token = await self._open_token(session, target_port)
+            requests = errors = 0
+            deadline = time.monotonic() + self.duration
+
+            async def worker():
+                nonlocal requests, errors
+                while time.monotonic() < deadline:
+                    try:
+                        async with self._request(session, route, token) as rsp:
+                            await rsp.read()
+                            if rsp.status == 200:
+                                requests += 1
+                            else:
+                                errors += 1
+                    except aiohttp.ClientError:
+                        errors += 1
+
+            cpu_before = get_cpu_time(pid) if pid is not None else None
+            started_at = time.monotonic()
+            await asyncio.gather(*[worker() for _ in range(concurrency)])
+            elapsed = time.monotonic() - started_at
+            cpu_after = get_cpu_time(pid) if pid is not None else None
+
+        cpu = cpu_after - cpu_before if cpu_before is not None and cpu_after is not None else 0.0
+        return RpsResult(
+            server=server,
+            workers=workers,
+            route=route,
+            concurrency=concurrency,
+            requests=requests,
+            errors=errors,
+            rps=round(requests / elapsed, 1),
+            server_cpu_seconds=round(cpu, 3),
+            requests_per_cpu_second=round(requests / cpu, 1) if cpu > 0 else 0.0,
+        )
+
+
+async def run_rps_bench(
+    *,
+    servers: List[str],
+    routes: List[str],
+    concurrency: List[int],
+    duration: float = 5.0,
+    payload_size: int = 64,
+    workers: Optional[List[int]] = None,
+    verbose: bool = False,
+) -> List[Dict]:
+    raise_fd_limit()
+
+    target = await asyncio.start_server(target_handler, "127.0.0.1", 0)
+    target_port = target.sockets[0].getsockname()[1]
+    results = []
+    try:
+        # With N workers, (N-1)/N of the requests land on a worker that does not own
+        # the token and take an extra hop to the one that does.
+        for server, n_workers in itertools.product(servers, workers or [1]):
+            server_port = get_free_port()
+            process = await start_server(server_port, verbose, SERVERS[server], n_workers)
+            bench = RpsBench(server_port=server_port, duration=duration, payload_size=payload_size)
+            try:
+                for route in routes:
+                    for n in concurrency:
+                        result = await bench.run_case(server, n_workers, route, n, target_port, process.pid)
+                        logger.info(
+                            f"{server} workers={n_workers} {route} concurrency={n}: {result.rps} req/s, "
+                            f"{result.requests_per_cpu_second} req/cpu-s, {result.errors} errors"
+                        )
+                        results.append(asdict(result))
+            finally:
+                process.terminate()
+                await process.wait()
+    finally:
+        target.close()
+
+    return results
+
+
+IO_SIDES = ("connect", "listen")
+
+
+class IoBench:
+    # Moves bytes over loopback with a plain asyncio peer on the other end, so only
+    # the socket I/O under test differs: the upstream side (`connect`, as in
+    # TCPGateway) or the local listener (`listen`, as in Client).
+    def __init__(self, *, total_size: int = 256 * 1024 * 1024, read_size: int = READ_SIZE):
+        self.total_size = total_size
+        self.read_size = read_size
+
+    async def _source(self, writer: asyncio.StreamWriter, length: int):
+        block = pattern(READ_SIZE)
+        while length > 0:
+            writer.write(block[:length])
+            length -= min(length, len(block))
+            await writer.drain()
+        writer.close()
+
+    async def _sink(self, reader, length: int) -> int:
+        reads = 0
+        while True:
+            data = await reader.read(self.read_size)
+            if not data:
+                break
+            reads += 1
+        return reads
+
+    async def _transfer(self, io: str, side: str, length: int) -> int:
+        done: asyncio.Future = asyncio.get_running_loop().create_future()
+
+        if side == "connect":
+            async def handler(reader, writer):
+                await self._source(writer, length)
+
+            server = await asyncio.start_server(handler, "127.0.0.1", 0)
+            port = server.sockets[0].getsockname()[1]
+            reader, writer = await buffered.open_connection("127.0.0.1", port, io=io)
+            reads = await self._sink(reader, length)
+            writer.close()
+        else:
+            async def handler(reader, writer):
+                done.set_result(await self._sink(reader, length))
+                writer.close()
+
+            server = await buffered.start_server(handler, "127.0.0.1", 0, io=io)
+            port = server.sockets[0].getsockname()[1]
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            await self._source(writer, length)
+            reads = await done
+
+        server.close()
+        await server.wait_closed()
+        return reads
+
+    async def run_case(self, io: str, side: str) -> IoResult:
+        allocated = buffered.ALLOCATED.value
+        started_at = time.perf_counter()
+        reads = await self._transfer(io, side, self.total_size)
+        elapsed = time.perf_counter() - started_at
+        # Every stream read allocates the bytes it returns; buffered reads only
+        # allocate when the pool has no free block.
+        allocations = reads if io == "stream" else buffered.ALLOCATED.value - allocated
+
+        # A shorter traced pass for memory: tracing would skew the timing above.
+        tracemalloc.start()
+        await self._transfer(io, side, min(self.total_size, 32 * 1024 * 1024))
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        return IoResult(
+            io=io,
+            side=side,
+            read_size=self.read_size,
+            total_bytes=self.total_size,
+            mbps=round(self.total_size / elapsed / 1024 / 1024, 2),
+            reads=reads,
+            buffer_allocations=allocations,
+            traced_peak_kb=round(peak / 1024, 1),
+        )
+
+
+async def run_io_bench(
+    *,
+    ios: List[str],
+    sides: List[str],
+    read_sizes: List[int],
+    total_size: int = 256 * 1024 * 1024,
+) -> List[Dict]:
+    results = []
+    for read_size in read_sizes:
+        bench = IoBench(total_size=total_size, read_size=read_size)
+        for side in sides:
+            for io in ios:
+                result = await bench.run_case(io, side)
+                logger.info(
+                    f"{io} {side} read={read_size}: {result.mbps} MB/s, {result.reads} reads, "
+                    f"{result.buffer_allocations} allocations, peak {result.traced_peak_kb} KB"
+                )
+                results.append(asdict(result))
+    return results
+
+
+class ScaleBench:
+    # Many tokens on one server: `idle` that only hold their upstream (or nothing,
+    # when lazy) and `active` that ping-pong small messages, to see what a token
+    # costs in memory and what a crowd of them does to the event loop and /pull.
+    def __init__(
+        self,
+        *,
+        server_port: int,
+        pid: int,
+        duration: float = 10.0,
+        payload_size: int = 64,
+        concurrency: int = 64,
+    ):
+        self.base_url = f"http://127.0.0.1:{server_port}"
+        self.pid = pid
+        self.duration = duration
+        self.payload = pattern(payload_size)
+        self.concurrency = concurrency
+
+    async def _open_tokens(
+        self, session: aiohttp.ClientSession, target_port: int, count: int, lazy: bool
+    ) -> List[str]:
+        params = {"username": "bench", "host": "127.0.0.1", "port": target_port, "lazy": str(lazy).lower()}
+        tokens: List[str] = []
+        remaining = count
+
+        async def worker():
+            nonlocal remaining
+            while remaining > 0:
+                remaining -= 1
+                async with session.get(self.base_url + "/token", params=params) as rsp:
+                    data = await rsp.json()
+                if data["code"] != 0:
+                    raise RuntimeError(data["message"])
+                tokens.append(data["data"]["token"])
+
+        await asyncio.gather(*[worker() for _ in range(min(self.concurrency, count))])
+        return tokens
+
+    async def _get_loop_lag(self, session: aiohttp.ClientSession) -> List[int]:
+        # Cumulative counts of the server's webvpn_loop_lag_seconds buckets.
+        async with session.get(self.base_url + "/metrics") as rsp:
+            text = await rsp.text()
+        return [
+            int(line.rsplit(" ", 1)[1])
+            for line in text.splitlines()
+            if line.startswith("webvpn_loop_lag_seconds_bucket")
+        ]
+
+    @staticmethod
+    def _lag_quantile(before: List[int], after: List[int], q: float) -> float:
+        # Upper bound (ms) of the bucket holding the q-th lag sampled in between.
+        counts = [b - a for a, b in zip(before, after)]
+        if not counts or not counts[-1]:
+            return 0.0
+        rank = q * counts[-1]
+        for bound, seen in zip(TIME_BUCKETS, counts):
+            if seen >= rank:
+                return round(bound * 1000, 3)
+        return math.inf
+
+    async def _ping_pong(self, session: aiohttp.ClientSession, token: str, deadline: float, stats: Dict):
+        params = {"token": token}
+        pull_params = {"token": token, "n": READ_SIZE, "hold": 5}
+        while time.monotonic() < deadline:
+            try:
+                async with session.post(self.base_url + "/push", params=params, data=self.payload) as rsp:
+                    await rsp.read()
+                    if rsp.status != 200:
+                        stats["errors"] += 1
+                        continue
+                received = 0
+                while received < len(self.payload):
+                    started_at = time.monotonic()
+                    async with session.get(self.base_url + "/pull", params=pull_params) as rsp:
+                        data = await rsp.read()
+                    if rsp.status != 200:
+                        stats["errors"] += 1
+                        break
+                    stats["latencies"].append(time.monotonic() - started_at)
+                    received += len(data)
+            except aiohttp.ClientError:
+                stats["errors"] += 1
+
+    async def run_case(self, idle: int, active: int, target_port: int, lazy: bool = False) -> ScaleResult:
+        connector = aiohttp.TCPConnector(limit=max(self.concurrency, active))
+        async with aiohttp.ClientSession(connector=connector) as session:
+            await self._open_tokens(session, target_port, 1, lazy)
+            rss_base = get_rss(self.pid) or 0
+
+            started_at = time.monotonic()
+            await self._open_tokens(session, target_port, idle, lazy)
+            actives = await self._open_tokens(session, target_port, active, False)
+            open_seconds = time.monotonic() - started_at
+            for token in actives:
+                async with session.post(self.base_url + "/push", params={"token": token}, data=b"E") as rsp:
+                    rsp.raise_for_status()
+
+            # The loop with every token open but only this bench's scrapes going on.
+            lag_before = await self._get_loop_lag(session)
+            await asyncio.sleep(min(self.duration, 2.0))
+            lag_idle = await self._get_loop_lag(session)
+
+            stats = {"latencies": [], "errors": 0}
+            deadline = time.monotonic() + self.duration
+            await asyncio.gather(*[self._ping_pong(session, token, deadline, stats) for token in actives])
+            lag_after = await self._get_loop_lag(session)
+            rss = get_rss(self.pid) or 0
+
+        tokens = idle + active
+        latencies = stats["latencies"]
+        return ScaleResult(
+            idle_tokens=idle,
+            active_tokens=active,
+            lazy=lazy,
+            open_seconds=round(open_seconds, 2),
+            rss_base_mb=round(rss_base / 1024 / 1024, 1),
+            rss_mb=round(rss / 1024 / 1024, 1),
+            rss_per_token_kb=round((rss - rss_base) / tokens / 1024, 2) if tokens else 0.0,
+            pulls=len(latencies),
+            errors=stats["errors"],
+            pull_p50_ms=round(percentile(latencies, 50) * 1000, 2),
+            pull_p99_ms=round(percentile(latencies, 99) * 1000, 2),
+            idle_loop_lag_p99_ms=self._lag_quantile(lag_before, lag_idle, 0.99),
+            loop_lag_p50_ms=self._lag_quantile(lag_idle, lag_after, 0.5),
+            loop_lag_p99_ms=self._lag_quantile(lag_idle, lag_after, 0.99),
+        )
+
+
+async def run_scale_bench(
+    *,
+    idle: int = 10000,
+    active: int = 1000,
+    duration: float = 10.0,
+    payload_size: int = 64,
+    lazy: bool = False,
+    io: str = "stream",
+    verbose: bool = False,
+) -> List[Dict]:
+    raise_fd_limit()
+
+    target = await asyncio.start_server(target_handler, "127.0.0.1", 0, backlog=1024)
+    target_port = target.sockets[0].getsockname()[1]
+    server_port = get_free_port()
+    # Tokens outlive the run however long opening them takes.
+    env = {"WEBVPN_SOCKET_IO": io, "WEBVPN_TUNNEL_TTL": "3600", "WEBVPN_LAZY_TOKEN_TTL": "3600"}
+    process = await start_server(server_port, verbose, env)
+    try:
+        bench = ScaleBench(server_port=server_port, pid=process.pid, duration=duration, payload_size=payload_size)
+        result = await bench.run_case(idle, active, target_port, lazy)
+        logger.info(
+            f"idle={idle}{' (lazy)' if lazy else ''} active={active} io={io}: "
+            f"{result.rss_per_token_kb} KB/token ({result.rss_mb} MB), "
+            f"pull p50 {result.pull_p50_ms} ms, p99 {result.pull_p99_ms} ms, "
+            f"loop lag p99 {result.idle_loop_lag_p99_ms} ms idle, {result.loop_lag_p99_ms} ms active, "
+            f"{result.errors} errors"
+        )
+    finally:
+        process.terminate()
+        await process.wait()
+        target.close()
+
+    return [asdict(result)]
@@ -1,9 +1,13 @@
 from typing import Optional
 from dataclasses import dataclass
 import asyncio
+import json
 import logging
 
+from .gateway.buffered import start_server
 from .gateway import WebVPNGateway
+from .gateway.metrics import registry
+from .runtime import SocketOptions
 
 logger = logging.getLogger(__name__)
 
@@ -27,6 +31,12 @@ class Client:
         username: str,
         password: str,
         gateway: WebVPNGateway,
+        stats_port: int = 0,
+        stats_interval: float = 0,
+        backlog: int = 100,
+        socket_options: SocketOptions = SocketOptions(),
+        drain_timeout: float = 10.0,
+        io: str = "stream",
     ):
         self.host = host
         self.port = port
@@ -39,18 +49,31 @@ class Client:
         self.gateway = gateway
         self.tcp_server: Optional[asyncio.Server] = None
 
+        self.stats_port = stats_port
+        self.stats_interval = stats_interval
+        self.stats_server: Optional[asyncio.Server] = None
+
+        self.backlog = backlog
+        self.socket_options = socket_options
+        self.drain_timeout = drain_timeout
+        self.io = io
+
     async def pull(self, conn: Connection):
         writer, token = conn.writer, conn.token
 
         while not conn.closed:
-            data = await self.gateway.pull(token, 1000 * 1024)
+            data = await self.gateway.pull(token, self.gateway.max_body_size)
             if data:
                 writer.write(data)
+                # Stop pulling while the local peer is slow; the tunnel's credit then
+                # runs out and the server stops reading upstream.
+                try:
+                    await writer.drain()
+                except ConnectionError:
+                    conn.closed = True
             elif data is None:
                 conn.closed = True
 
-        await writer.drain()
-
         writer.close()
         await writer.wait_closed()
 
@@ -60,7 +83,7 @@ class Client:
         reader, token = conn.reader, conn.token
 
         while not conn.closed:
-            data = await reader.read(1000 * 1024)
+            data = await reader.read(self.gateway.get_read_size(token))
             if not data:
                 conn.closed = True
                 break
@@ -68,20 +91,14 @@ class Client:
 
         logger.debug("push done")
 
-    async def conn_handler(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
-        addr = writer.get_extra_info("peername")
-        logger.info(f"Connection established: {addr!r}")
-
+    async def open_connection(self, rhost: str, rport: int) -> Optional[str]:
         try:
-            token = await self.gateway.open_connection(
-                self.rhost, self.rport, self.username, self.password
-            )
+            return await self.gateway.open_connection(rhost, rport, self.username, self.password)
         except Exception as e:
-            logger.error(f"Failed to open connection: {e}")
-            writer.close()
-            await writer.wait_closed()
-            return
+            logger.error(f"Failed to open connection to {rhost}:{rport}: {e}")
+            return None
 
+    async def relay(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, token: str):
         conn = Connection(reader, writer, token)
 
         await asyncio.gather(
@@ -89,15 +106,86 @@ class Client:
             self.push(conn),
         )
 
+        logger.debug(f"Tuning stats: {self.gateway.get_tuning_stats().get(token)}")
+        compression = self.gateway.get_compression_stats().get(token)
+        if compression is not None:
+            logger.info(f"Compression stats: {compression}")
         await self.gateway.close(token)
 
+    async def conn_handler(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        addr = writer.get_extra_info("peername")
+        logger.info(f"Connection established: {addr!r}")
+        self.socket_options.apply(writer.get_extra_info("socket"))
+
+        token = await self.open_connection(self.rhost, self.rport)
+        if token is None:
+            writer.close()
+            await writer.wait_closed()
+            return
+
+        await self.relay(reader, writer, token)
+
         logger.info(f"Connection closed: {addr!r}")
 
+    def describe(self) -> str:
+        return f"{self.host}:{self.port} -> {self.rhost}:{self.rport}"
+
+    def warm_up(self):
+        self.gateway.warm_up(self.rhost, self.rport, self.username, self.password)
+
+    def get_stats(self):
+        stats = registry.as_dict()
+        stats["pool"] = self.gateway.get_pool_stats()
+        return stats
+
+    async def stats_handler(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # Answers any request (`curl`, or a line through `nc`) with the Prometheus text format.
+        try:
+            await asyncio.wait_for(reader.readline(), timeout=1)
+        except asyncio.TimeoutError:
+            ...
+        body = registry.render().encode()
+        writer.write(
+            b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            + f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+        )
+        try:
+            await writer.drain()
+        except ConnectionError:
+            ...
+        writer.close()
+
+    async def dump_stats(self):
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            logger.info(f"Stats: {json.dumps(self.get_stats())}")
+
     async def run(self):
-        self.tcp_server = await asyncio.start_server(
-            self.conn_handler, self.host, self.port,
+        self.tcp_server = await start_server(
+            self.conn_handler, self.host, self.port, io=self.io, backlog=self.backlog,
         )
-        logger.info(f"Listening on {self.host}:{self.port} -> {self.rhost}:{self.rport}")
+        logger.info(f"Listening on {self.describe()}")
+        self.warm_up()
 
-        async with self.tcp_server:
-            await self.tcp_server.serve_forever()
+        if self.stats_port:
+            self.stats_server = await asyncio.start_server(
+                self.stats_handler, "127.0.0.1", self.stats_port,
+            )
+            logger.info(f"Stats on 127.0.0.1:{self.stats_port}")
+
+        dump_task = None
+        if self.stats_interval > 0:
+            dump_task = asyncio.ensure_future(self.dump_stats())
+
+        try:
+            async with self.tcp_server:
+                await self.tcp_server.serve_forever()
+        finally:
+            if dump_task is not None:
+                dump_task.cancel()
+            if self.stats_server is not None:
+                self.stats_server.close()
+            logger.debug(f"Session pool stats: {self.gateway.get_pool_stats()}")
+            # Stopped accepting; let buffered pushes reach the server before closing.
+            await self.gateway.drain(self.drain_timeout)
+            await self.gateway.shutdown()
@@ -1,16 +1,25 @@
+from typing import Optional
 import asyncio
-import logging
+import json
+import os
 from pathlib import Path
 
 import typer
 import sentry_sdk
 from aiorun import run
 
+from .bench import run_bench, run_rps_bench, run_io_bench, run_scale_bench, MODES, SERVERS, RPS_ROUTES, IO_SIDES
+from .gateway.buffered import SOCKET_IO
 from .client import Client
 from .config import settings, save_settings
 from .gateway import WebVPNGateway
+from .gateway.retry import RetryPolicy
 from .login import buaa_webvpn_login
+from .proxy import ProxyClient
 from .logger import setup_logger
+from .runtime import SocketOptions, use_uvloop, get_http_parser
+from .shard import run_sharded
+from .simulator import SimulatorConfig, run_simulator
 
 app = typer.Typer()
 
@@ -24,7 +33,46 @@ def login(
     settings.PASSWORD = password
     save_settings()
 
-    asyncio.run(buaa_webvpn_login(username, password))
+    asyncio.run(buaa_webvpn_login(
+        username, password,
+        login_url=settings.LOGIN_URL, submit_url=settings.LOGIN_SUBMIT_URL,
+    ))
+
+
+def create_gateway(prewarm: int = settings.PREWARM) -> WebVPNGateway:
+    return WebVPNGateway(
+        base_url=settings.BASE_URL,
+        require_login=settings.REQUIRE_LOGIN,
+        login_url=settings.LOGIN_URL,
+        submit_url=settings.LOGIN_SUBMIT_URL,
+        pool_size=settings.POOL_SIZE,
+        pool_limit_per_host=settings.POOL_LIMIT_PER_HOST,
+        pool_keepalive_timeout=settings.POOL_KEEPALIVE_TIMEOUT,
+        login_ttl=settings.LOGIN_TTL,
+        pull_window=(settings.PULL_WINDOW_MIN, settings.PULL_WINDOW_MAX),
+        recv_window=settings.RECV_WINDOW,
+        push_inflight=settings.PUSH_INFLIGHT,
+        push_coalesce_delay=settings.PUSH_COALESCE_DELAY,
+        push_stream=settings.PUSH_STREAM,
+        prewarm=prewarm,
+        prewarm_ttl=settings.PREWARM_TTL,
+        mux=settings.MUX,
+        mux_inflight=settings.MUX_INFLIGHT,
+        exchange=settings.EXCHANGE,
+        exchange_hold=settings.EXCHANGE_HOLD,
+        max_body_size=settings.MAX_BODY_SIZE,
+        max_hold=settings.MAX_HOLD,
+        retry=RetryPolicy(
+            base_delay=settings.RETRY_BASE_DELAY,
+            max_delay=settings.RETRY_MAX_DELAY,
+            max_timeout=settings.REQUEST_TIMEOUT,
+            hedge=settings.HEDGE_PULLS,
+            breaker_threshold=settings.BREAKER_THRESHOLD,
+            breaker_reset=settings.BREAKER_RESET,
+        ),
+        resume_timeout=settings.RESUME_TIMEOUT if settings.RESUME else None,
+        compression=settings.COMPRESSION,
+    )
 
 
 @app.command()
@@ -33,7 +81,14 @@ def forward(
     port: int = settings.PORT,
     rhost: str = settings.RHOST,
     rport: int = settings.RPORT,
+    loop: str = settings.LOOP,
+    io: str = settings.SOCKET_IO,
+    backlog: int = settings.BACKLOG,
+    drain_timeout: float = settings.DRAIN_TIMEOUT,
 ):
+    if io not in SOCKET_IO:
+        typer.echo(f"Unknown socket I/O: {io}")
+        raise typer.Exit(1)
     if not settings.USERNAME or not settings.PASSWORD:
         typer.echo(
             "Please login first by `webvpn login`"
@@ -47,23 +102,272 @@ def forward(
         rport=rport,
         username=settings.USERNAME,
         password=settings.PASSWORD,
-        gateway=WebVPNGateway()
+        stats_port=settings.STATS_PORT,
+        stats_interval=settings.STATS_INTERVAL,
+        backlog=backlog,
+        socket_options=SocketOptions(settings.TCP_NODELAY, settings.SO_SNDBUF, settings.SO_RCVBUF),
+        drain_timeout=drain_timeout,
+        io=io,
+        gateway=create_gateway(),
     )
-    run(client.run(), stop_on_unhandled_errors=True)
+    run(client.run(), stop_on_unhandled_errors=True, use_uvloop=use_uvloop(loop))
 
 
 @app.command()
-def serve():
-    logger = logging.getLogger(__name__)
-    logger.info("Not implemented yet.")
+def proxy(
+    host: str = settings.PROXY_HOST,
+    port: int = settings.PROXY_PORT,
+    loop: str = settings.LOOP,
+    io: str = settings.SOCKET_IO,
+    backlog: int = settings.BACKLOG,
+    drain_timeout: float = settings.DRAIN_TIMEOUT,
+):
+    if io not in SOCKET_IO:
+        typer.echo(f"Unknown socket I/O: {io}")
+        raise typer.Exit(1)
+    if not settings.USERNAME or not settings.PASSWORD:
+        typer.echo(
+            "Please login first by `webvpn login`"
+        )
+        return
 
+    client = ProxyClient(
+        host=host,
+        port=port,
+        username=settings.USERNAME,
+        password=settings.PASSWORD,
+        stats_port=settings.STATS_PORT,
+        stats_interval=settings.STATS_INTERVAL,
+        backlog=backlog,
+        socket_options=SocketOptions(settings.TCP_NODELAY, settings.SO_SNDBUF, settings.SO_RCVBUF),
+        drain_timeout=drain_timeout,
+        io=io,
+        handshake_timeout=settings.PROXY_HANDSHAKE_TIMEOUT,
+        # Destinations vary per request: pre-warming each would hold tokens for hosts
+        # visited once.
+        gateway=create_gateway(prewarm=0),
+    )
+    run(client.run(), stop_on_unhandled_errors=True, use_uvloop=use_uvloop(loop))
 
-@app.callback()
-def main(verbose: bool = False):
-    sentry_sdk.init(
-        "https://6e41d074f65e4d5c85ac42611a08fe94@o246548.ingest.sentry.io/6464187",
-        traces_sample_rate=0.5
+
+@app.command()
+def serve(
+    host: str = settings.SERVER_HOST,
+    port: int = settings.SERVER_PORT,
+    workers: int = settings.WORKERS,
+    loop: str = settings.LOOP,
+    http: str = settings.HTTP,
+    io: str = settings.SOCKET_IO,
+    backlog: int = settings.BACKLOG,
+    drain_timeout: float = settings.DRAIN_TIMEOUT,
+):
+    if io not in SOCKET_IO:
+        typer.echo(f"Unknown socket I/O: {io}")
+        raise typer.Exit(1)
+    try:
+        import uvicorn
+    except ImportError:
+        typer.echo("The server needs its dependencies: pip install 'webvpn[server]'")
+        raise typer.Exit(1)
+
+    # Workers re-read their settings; the environment carries the override to them.
+    os.environ["WEBVPN_DRAIN_TIMEOUT"] = str(drain_timeout)
+    os.environ["WEBVPN_SOCKET_IO"] = io
+    settings.set("DRAIN_TIMEOUT", drain_timeout)
+    settings.set("SOCKET_IO", io)
+    options = dict(
+        loop="uvloop" if use_uvloop(loop) else "asyncio",
+        http=get_http_parser(http),
+        backlog=backlog,
+        # Long-polls in flight finish within their hold; then the gateway drains.
+        timeout_graceful_shutdown=drain_timeout,
+        log_level="info",
+    )
+    if workers > 1:
+        run_sharded(host, port, workers, options)
+    else:
+        uvicorn.run("webvpn.server:app", host=host, port=port, **options)
+
+
+@app.command()
+def simulate(
+    host: str = "127.0.0.1",
+    port: int = settings.SIMULATOR_PORT,
+    upstream: str = settings.SIMULATOR_UPSTREAM,
+    latency: float = 0.03,
+    jitter: float = 0.01,
+    drop_rate: float = 0.0,
+    error_rate: float = 0.0,
+    session_ttl: float = 600.0,
+    redirect_rate: float = 0.0,
+    max_body_size: int = 4 * 1024 * 1024,
+    rate_limit: float = 0.0,
+    rate_burst: int = 100,
+    proxy_timeout: float = 60.0,
+    seed: Optional[int] = None,
+):
+    config = SimulatorConfig(
+        upstream=upstream,
+        latency=latency,
+        jitter=jitter,
+        drop_rate=drop_rate,
+        error_rate=error_rate,
+        session_ttl=session_ttl,
+        redirect_rate=redirect_rate,
+        max_body_size=max_body_size,
+        rate_limit=rate_limit,
+        rate_burst=rate_burst,
+        proxy_timeout=proxy_timeout,
+        seed=seed,
     )
+    run(run_simulator(config, host, port), stop_on_unhandled_errors=True)
+
+
+# Shared by the bench commands.
+OUTPUT = typer.Option(None, help="Write the results as JSON to a file instead of stdout.")
+
+
+def write_results(results, output: Optional[Path]):
+    data = json.dumps(results, indent=2)
+    if output is None:
+        typer.echo(data)
+    else:
+        output.write_text(data)
+
+
+@app.command()
+def bench(
+    modes: str = "plain,mux,exchange",
+    chunk_sizes: str = "1024,65536,1048576",
+    tunnels: str = "1,10,100,500",
+    rounds: int = 20,
+    total_size: int = 16 * 1024 * 1024,
+    server_port: Optional[int] = typer.Option(None, help="Use a server that is already running."),
+    simulator_port: Optional[int] = typer.Option(
+        None, help="Go through a running `webvpn simulate` (whose upstream is --server-port)."
+    ),
+    io: str = settings.SOCKET_IO,
+    output: Optional[Path] = OUTPUT,
+):
+    mode_list = modes.split(",")
+    for mode in mode_list:
+        if mode not in MODES:
+            typer.echo(f"Unknown mode: {mode}")
+            raise typer.Exit(1)
+
+    results = asyncio.run(run_bench(
+        modes=mode_list,
+        chunk_sizes=[int(size) for size in chunk_sizes.split(",")],
+        tunnels=[int(n) for n in tunnels.split(",")],
+        rounds=rounds,
+        total_size=total_size,
+        server_port=server_port,
+        simulator_port=simulator_port,
+        io=io,
+    ))
+
+    write_results(results, output)
+
+
+@app.command()
+def bench_rps(
+    servers: str = "fastapi,fastpath",
+    routes: str = "push,pull,keep-alive",
+    concurrency: str = "1,16,64",
+    duration: float = 5.0,
+    payload_size: int = 64,
+    workers: str = typer.Option("1", help="Worker counts to compare, e.g. 1,4 (see `serve --workers`)."),
+    output: Optional[Path] = OUTPUT,
+):
+    server_list = servers.split(",")
+    route_list = routes.split(",")
+    for server in server_list:
+        if server not in SERVERS:
+            typer.echo(f"Unknown server: {server}")
+            raise typer.Exit(1)
+    for route in route_list:
+        if route not in RPS_ROUTES:
+            typer.echo(f"Unknown route: {route}")
+            raise typer.Exit(1)
+
+    results = asyncio.run(run_rps_bench(
+        servers=server_list,
+        routes=route_list,
+        concurrency=[int(n) for n in concurrency.split(",")],
+        duration=duration,
+        payload_size=payload_size,
+        workers=[int(n) for n in workers.split(",")],
+    ))
+
+    write_results(results, output)
+
+
+@app.command()
+def bench_io(
+    ios: str = "stream,buffered",
+    sides: str = "connect,listen",
+    read_sizes: str = "65536,262144",
+    total_size: int = 256 * 1024 * 1024,
+    output: Optional[Path] = OUTPUT,
+):
+    io_list = ios.split(",")
+    side_list = sides.split(",")
+    for io in io_list:
+        if io not in SOCKET_IO:
+            typer.echo(f"Unknown socket I/O: {io}")
+            raise typer.Exit(1)
+    for side in side_list:
+        if side not in IO_SIDES:
+            typer.echo(f"Unknown side: {side}")
+            raise typer.Exit(1)
+
+    results = asyncio.run(run_io_bench(
+        ios=io_list,
+        sides=side_list,
+        read_sizes=[int(size) for size in read_sizes.split(",")],
+        total_size=total_size,
+    ))
+
+    write_results(results, output)
+
+
+@app.command()
+def bench_scale(
+    idle: int = 10000,
+    active: int = 1000,
+    duration: float = 10.0,
+    payload_size: int = 64,
+    lazy: bool = typer.Option(False, help="Issue the idle tokens lazily."),
+    io: str = settings.SOCKET_IO,
+    output: Optional[Path] = OUTPUT,
+):
+    if io not in SOCKET_IO:
+        typer.echo(f"Unknown socket I/O: {io}")
+        raise typer.Exit(1)
+
+    results = asyncio.run(run_scale_bench(
+        idle=idle,
+        active=active,
+        duration=duration,
+        payload_size=payload_size,
+        lazy=lazy,
+        io=io,
+    ))
+
+    write_results(results, output)
+
+
+# Local runs with nothing to report.
+OFFLINE_COMMANDS = ("bench", "bench-rps", "bench-io", "bench-scale", "simulate")
+
+
+@app.callback()
+def main(ctx: typer.Context, verbose: bool = False):
+    if settings.SENTRY and ctx.invoked_subcommand not in OFFLINE_COMMANDS:
+        sentry_sdk.init(
+            "https://6e41d074f65e4d5c85ac42611a08fe94@o246548.ingest.sentry.io/6464187",
+            traces_sample_rate=0.5
+        )
     setup_logger(verbose)
 
 
@@ -0,0 +1,405 @@
+from typing import Optional, AsyncIterator, Awaitable, Dict, List, Tuple, Mapping, Union
+from urllib.parse import parse_qsl
+import asyncio
+import json
+import logging
+
+from .gateway import TCPGateway, InvalidToken
+from .gateway.metrics import registry
+from .gateway.mux import Frame, FrameType, decode_frames, encode_frames, handle_frames
+from .shard import ShardRouter
+
+logger = logging.getLogger(__name__)
+
+# (status, headers, body)
+Result = Tuple[int, Dict[str, str], bytes]
+
+OCTET_STREAM = "application/octet-stream"
+JSON = "application/json"
+
+# Status codes travel in X-Code; the JSON bodies are constants kept for older clients.
+CODE_OK = 0
+CODE_CLOSED = 2000
+BODIES = {
+    ("push", CODE_OK): b'{"code":0}',
+    ("push", CODE_CLOSED): b'{"code":2000,"message":"Connection closed (push)"}',
+    ("keep_alive", CODE_OK): b'{"code":0}',
+    ("keep_alive", CODE_CLOSED): b'{"code":2000,"message":"Connection closed (keep_alive)"}',
+    ("resume", CODE_CLOSED): b'{"code":2000,"message":"Connection closed (resume)"}',
+    ("close", CODE_OK): b'{"code":0}',
+}
+
+ROUTES = ("token", "keep_alive", "pull", "push", "exchange", "mux", "resume", "close")
+REQUESTS = {
+    route: registry.counter("webvpn_http_requests_total", "Requests served per route", route=route)
+    for route in ROUTES
+}
+
+
+class ClientDisconnected(Exception):
+    ...
+
+
+def status(code: int) -> Result:
+    return code, {}, b""
+
+
+def coded(route: str, code: int, headers: Optional[Dict[str, str]] = None) -> Result:
+    headers = dict(headers or {})
+    headers["X-Code"] = str(code)
+    headers["Content-Type"] = JSON
+    return 200, headers, BODIES[route, code]
+
+
+class DataPlane:
+    def __init__(
+        self,
+        gateway: TCPGateway,
+        router: ShardRouter,
+        *,
+        pull_hold: float = 2.0,
+        pull_max_hold: float = 10.0,
+    ):
+        self.gateway = gateway
+        self.router = router
+        self.pull_hold = pull_hold
+        self.pull_max_hold = pull_max_hold
+
+    def get_hold(self, hold: Optional[float]) -> float:
+        if hold is None:
+            hold = self.pull_hold
+        return min(max(hold, 0), self.pull_max_hold)
+
+    async def _forward(
+        self,
+        token: str,
+        method: str,
+        path: str,
+        params: Dict[str, object],
+        body: Union[bytes, AsyncIterator[bytes]] = b"",
+    ) -> Optional[Result]:
+        # Requests for tokens owned by another shard are passed on as they are.
+        shard = self.router.owner(token)
+        if shard == self.router.shard:
+            return None
+        params = {k: str(v) for k, v in params.items() if v is not None}
+        return await self.router.forward(shard, method, path, params, body)
+
+    async def keep_alive(self, token: str) -> Result:
+        forwarded = await self._forward(token, "GET", "/keep-alive", {"token": token})
+        if forwarded is not None:
+            return forwarded
+
+        REQUESTS["keep_alive"].inc()
+        try:
+            if await self.gateway.keep_alive(token):
+                logger.debug(f"keep-alive: {self.gateway.get_username(token)}:{token}")
+                return coded("keep_alive", CODE_OK)
+            else:
+                return coded("keep_alive", CODE_CLOSED)
+        except InvalidToken:
+            return status(400)
+
+    async def close(self, token: str) -> Result:
+        # The client is done with the tunnel: nothing is kept for it to resume.
+        forwarded = await self._forward(token, "GET", "/close", {"token": token})
+        if forwarded is not None:
+            return forwarded
+
+        REQUESTS["close"].inc()
+        username = self.gateway.get_username(token)
+        if username is None:
+            return status(400)
+        await self.gateway.close(token)
+        logger.info(f"connection closed by client: {username}:{token}")
+        return coded("close", CODE_OK)
+
+    async def resume(self, token: str, ack: int) -> Result:
+        forwarded = await self._forward(token, "GET", "/resume", {"token": token, "ack": ack})
+        if forwarded is not None:
+            return forwarded
+
+        REQUESTS["resume"].inc()
+        try:
+            push_seq = await self.gateway.resume(token, ack)
+        except InvalidToken:
+            return status(400)
+
+        if push_seq is None:
+            return coded("resume", CODE_CLOSED)
+        logger.info(f"resume from {ack}: {self.gateway.get_username(token)}:{token}")
+        body = json.dumps({"code": CODE_OK, "data": {"push_seq": push_seq}}).encode()
+        return 200, {"X-Code": str(CODE_OK), "Content-Type": JSON}, body
+
+    async def pull(
+        self,
+        token: str,
+        n: int = 1024,
+        seq: Optional[int] = None,
+        hold: Optional[float] = None,
+        ack: Optional[int] = None,
+    ) -> Result:
+        forwarded = await self._forward(
+            token, "GET", "/pull", {"token": token, "n": n, "seq": seq, "hold": hold, "ack": ack}
+        )
+        if forwarded is not None:
+            return forwarded
+
+        REQUESTS["pull"].inc()
+        headers = {"Content-Type": OCTET_STREAM}
+        try:
+            if seq is None:
+                # Held inside the tunnel: no task or wait_for wrapper per pull.
+                data = await self.gateway.pull(token, n, self.get_hold(hold))
+                if data is None:
+                    return status(503)      # Connection closed
+            else:
+                chunk = await self.gateway.pull_chunk(token, seq, n, self.get_hold(hold), ack)
+                if chunk is None:
+                    return status(503)      # Connection closed
+                if chunk.data:
+                    headers["X-Seq"] = str(chunk.seq)
+                headers["X-Buffered"] = str(self.gateway.get_buffered(token))
+                data = chunk.data
+        except InvalidToken:
+            return status(400)
+
+        if len(data) > 0:
+            logger.debug(f"pull {len(data)} bytes: {self.gateway.get_username(token)}:{token}")
+        return 200, headers, data
+
+    async def push(self, token: str, chunks: AsyncIterator[bytes], seq: Optional[int] = None) -> Result:
+        # The body is consumed as it arrives, never held whole (see TCPConnection.push_stream).
+        forwarded = await self._forward(token, "POST", "/push", {"token": token, "seq": seq}, chunks)
+        if forwarded is not None:
+            return forwarded
+
+        REQUESTS["push"].inc()
+        try:
+            if await self.gateway.push_stream(token, chunks, seq):
+                logger.debug(f"push: {self.gateway.get_username(token)}:{token}")
+                headers = {"X-Window": str(self.gateway.get_send_window(token))}
+                return coded("push", CODE_OK, headers)
+            else:
+                return coded("push", CODE_CLOSED)
+        except InvalidToken:
+            return status(400)
+
+    async def exchange(
+        self,
+        token: str,
+        pseq: int,
+        data: bytes,
+        seq: Optional[int] = None,
+        n: int = 1024,
+        hold: float = 0.1,
+        ack: Optional[int] = None,
+    ) -> Result:
+        forwarded = await self._forward(
+            token, "POST", "/exchange",
+            {"token": token, "pseq": pseq, "seq": seq, "n": n, "hold": hold, "ack": ack}, data,
+        )
+        if forwarded is not None:
+            return forwarded
+
+        REQUESTS["exchange"].inc()
+        try:
+            if seq is not None:
+                if not await self.gateway.push(token, data, seq):
+                    return status(503)      # Connection closed
+                if len(data) > 0:
+                    logger.debug(f"push {len(data)} bytes: {self.gateway.get_username(token)}:{token}")
+
+            self.gateway.supersede(token)
+            chunk = await self.gateway.pull_chunk(token, pseq, n, self.get_hold(hold), ack)
+        except InvalidToken:
+            return status(400)
+
+        if chunk is None:
+            return status(503)      # Connection closed
+
+        headers = {
+            "Content-Type": OCTET_STREAM,
+            "X-Window": str(self.gateway.get_send_window(token)),
+            "X-Buffered": str(self.gateway.get_buffered(token)),
+        }
+        if chunk.data:
+            headers["X-Seq"] = str(chunk.seq)
+            logger.debug(f"pull {len(chunk.data)} bytes: {self.gateway.get_username(token)}:{token}")
+        return 200, headers, chunk.data
+
+    async def mux(self, data: bytes, hold: Optional[float] = None) -> Result:
+        REQUESTS["mux"].inc()
+        try:
+            frames = decode_frames(data)
+        except Exception:
+            return status(400)
+
+        if self.router.shards > 1:
+            responses = await self._handle_sharded_frames(frames, self.get_hold(hold))
+        else:
+            responses = await handle_frames(self.gateway, frames, self.get_hold(hold))
+        return 200, {"Content-Type": OCTET_STREAM}, encode_frames(responses)
+
+    def release(self, tokens: List[str]):
+        for token in tokens:
+            if self.router.is_local(token):
+                self.gateway.supersede(token)
+
+    async def _release(self, shard: int, tokens: List[str]):
+        # Parked pulls return early without losing data (see TCPConnection.supersede).
+        if shard == self.router.shard:
+            self.release(tokens)
+        else:
+            await self.router.forward(shard, "POST", "/shard/release", {}, "\n".join(tokens).encode())
+
+    async def _handle_sharded_frames(self, frames: List[Frame], hold: float) -> List[Frame]:
+        groups: Dict[int, List[int]] = {}
+        for i, frame in enumerate(frames):
+            groups.setdefault(self.router.owner(frame.token), []).append(i)
+
+        async def run(shard: int, batch: List[Frame]) -> List[Frame]:
+            if shard == self.router.shard:
+                return await handle_frames(self.gateway, batch, hold)
+            code, _, body = await self.router.forward(
+                shard, "POST", "/mux", {"hold": str(hold)}, encode_frames(batch)
+            )
+            if code != 200:
+                return [Frame(FrameType.CLOSED, frame.token, frame.rid) for frame in batch]
+            return decode_frames(body)
+
+        tasks = {
+            asyncio.ensure_future(run(shard, [frames[i] for i in indexes])): shard
+            for shard, indexes in groups.items()
+        }
+        # Like a single shard, answer as soon as one part of the batch is answered.
+        _, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        if pending:
+            await asyncio.gather(*[
+                self._release(tasks[task], [frames[i].token for i in groups[tasks[task]]])
+                for task in pending
+            ])
+            await asyncio.wait(pending)
+
+        responses: List[Optional[Frame]] = [None] * len(frames)
+        for task, shard in tasks.items():
+            for i, response in zip(groups[shard], task.result()):
+                responses[i] = response
+        return responses
+
+
+def get_int(params: Mapping[str, str], name: str, default: Optional[int] = None) -> Optional[int]:
+    value = params.get(name)
+    return default if value is None else int(value)
+
+
+def get_float(params: Mapping[str, str], name: str, default: Optional[float] = None) -> Optional[float]:
+    value = params.get(name)
+    return default if value is None else float(value)
+
+
+class FastPath:
+    # Serves the data-plane routes straight from ASGI: no routing tables, dependency
+    # injection or response models. Everything else falls through to `app`. Requests
+    # forwarded by other shards come in through `serve_forwarded`, with or without
+    # FAST_PATH.
+    def __init__(self, app, plane: DataPlane):
+        self.app = app
+        self.plane = plane
+        self.routes = {
+            ("GET", "/pull"): self._pull,
+            ("GET", "/keep-alive"): self._keep_alive,
+            ("GET", "/resume"): self._resume,
+            ("GET", "/close"): self._close,
+            ("POST", "/push"): self._push,
+            ("POST", "/exchange"): self._exchange,
+            ("POST", "/mux"): self._mux,
+        }
+
+    async def __call__(self, scope, receive, send):
+        handler = None
+        if scope["type"] == "http":
+            handler = self.routes.get((scope["method"], scope["path"]))
+        if handler is None:
+            return await self.app(scope, receive, send)
+
+        params = dict(parse_qsl(scope["query_string"].decode("latin-1")))
+        try:
+            code, headers, body = await self.handle(handler, params, self._stream_body(receive))
+        except ClientDisconnected:
+            return
+
+        raw_headers = [(b"content-length", str(len(body)).encode())]
+        raw_headers += [(k.lower().encode(), v.encode()) for k, v in headers.items()]
+        await send({"type": "http.response.start", "status": code, "headers": raw_headers})
+        await send({"type": "http.response.body", "body": body})
+
+    async def handle(self, handler, params: Dict[str, str], chunks: AsyncIterator[bytes]) -> Result:
+        try:
+            # Parameters are parsed before anything runs; errors past that are not the client's.
+            call = handler(params, chunks)
+        except (KeyError, ValueError):
+            return status(422)   # missing or malformed parameter
+        return await call
+
+    async def serve_forwarded(
+        self, method: str, path: str, params: Dict[str, str], chunks: AsyncIterator[bytes]
+    ) -> Result:
+        if (method, path) == ("POST", "/shard/release"):
+            self.plane.release((await self._read_body(chunks)).decode().split("\n"))
+            return status(200)
+        handler = self.routes.get((method, path))
+        if handler is None:
+            return status(404)
+        return await self.handle(handler, params, chunks)
+
+    async def _stream_body(self, receive) -> AsyncIterator[bytes]:
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                raise ClientDisconnected()
+            more_body = message.get("more_body", False)
+            if message.get("body"):
+                yield message["body"]
+
+    async def _read_body(self, chunks: AsyncIterator[bytes]) -> bytes:
+        data = [chunk async for chunk in chunks]
+        return data[0] if len(data) == 1 else b"".join(data)
+
+    # Route handlers parse their parameters and return the call to await; `chunks` is
+    # the request body.
+    def _pull(self, params, chunks) -> Awaitable[Result]:
+        return self.plane.pull(
+            params["token"], get_int(params, "n", 1024), get_int(params, "seq"), get_float(params, "hold"),
+            get_int(params, "ack"),
+        )
+
+    def _keep_alive(self, params, chunks) -> Awaitable[Result]:
+        return self.plane.keep_alive(params["token"])
+
+    def _resume(self, params, chunks) -> Awaitable[Result]:
+        return self.plane.resume(params["token"], int(params["ack"]))
+
+    def _close(self, params, chunks) -> Awaitable[Result]:
+        return self.plane.close(params["token"])
+
+    def _push(self, params, chunks) -> Awaitable[Result]:
+        token, seq = params["token"], get_int(params, "seq")
+        return self.plane.push(token, chunks, seq)
+
+    def _exchange(self, params, chunks) -> Awaitable[Result]:
+        token, pseq = params["token"], int(params["pseq"])
+        seq, n, hold = get_int(params, "seq"), get_int(params, "n", 1024), get_float(params, "hold", 0.1)
+        ack = get_int(params, "ack")
+
+        async def call() -> Result:
+            return await self.plane.exchange(token, pseq, await self._read_body(chunks), seq, n, hold, ack)
+        return call()
+
+    def _mux(self, params, chunks) -> Awaitable[Result]:
+        hold = get_float(params, "hold")
+
+        async def call() -> Result:
+            return await self.plane.mux(await self._read_body(chunks), hold)
+        return call()
@@ -1,3 +1,3 @@
-from .gateway import Gateway, InvalidToken, ConnectionClosedError
+from .gateway import Gateway, Chunk, InvalidToken, ConnectionClosedError
 from .tcp import TCPGateway
 from .webvpn import WebVPNGateway
@@ -0,0 +1,120 @@
+from typing import Optional
+import asyncio
+import logging
+import time
+
+from webvpn.login import (
+    buaa_webvpn_login, load_cookie_jar, get_cookie_jar_path, LOGIN_URL_1, LOGIN_URL_2
+)
+from .metrics import registry
+from .pool import SessionPool
+
+logger = logging.getLogger(__name__)
+
+LOGINS = registry.counter("webvpn_logins_total", "SSO logins performed")
+LOGIN_FAILURES = registry.counter("webvpn_login_failures_total", "SSO logins that failed")
+LOGINS_COALESCED = registry.counter("webvpn_logins_coalesced_total", "Logins that joined one in flight")
+LOGIN_TIME = registry.histogram("webvpn_login_seconds", "Duration of SSO logins")
+
+
+class Credentials:
+    def __init__(
+        self,
+        username: str,
+        password: str,
+        pool: SessionPool,
+        *,
+        ttl: float = 1800.0,
+        login_url: str = LOGIN_URL_1,
+        submit_url: str = LOGIN_URL_2,
+    ):
+        self.username = username
+        self.password = password
+        self.pool = pool
+        self.ttl = ttl
+        self.login_url = login_url
+        self.submit_url = submit_url
+
+        # Bumped after every successful login so that tunnels which saw a 302 with
+        # an older cookie can tell whether somebody already re-authenticated.
+        self.generation = 0
+        self.valid_until = 0.0
+
+        self.logins = 0
+        self.coalesced = 0
+
+        self._loading: Optional[asyncio.Future] = None
+        self._inflight: Optional[asyncio.Future] = None
+
+    @property
+    def valid(self) -> bool:
+        return time.monotonic() < self.valid_until
+
+    def invalidate(self):
+        self.valid_until = 0.0
+
+    async def ensure(self) -> bool:
+        # The saved cookies are loaded once; callers meanwhile wait for them rather
+        # than log in themselves.
+        if self._loading is None:
+            self._loading = asyncio.ensure_future(self._load())
+        await asyncio.shield(self._loading)
+
+        if self.valid:
+            return True
+        return await self.login()
+
+    async def _load(self):
+        cookie_jar = self.pool.create_cookie_jar()
+        try:
+            if not await load_cookie_jar(cookie_jar, self.login_url, self.username):
+                return
+            age = time.time() - get_cookie_jar_path(self.login_url, self.username).stat().st_mtime
+        except Exception as e:
+            logger.warning(f"Failed to load cookie: {e}")
+            return
+
+        self.pool.set_cookie_jar(cookie_jar)
+        if age < self.ttl:
+            self.valid_until = time.monotonic() + self.ttl - age
+            logger.debug("Cookie loaded.")
+
+    async def refresh(self, generation: int) -> bool:
+        # Called after a 302: only log in again if nobody did since `generation`.
+        if generation != self.generation and self.valid:
+            return True
+
+        self.invalidate()
+        return await self.login()
+
+    async def login(self) -> bool:
+        if self._inflight is None:
+            self._inflight = asyncio.ensure_future(self._login())
+        else:
+            self.coalesced += 1
+            LOGINS_COALESCED.inc()
+
+        return await asyncio.shield(self._inflight)
+
+    async def _login(self) -> bool:
+        started_at = time.monotonic()
+        try:
+            self.logins += 1
+            LOGINS.inc()
+            ok = await buaa_webvpn_login(
+                self.username, self.password, self.pool.session,
+                login_url=self.login_url, submit_url=self.submit_url,
+            )
+            if ok:
+                self.generation += 1
+                self.valid_until = time.monotonic() + self.ttl
+            else:
+                LOGIN_FAILURES.inc()
+            return ok
+        except Exception as e:
+            logger.error(f"Failed to login: {e}")
+            LOGIN_FAILURES.inc()
+            return False
+        finally:
+            LOGIN_TIME.observe(time.monotonic() - started_at)
+            self._inflight = None
@@ -0,0 +1,111 @@
+from typing import Optional, List, Deque, Union
+from collections import deque
+import asyncio
+
+
+class RecvBuffer:
+    __slots__ = ("high", "low", "size", "eof", "_chunks", "_offset", "_waiters", "_paused", "_resumed")
+
+    def __init__(self, high: int = 4 * 1024 * 1024, low: int = 1024 * 1024):
+        self.high = high
+        self.low = min(low, high)
+
+        self.size = 0
+        self.eof = False
+
+        # Chunks are kept as received; reads slice them with memoryviews and only
+        # join when a response spans several chunks. The deque is made on first feed.
+        self._chunks: Optional[Deque[bytes]] = None
+        self._offset = 0
+        self._waiters: List[asyncio.Future] = []
+        # Past the high watermark until back under the low one; a future rather than
+        # an Event, which would cost every idle tunnel a deque of its own.
+        self._paused = False
+        self._resumed: Optional[asyncio.Future] = None
+
+    @property
+    def ready(self) -> bool:
+        return self.size > 0 or self.eof
+
+    @property
+    def writable(self) -> bool:
+        return not self._paused
+
+    def _set_writable(self):
+        self._paused = False
+        if self._resumed is not None and not self._resumed.done():
+            self._resumed.set_result(None)
+
+    def feed(self, data: bytes):
+        if not data:
+            return
+
+        if self._chunks is None:
+            self._chunks = deque()
+        self._chunks.append(data)
+        self.size += len(data)
+        if self.size >= self.high:
+            self._paused = True
+        self.wake_one()
+
+    def feed_eof(self):
+        self.eof = True
+        self._set_writable()
+        self.wake_all()
+
+    def add_waiter(self, waiter: asyncio.Future):
+        self._waiters.append(waiter)
+
+    def remove_waiter(self, waiter: asyncio.Future):
+        if waiter in self._waiters:
+            self._waiters.remove(waiter)
+
+    def wake_one(self):
+        # Readers are woken one at a time so parked pulls don't race for the same bytes.
+        while self._waiters:
+            waiter = self._waiters.pop(0)
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+    def wake_all(self):
+        for waiter in self._waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self._waiters.clear()
+
+    async def wait_writable(self):
+        while self._paused:
+            self._resumed = asyncio.get_running_loop().create_future()
+            try:
+                await self._resumed
+            finally:
+                self._resumed = None
+
+    def read(self, n: int) -> bytes:
+        pieces: List[Union[bytes, memoryview]] = []
+        remaining = n
+        while self._chunks and remaining > 0:
+            chunk = self._chunks[0]
+            available = len(chunk) - self._offset
+            if available <= remaining:
+                pieces.append(chunk if self._offset == 0 else memoryview(chunk)[self._offset:])
+                self._chunks.popleft()
+                self._offset = 0
+                remaining -= available
+            else:
+                pieces.append(memoryview(chunk)[self._offset:self._offset + remaining])
+                self._offset += remaining
+                remaining = 0
+
+        if len(pieces) == 1 and isinstance(pieces[0], bytes):
+            data = pieces[0]
+        else:
+            data = b"".join(pieces)
+
+        self.size -= len(data)
+        if self.size <= self.low:
+            self._set_writable()
+        if self.size > 0:
+            self.wake_one()
+        return data
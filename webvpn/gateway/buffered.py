@@ -0,0 +1,242 @@
+from typing import Optional, Awaitable, Callable, Deque, List, Set, Tuple, Union
+from collections import deque
+import asyncio
+import logging
+
+from .metrics import registry
+
+logger = logging.getLogger(__name__)
+
+SOCKET_IO = ("stream", "buffered")
+
+BLOCK_SIZE = 256 * 1024
+MIN_FREE = 16 * 1024        # a block with less room left is retired for a fresh one
+
+ALLOCATED = registry.counter("webvpn_buffer_blocks_allocated_total", "Receive blocks allocated")
+REUSED = registry.counter("webvpn_buffer_blocks_reused_total", "Receive blocks taken back from the pool")
+
+
+def is_exported(block: bytearray) -> bool:
+    # CPython refuses to resize a bytearray while any memoryview into it is alive.
+    # Shrinking by one and growing back stays within the allocation: no copy.
+    try:
+        last = block.pop()
+    except BufferError:
+        return True
+    block.append(last)
+    return False
+
+
+class BufferPool:
+    # Blocks are filled front to back by consecutive reads and handed out as
+    # memoryviews. A retired block is reused once every view into it is gone, so
+    # consumers never have to give anything back explicitly.
+    def __init__(self, block_size: int = BLOCK_SIZE, max_retired: int = 64, max_probe: int = 4):
+        self.block_size = block_size
+        self.max_retired = max_retired
+        self.max_probe = max_probe
+        self._retired: Deque[bytearray] = deque()
+
+    def acquire(self) -> bytearray:
+        # The oldest blocks are the likeliest to be free; don't scan far for one.
+        for _ in range(min(self.max_probe, len(self._retired))):
+            block = self._retired.popleft()
+            if not is_exported(block):
+                REUSED.inc()
+                return block
+            self._retired.append(block)
+
+        ALLOCATED.inc()
+        return bytearray(self.block_size)
+
+    def retire(self, block: bytearray):
+        if len(self._retired) < self.max_retired:
+            self._retired.append(block)
+
+
+default_pool = BufferPool()
+
+Handler = Callable[["BufferedStream", "BufferedStream"], Awaitable[None]]
+
+
+class BufferedStream(asyncio.BufferedProtocol):
+    # Both halves of a connection: the read side of StreamReader and the write side
+    # of StreamWriter, as far as Client and TCPConnection use them. read() returns
+    # memoryviews into pooled blocks instead of fresh bytes.
+    def __init__(
+        self, pool: BufferPool = default_pool, handler: Optional[Handler] = None, limit: int = BLOCK_SIZE
+    ):
+        self.pool = pool
+        self.handler = handler
+        self.limit = limit
+        self.transport: Optional[asyncio.Transport] = None
+
+        # Taken from the pool on the first read, so connections that never receive
+        # (idle tunnels) hold no block.
+        self._block: Optional[bytearray] = None
+        self._pos = 0
+        # (view of the block, start, end) of received bytes. The view keeps the block
+        # out of the pool until the bytes have been read and let go of. Made on first receive.
+        self._segments: Optional[Deque[Tuple[memoryview, int, int]]] = None
+        self._size = 0
+        self._eof = False
+        self._exception: Optional[BaseException] = None
+        self._paused = False
+        self._read_waiter: Optional[asyncio.Future] = None
+
+        self._write_paused = False
+        self._drain_waiters: List[asyncio.Future] = []
+        self._closed: Optional[asyncio.Future] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+        self._closed = asyncio.get_running_loop().create_future()
+        if self.handler is not None:
+            task = asyncio.ensure_future(self.handler(self, self))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        if self._block is None or len(self._block) - self._pos < MIN_FREE:
+            if self._block is not None:
+                self.pool.retire(self._block)
+            self._block = self.pool.acquire()
+            self._pos = 0
+        return memoryview(self._block)[self._pos:]
+
+    def buffer_updated(self, nbytes: int):
+        start, end = self._pos, self._pos + nbytes
+        self._pos = end
+        if self._segments is None:
+            self._segments = deque()
+        if self._segments and self._segments[-1][0].obj is self._block and self._segments[-1][2] == start:
+            view, first, _ = self._segments.pop()
+            self._segments.append((view, first, end))
+        else:
+            self._segments.append((memoryview(self._block), start, end))
+        self._size += nbytes
+
+        if self._size >= self.limit and not self._paused:
+            self._paused = True
+            self.transport.pause_reading()
+        self._wakeup()
+
+    def eof_received(self) -> bool:
+        self._eof = True
+        self._wakeup()
+        return False
+
+    def connection_lost(self, exc: Optional[Exception]):
+        if self._block is not None:
+            self.pool.retire(self._block)
+        self._eof = True
+        if exc is not None:
+            self._exception = exc
+        self._wakeup()
+        for waiter in self._drain_waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self._drain_waiters.clear()
+        if self._closed is not None and not self._closed.done():
+            self._closed.set_result(None)
+
+    def pause_writing(self):
+        self._write_paused = True
+
+    def resume_writing(self):
+        self._write_paused = False
+        for waiter in self._drain_waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self._drain_waiters.clear()
+
+    def _wakeup(self):
+        if self._read_waiter is not None and not self._read_waiter.done():
+            self._read_waiter.set_result(None)
+
+    async def read(self, n: int = -1) -> Union[bytes, memoryview]:
+        while not self._segments:
+            if self._exception is not None:
+                raise self._exception
+            if self._eof:
+                return b""
+            self._read_waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self._read_waiter
+            finally:
+                self._read_waiter = None
+
+        view, start, end = self._segments[0]
+        if 0 <= n < end - start:
+            self._segments[0] = (view, start + n, end)
+            end = start + n
+        else:
+            self._segments.popleft()
+        self._size -= end - start
+
+        if self._paused and self._size < self.limit // 2:
+            self._paused = False
+            self.transport.resume_reading()
+        return view[start:end]
+
+    def write(self, data: Union[bytes, memoryview]):
+        self.transport.write(data)
+
+    async def drain(self):
+        if self.transport.is_closing():
+            # Like StreamWriter: let connection_lost run, then report it.
+            await asyncio.sleep(0)
+            if self._exception is not None:
+                raise self._exception
+            if self._closed.done():
+                raise ConnectionResetError("Connection lost")
+        if self._write_paused:
+            waiter = asyncio.get_running_loop().create_future()
+            self._drain_waiters.append(waiter)
+            await waiter
+            if self._closed.done():
+                raise ConnectionResetError("Connection lost")
+
+    def can_write_eof(self) -> bool:
+        return self.transport.can_write_eof()
+
+    def write_eof(self):
+        self.transport.write_eof()
+
+    def is_closing(self) -> bool:
+        return self.transport.is_closing()
+
+    def close(self):
+        self.transport.close()
+
+    async def wait_closed(self):
+        await self._closed
+
+    def get_extra_info(self, name: str, default=None):
+        return self.transport.get_extra_info(name, default)
+
+
+async def open_connection(
+    host: str, port: int, *, io: str = "stream", pool: BufferPool = default_pool
+) -> Tuple[object, object]:
+    if io == "stream":
+        return await asyncio.open_connection(host, port)
+    loop = asyncio.get_running_loop()
+    _, stream = await loop.create_connection(lambda: BufferedStream(pool), host, port)
+    return stream, stream
+
+
+async def start_server(
+    handler: Handler,
+    host: str,
+    port: int,
+    *,
+    io: str = "stream",
+    backlog: int = 100,
+    pool: BufferPool = default_pool,
+) -> asyncio.AbstractServer:
+    if io == "stream":
+        return await asyncio.start_server(handler, host, port, backlog=backlog)
+    loop = asyncio.get_running_loop()
+    return await loop.create_server(lambda: BufferedStream(pool, handler), host, port, backlog=backlog)
@@ -0,0 +1,208 @@
+from typing import Optional, AsyncIterator, Dict, List
+import logging
+import time
+import zlib
+
+from .metrics import registry
+
+try:
+    import zstandard
+except ImportError:     # optional: pip install 'webvpn[zstd]'
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# With a codec negotiated for the token, every non-empty push and pull body starts
+# with one of these; empty bodies stay empty.
+RAW = b"\x00"
+COMPRESSED = b"\x01"
+
+MIN_SIZE = 256              # smaller bodies go raw: too little to gain
+SAMPLE_SIZE = 4096          # bodies above 4x this are tried on a prefix first
+MAX_RATIO = 0.9             # compressed / raw above this is incompressible
+MAX_SKIP = 64               # raw bodies after an incompressible one, at most
+MAX_DECODED_SIZE = 16 * 1024 * 1024
+
+
+class ZlibCodec:
+    name = "zlib"
+
+    def __init__(self, level: int = 1):
+        self.level = level
+
+    def compress(self, data: bytes) -> bytes:
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data: bytes, limit: int) -> bytes:
+        decompressor = zlib.decompressobj()
+        output = decompressor.decompress(data, limit)
+        if decompressor.unconsumed_tail:
+            raise ValueError("Decompressed body too large")
+        return output
+
+
+class ZstdCodec:
+    name = "zstd"
+
+    def __init__(self, level: int = 3):
+        self.compressor = zstandard.ZstdCompressor(level=level)
+        self.decompressor = zstandard.ZstdDecompressor()
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.compress(data)
+
+    def decompress(self, data: bytes, limit: int) -> bytes:
+        # Frames from compress() state their size; others are bounded by `limit`.
+        if zstandard.frame_content_size(data) > limit:
+            raise ValueError("Decompressed body too large")
+        return self.decompressor.decompress(data, max_output_size=limit)
+
+
+CODECS = {"zlib": ZlibCodec}
+if zstandard is not None:
+    CODECS["zstd"] = ZstdCodec
+CODEC_ERRORS = (zlib.error,) if zstandard is None else (zlib.error, zstandard.ZstdError)
+
+
+def parse_codecs(value: str) -> List[str]:
+    # "zstd,zlib" -> those of them available here, in order.
+    return [name for name in (part.strip() for part in str(value or "").split(",")) if name in CODECS]
+
+
+def negotiate(offered: Optional[str], accepted: List[str]) -> Optional[str]:
+    # The client's first choice that this side accepts.
+    for name in parse_codecs(offered):
+        if name in accepted:
+            return name
+    return None
+
+
+class TunnelCodec:
+    # One tunnel's compression, seen from one end. What this end sends is compressed
+    # when it pays: small bodies go raw, and after an incompressible one (judged on a
+    # prefix for large bodies) the next go raw too, twice as many each time it stays
+    # so. What it receives is decoded by its flag either way.
+    def __init__(self, name: str):
+        self.codec = CODECS[name]()
+        self.name = name
+        self.skip = 0
+        self.backoff = 1
+
+        self.sent_raw = 0
+        self.sent_wire = 0
+        self.received_wire = 0
+        self.received_raw = 0
+        self.skipped = 0
+        self.cpu_time = 0.0
+
+        self.raw_bytes = registry.counter(
+            "webvpn_compression_raw_bytes_total", "Body bytes sent before compression", codec=name
+        )
+        self.wire_bytes = registry.counter(
+            "webvpn_compression_wire_bytes_total", "Body bytes sent after compression", codec=name
+        )
+        self.skipped_total = registry.counter(
+            "webvpn_compression_skipped_total", "Bodies sent raw as incompressible", codec=name
+        )
+        self.cpu_seconds = registry.counter(
+            "webvpn_compression_cpu_seconds_total", "CPU time spent compressing and decompressing", codec=name
+        )
+
+    def _charge(self, started_at: float):
+        elapsed = time.thread_time() - started_at
+        self.cpu_time += elapsed
+        self.cpu_seconds.inc(elapsed)
+
+    def _incompressible(self):
+        self.skipped += 1
+        self.skipped_total.inc()
+        self.skip = self.backoff
+        self.backoff = min(self.backoff * 2, MAX_SKIP)
+
+    def _compress(self, data: bytes) -> Optional[bytes]:
+        if len(data) < MIN_SIZE:
+            return None
+        if self.skip > 0:
+            self.skip -= 1
+            return None
+
+        if len(data) > 4 * SAMPLE_SIZE:
+            sample = self.codec.compress(data[:SAMPLE_SIZE])
+            if len(sample) > MAX_RATIO * SAMPLE_SIZE:
+                self._incompressible()
+                return None
+        compressed = self.codec.compress(data)
+        if len(compressed) > MAX_RATIO * len(data):
+            self._incompressible()
+            return None
+        self.backoff = 1
+        return compressed
+
+    def encode(self, data: bytes) -> bytes:
+        if not data:
+            return data
+        started_at = time.thread_time()
+        compressed = self._compress(data)
+        body = RAW + data if compressed is None else COMPRESSED + compressed
+        self._charge(started_at)
+
+        self.sent_raw += len(data)
+        self.sent_wire += len(body)
+        self.raw_bytes.inc(len(data))
+        self.wire_bytes.inc(len(body))
+        return body
+
+    def decode(self, body: bytes) -> bytes:
+        if not body:
+            return body
+        flag = body[:1]
+        if flag == RAW:
+            data = body[1:]
+        elif flag == COMPRESSED:
+            started_at = time.thread_time()
+            try:
+                data = self.codec.decompress(memoryview(body)[1:], MAX_DECODED_SIZE)
+            except CODEC_ERRORS as e:
+                raise ValueError(f"Corrupt {self.name} body: {e}")
+            finally:
+                self._charge(started_at)
+        else:
+            raise ValueError(f"Unknown body flag: {flag!r}")
+
+        self.received_wire += len(body)
+        self.received_raw += len(data)
+        return data
+
+    async def decode_stream(self, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        # Raw bodies still stream through; compressed ones are decoded whole, being
+        # at most the client's max body size.
+        flag = None
+        pieces = []
+        async for chunk in chunks:
+            if flag is None:
+                if not chunk:
+                    continue
+                flag, chunk = chunk[:1], chunk[1:]
+                if flag not in (RAW, COMPRESSED):
+                    raise ValueError(f"Unknown body flag: {flag!r}")
+                if flag == RAW:
+                    self.received_wire += 1
+            if flag == COMPRESSED:
+                pieces.append(chunk)
+            elif chunk:
+                self.received_wire += len(chunk)
+                self.received_raw += len(chunk)
+                yield chunk
+        if flag == COMPRESSED:
+            yield self.decode(COMPRESSED + b"".join(pieces))
+
+    def get_stats(self) -> Dict:
+        return {
+            "codec": self.name,
+            "sent_bytes": self.sent_raw,
+            "sent_ratio": round(self.sent_wire / self.sent_raw, 3) if self.sent_raw else 1.0,
+            "received_bytes": self.received_raw,
+            "received_ratio": round(self.received_wire / self.received_raw, 3) if self.received_raw else 1.0,
+            "skipped": self.skipped,
+            "cpu_ms": round(self.cpu_time * 1000, 1),
+        }
@@ -0,0 +1,327 @@
+from typing import Optional, Deque, Dict, Set
+from collections import deque
+from dataclasses import dataclass, field
+import asyncio
+import logging
+import math
+import time
+
+from .metrics import registry, Counter
+
+logger = logging.getLogger(__name__)
+
+DIRECTIONS = ("pull", "push")
+# The label of users past `max_user_labels`.
+OTHER_USERS = "other"
+THROTTLED = {
+    direction: registry.counter(
+        "webvpn_sched_throttled_total", "Transfers that waited for bandwidth", direction=direction
+    )
+    for direction in DIRECTIONS
+}
+INTERACTIVE = {
+    direction: registry.counter(
+        "webvpn_sched_interactive_total", "Small transfers of quiet tunnels served ahead of the queue",
+        direction=direction,
+    )
+    for direction in DIRECTIONS
+}
+WAIT_TIME = {
+    direction: registry.histogram(
+        "webvpn_sched_wait_seconds", "Time throttled transfers waited for bandwidth", direction=direction
+    )
+    for direction in DIRECTIONS
+}
+
+
+class TokenBucket:
+    # `rate` bytes per second, up to `burst` saved up. Takes may overdraw: bytes
+    # already received have to go somewhere, and the debt delays what follows.
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self.tokens = self.burst
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def available(self) -> float:
+        self._refill()
+        return self.tokens
+
+    def delay(self, n: int) -> float:
+        # Seconds until `n` bytes (at most a full bucket) may be taken.
+        self._refill()
+        return max(min(n, self.burst) - self.tokens, 0.0) / self.rate
+
+    def take(self, n: int):
+        self._refill()
+        self.tokens -= n
+
+
+class RateMeter:
+    # Bytes per second, decaying with a time constant of `window` seconds.
+    __slots__ = ("window", "value", "updated_at")
+
+    def __init__(self, window: float = 1.0):
+        self.window = window
+        self.value = 0.0
+        self.updated_at = time.monotonic()
+
+    def _decay(self) -> float:
+        now = time.monotonic()
+        value = self.value * math.exp((self.updated_at - now) / self.window)
+        self.value, self.updated_at = value, now
+        return value
+
+    def add(self, n: int):
+        self.value = self._decay() + n / self.window
+
+    def get(self) -> float:
+        return self._decay()
+
+
+@dataclass
+class Request:
+    size: int
+    future: asyncio.Future
+
+
+@dataclass
+class UserState:
+    name: str
+    weight: float
+    bucket: Optional[TokenBucket]
+    bytes_total: Counter
+    throttled_total: Counter
+    meter: RateMeter = field(default_factory=RateMeter)
+    bytes: int = 0
+    throttled: float = 0.0      # seconds spent waiting
+    # Deficit round robin over users (a deficit below zero is debt), then round robin
+    # over the user's flows.
+    deficit: float = 0.0
+    flows: Deque["Flow"] = field(default_factory=deque)
+    active: bool = False
+    tunnels: int = 0
+
+
+class Flow:
+    # One tunnel's traffic in one direction. Every tunnel has two, so the queue is
+    # only made once the tunnel first has to wait.
+    __slots__ = ("scheduler", "user", "meter", "queue", "active", "closed")
+
+    def __init__(self, scheduler: "FairScheduler", user: UserState):
+        self.scheduler = scheduler
+        self.user = user
+        self.meter = RateMeter()
+        self.queue: Optional[Deque[Request]] = None
+        self.active = False
+        self.closed = False
+
+    async def acquire(self, size: int, partial: bool = True) -> int:
+        return await self.scheduler.acquire(self, size, partial)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.scheduler.release(self)
+
+
+class FairScheduler:
+    # Shares one direction of the server's bandwidth between users. Without limits
+    # it only keeps count. With `rate` (bytes/s) set, bulk transfers queue and are
+    # granted in deficit round robin by user weight; `user_rate` caps each user with
+    # a token bucket. Small transfers of tunnels moving less than `interactive_rate`
+    # (keystrokes, prompts) skip both waits and are charged to the buckets after.
+    # Usernames come unauthenticated from clients: a user's state lives as long as
+    # their tunnels, and only `max_user_labels` of them get metrics of their own.
+    def __init__(
+        self,
+        direction: str,
+        *,
+        rate: float = 0,
+        user_rate: float = 0,
+        user_burst: float = 1024 * 1024,
+        user_rates: Optional[Dict[str, float]] = None,
+        weights: Optional[Dict[str, float]] = None,
+        quantum: int = 64 * 1024,
+        interactive_rate: float = 64 * 1024,
+        interactive_size: int = 16 * 1024,
+        max_user_labels: int = 100,
+    ):
+        self.direction = direction
+        self.bucket = TokenBucket(rate, max(quantum, rate / 10)) if rate > 0 else None
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.user_rates = dict(user_rates or {})
+        self.weights = dict(weights or {})
+        self.quantum = quantum
+        self.interactive_rate = interactive_rate
+        self.interactive_size = interactive_size
+        self.max_user_labels = max_user_labels
+
+        self.users: Dict[str, UserState] = {}
+        self.active: Deque[UserState] = deque()
+        # Users named in the settings always have labels; others as they come, up to
+        # the limit. Labels are never taken back: the counters behind them go on.
+        self.labels: Set[str] = set(self.user_rates) | set(self.weights)
+        self._extra_labels = 0
+        # Made with the dispatcher: schedulers are built before the loop runs.
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+
+    def get_label(self, username: str) -> str:
+        if username not in self.labels:
+            if self._extra_labels >= self.max_user_labels:
+                return OTHER_USERS
+            self.labels.add(username)
+            self._extra_labels += 1
+        return username
+
+    def get_user(self, username: str) -> UserState:
+        user = self.users.get(username)
+        if user is None:
+            rate = self.user_rates.get(username, self.user_rate)
+            label = self.get_label(username)
+            user = UserState(
+                username,
+                max(float(self.weights.get(username, 1.0)), 0.01),
+                TokenBucket(rate, max(self.user_burst, self.quantum)) if rate > 0 else None,
+                registry.counter(
+                    "webvpn_user_bytes_total", "Bytes moved per user", user=label, direction=self.direction
+                ),
+                registry.counter(
+                    "webvpn_user_throttled_seconds_total", "Time each user's transfers waited for bandwidth",
+                    user=label, direction=self.direction,
+                ),
+            )
+            self.users[username] = user
+        return user
+
+    def flow(self, username: str) -> Flow:
+        user = self.get_user(username)
+        user.tunnels += 1
+        return Flow(self, user)
+
+    def release(self, flow: Flow):
+        flow.user.tunnels -= 1
+        self._drop(flow.user)
+
+    def _drop(self, user: UserState):
+        # Forgotten once the last tunnel is gone and nothing is queued.
+        if user.tunnels <= 0 and not user.active and self.users.get(user.name) is user:
+            del self.users[user.name]
+
+    def _account(self, flow: Flow, n: int):
+        flow.meter.add(n)
+        flow.user.meter.add(n)
+        flow.user.bytes += n
+        flow.user.bytes_total.inc(n)
+
+    async def acquire(self, flow: Flow, size: int, partial: bool = True) -> int:
+        # How many of `size` bytes may go now: all of them unless `partial`.
+        user = flow.user
+        if self.bucket is None and user.bucket is None:
+            self._account(flow, size)
+            return size
+
+        if size <= self.interactive_size and flow.meter.get() < self.interactive_rate:
+            INTERACTIVE[self.direction].inc()
+            self._charge(user, size)
+            self._account(flow, size)
+            return size
+
+        started_at = time.monotonic()
+        if user.bucket is not None:
+            delay = user.bucket.delay(min(size, self.quantum))
+            while delay > 0:
+                await asyncio.sleep(delay)
+                delay = user.bucket.delay(min(size, self.quantum))
+            if partial:
+                size = min(size, max(int(user.bucket.available()), self.quantum))
+
+        if self.bucket is not None:
+            future = asyncio.get_running_loop().create_future()
+            if flow.queue is None:
+                flow.queue = deque()
+            flow.queue.append(Request(size, future))
+            self._activate(flow)
+            size = await future
+        if user.bucket is not None:
+            user.bucket.take(size)
+
+        waited = time.monotonic() - started_at
+        if waited > 0.001:
+            THROTTLED[self.direction].inc()
+            WAIT_TIME[self.direction].observe(waited)
+            user.throttled += waited
+            user.throttled_total.inc(waited)
+        self._account(flow, size)
+        return size
+
+    def _charge(self, user: UserState, n: int):
+        if self.bucket is not None:
+            self.bucket.take(n)
+        if user.bucket is not None:
+            user.bucket.take(n)
+
+    def _activate(self, flow: Flow):
+        if not flow.active:
+            flow.active = True
+            flow.user.flows.append(flow)
+        if not flow.user.active:
+            flow.user.active = True
+            self.active.append(flow.user)
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.ensure_future(self._dispatch())
+        self._wakeup.set()
+
+    async def _dispatch(self):
+        while True:
+            if not self.active:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            user = self.active[0]
+            user.deficit += self.quantum * user.weight
+            while user.flows and user.deficit > 0:
+                flow = user.flows[0]
+                while flow.queue and flow.queue[0].future.done():    # cancelled
+                    flow.queue.popleft()
+                if not flow.queue:
+                    flow.active = False
+                    user.flows.popleft()
+                    continue
+
+                # Granted whole: a user with few requests in flight still moves large
+                # chunks, and the debt sits out the rounds it ran ahead.
+                request = flow.queue[0]
+                delay = self.bucket.delay(request.size)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                flow.queue.popleft()
+                if request.future.done():
+                    continue
+                self.bucket.take(request.size)
+                user.deficit -= request.size
+                request.future.set_result(request.size)
+                user.flows.rotate(-1)
+
+            self.active.popleft()
+            if user.flows:
+                self.active.append(user)
+            else:
+                user.active = False
+                user.deficit = min(user.deficit, 0.0)
+                self._drop(user)
+
+    def close(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            self._dispatcher = None
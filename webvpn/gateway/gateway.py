@@ -1,12 +1,36 @@
 from abc import ABCMeta, abstractmethod
-from typing import Optional, Dict
+from typing import Optional, AsyncIterator, Dict, List, Tuple, NamedTuple
+import heapq
 import uuid
+import weakref
 import time
 import asyncio
 import logging
 
+from .metrics import registry
+
 logger = logging.getLogger(__name__)
 
+PUSHES = registry.counter("webvpn_pushes_total", "Pushes applied to tunnels")
+PUSH_BYTES = registry.counter("webvpn_push_bytes_total", "Bytes pushed into tunnels")
+PULLS = registry.counter("webvpn_pulls_total", "Pulls that returned data")
+PULL_BYTES = registry.counter("webvpn_pull_bytes_total", "Bytes pulled out of tunnels")
+PULL_WAIT = registry.histogram("webvpn_pull_wait_seconds", "Time a pull was held before it was answered")
+OPENED = registry.counter("webvpn_connections_opened_total", "Tunnels opened")
+CLOSED = registry.counter("webvpn_connections_closed_total", "Tunnels closed")
+RESUMED = registry.counter("webvpn_connections_resumed_total", "Tunnels resumed by their client")
+EXPIRED = registry.counter("webvpn_connections_expired_total", "Idle tunnels expired")
+EXPIRY_LATENESS = registry.histogram(
+    "webvpn_expiry_lateness_seconds", "How long after its deadline an idle tunnel was expired"
+)
+
+
+# Every live gateway of the process (bench builds several); gauges sum over them.
+GATEWAYS: "weakref.WeakSet[Gateway]" = weakref.WeakSet()
+registry.gauge(
+    "webvpn_connections", "Live tokens", fn=lambda: sum(len(gateway.connections) for gateway in GATEWAYS)
+)
+
 
 class InvalidToken(Exception):
     ...
@@ -16,22 +40,42 @@ class ConnectionClosedError(Exception):
     ...
 
 
+class Chunk(NamedTuple):
+    seq: int
+    data: bytes
+
+
 class Connection(metaclass=ABCMeta):
-    def __init__(self, closed: bool = False):
+    # Servers hold thousands of these, mostly idle: subclasses there declare slots too.
+    __slots__ = ("closed", "updated_at", "ttl", "scheduled")
+
+    def __init__(self, closed: bool = False, ttl: Optional[float] = None):
         self.closed = closed
-        self.created_at = time.time()
-        self.updated_at = time.time()
+        self.updated_at = time.monotonic()
+        # Idle time before expiry when it differs from the gateway's.
+        self.ttl = ttl
+        self.scheduled = 0.0    # deadline of this connection's live expiry entry
 
     @abstractmethod
-    async def push(self, data: bytes):
+    async def push(self, data: bytes, seq: Optional[int] = None):
         ...
 
+    async def push_stream(self, chunks: AsyncIterator[bytes], seq: Optional[int] = None) -> int:
+        data = b"".join([chunk async for chunk in chunks])
+        await self.push(data, seq)
+        return len(data)
+
     @abstractmethod
-    async def pull(self, n: int) -> bytes:
+    async def pull(self, n: int, hold: Optional[float] = None) -> bytes:
+        # Waits up to `hold` seconds for data (forever if None); b"" if none came.
         ...
 
+    def resume(self, ack: int) -> Optional[int]:
+        # The seq of the next push to apply, or None if the tunnel cannot resume.
+        return None
+
     def update(self):
-        self.updated_at = time.time()
+        self.updated_at = time.monotonic()
 
     async def keep_alive(self) -> bool:
         self.update()
@@ -43,41 +87,106 @@ class Connection(metaclass=ABCMeta):
 
 
 class Gateway(metaclass=ABCMeta):
-    def __init__(self, expire_time: float = -1):
+    def __init__(self, expire_time: float = -1, token_prefix: str = ""):
         self.expire_time = expire_time
+        # Sharded servers prefix tokens with the owning shard.
+        self.token_prefix = token_prefix
 
         self.connections: Dict[str, Connection] = {}
+        # Lazy-deletion heap of (deadline, token), one live entry per token: the one
+        # matching `conn.scheduled`. `update()` only stamps the connection; an entry
+        # that surfaces early is pushed back to the token's current deadline, so
+        # expiring costs O(log n) per due token.
+        self.expiry: List[Tuple[float, str]] = []
+        # Made by clean(): gateways are built before the loop runs, and an event
+        # made then binds to the wrong loop on Python < 3.10.
+        self._rescheduled: Optional[asyncio.Event] = None
+        GATEWAYS.add(self)
 
     @abstractmethod
     def open_connection(self, conn) -> Optional[str]:
-        token = str(uuid.uuid4())
+        token = self.token_prefix + str(uuid.uuid4())
         self.connections[token] = conn
+        OPENED.inc()
+        self._schedule(token, conn)
         return token
 
-    async def push(self, token: str, data: bytes) -> bool:
+    def _get_ttl(self, conn: Connection) -> float:
+        return conn.ttl if conn.ttl is not None else self.expire_time
+
+    def _schedule(self, token: str, conn: Connection):
+        if self.expire_time <= 0:
+            return
+        deadline = conn.updated_at + self._get_ttl(conn)
+        conn.scheduled = deadline
+        if self._rescheduled is not None and (not self.expiry or deadline < self.expiry[0][0]):
+            # Due before whatever clean() is sleeping on.
+            self._rescheduled.set()
+        heapq.heappush(self.expiry, (deadline, token))
+
+    async def push(self, token: str, data: bytes, seq: Optional[int] = None) -> bool:
         if token not in self.connections:
             raise InvalidToken()
 
         conn = self.connections[token]
         try:
-            await conn.push(data)
+            await conn.push(data, seq)
         except ConnectionClosedError:
             await self.close(token)
             return False
 
+        PUSHES.inc()
+        PUSH_BYTES.inc(len(data))
         return True
 
-    async def pull(self, token: str, n: int = 1024) -> Optional[bytes]:
+    async def push_stream(
+        self, token: str, chunks: AsyncIterator[bytes], seq: Optional[int] = None
+    ) -> bool:
         if token not in self.connections:
             raise InvalidToken()
 
         conn = self.connections[token]
         try:
-            return await conn.pull(n)
+            size = await conn.push_stream(chunks, seq)
+        except ConnectionClosedError:
+            await self.close(token)
+            return False
+
+        PUSHES.inc()
+        PUSH_BYTES.inc(size)
+        return True
+
+    async def pull(self, token: str, n: int = 1024, hold: Optional[float] = None) -> Optional[bytes]:
+        if token not in self.connections:
+            raise InvalidToken()
+
+        conn = self.connections[token]
+        started_at = time.monotonic()
+        try:
+            data = await conn.pull(n, hold)
         except ConnectionClosedError:
             await self.close(token)
             return None
 
+        PULL_WAIT.observe(time.monotonic() - started_at)
+        if data:
+            PULLS.inc()
+            PULL_BYTES.inc(len(data))
+        return data
+
+    async def resume(self, token: str, ack: int) -> Optional[int]:
+        if token not in self.connections:
+            raise InvalidToken()
+
+        conn = self.connections[token]
+        conn.update()
+        push_seq = conn.resume(ack)
+        if push_seq is None:
+            await self.close(token)
+        else:
+            RESUMED.inc()
+        return push_seq
+
     async def keep_alive(self, token: str):
         if token not in self.connections:
             raise InvalidToken()
@@ -89,25 +198,53 @@ class Gateway(metaclass=ABCMeta):
         else:
             return True
 
+    @abstractmethod
+    async def drain(self, timeout: float):
+        # Flush what tunnels still hold before shutting down.
+        ...
+
     async def close(self, token: str):
-        if token in self.connections:
-            await self.connections[token].close()
-            del self.connections[token]
+        # Removed before awaiting: concurrent requests on a closing tunnel may all call this.
+        conn = self.connections.pop(token, None)
+        if conn is not None:
+            await conn.close()
+            CLOSED.inc()
 
     async def clean(self):
         if self.expire_time <= 0:
             return
 
+        self._rescheduled = asyncio.Event()
         while True:
-            await asyncio.sleep(self.expire_time)
-
+            # Sleep until the head is due (or one full period when empty); a token
+            # scheduled ahead of the head cuts the sleep short.
+            delay = self.expiry[0][0] - time.monotonic() if self.expiry else self.expire_time
+            self._rescheduled.clear()
             try:
-                now = time.time()
-                logger.info("Clean expired connections.")
-                for token, conn in list(self.connections.items()):
-                    if now - conn.updated_at > self.expire_time:
-                        logger.info(f"Connection {token} expired")
+                await asyncio.wait_for(self._rescheduled.wait(), max(delay, 0))
+            except asyncio.TimeoutError:
+                ...
 
-                        await self.close(token)
+            try:
+                await self.expire()
             except Exception as e:
-                print("Clean Error:", e)
+                logger.error(f"Clean Error: {e!r}")
+
+    async def expire(self):
+        now = time.monotonic()
+        while self.expiry and self.expiry[0][0] <= now:
+            scheduled, token = heapq.heappop(self.expiry)
+            conn = self.connections.get(token)
+            if conn is None or conn.scheduled != scheduled:    # closed, or superseded
+                continue
+
+            deadline = conn.updated_at + self._get_ttl(conn)
+            if deadline > now:  # used since the entry was pushed
+                conn.scheduled = deadline
+                heapq.heappush(self.expiry, (deadline, token))
+                continue
+
+            EXPIRED.inc()
+            EXPIRY_LATENESS.observe(now - deadline)
+            logger.info(f"Connection {token} expired")
+            await self.close(token)
@@ -0,0 +1,167 @@
+from typing import Dict, List, Tuple, Callable, Optional, Union
+from bisect import bisect_left
+import math
+
+Labels = Tuple[Tuple[str, str], ...]
+
+# Exponential buckets: 1ms .. ~65s for latencies, 64B .. 16MB for sizes.
+TIME_BUCKETS = tuple(0.001 * 2 ** i for i in range(17))
+SIZE_BUCKETS = tuple(float(64 * 4 ** i) for i in range(10))
+
+
+def format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    if extra is not None:
+        labels = labels + (extra,)
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, labels: Labels = ()):
+        self.labels = labels
+        self.value = 0
+
+    def inc(self, n: int = 1):
+        self.value += n
+
+    def render(self, name: str) -> List[str]:
+        return [f"{name}{format_labels(self.labels)} {self.value}"]
+
+    def as_dict(self) -> Union[int, float]:
+        return self.value
+
+
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self, labels: Labels = (), fn: Optional[Callable[[], float]] = None):
+        self.labels = labels
+        self.value = 0
+        # Callback gauges are computed on scrape and cost nothing in between.
+        self.fn = fn
+
+    def set(self, value: float):
+        self.value = value
+
+    def get(self) -> float:
+        return self.fn() if self.fn is not None else self.value
+
+    def render(self, name: str) -> List[str]:
+        return [f"{name}{format_labels(self.labels)} {format_value(self.get())}"]
+
+    def as_dict(self) -> Union[int, float]:
+        return self.get()
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, labels: Labels = (), buckets: Tuple[float, ...] = TIME_BUCKETS):
+        self.labels = labels
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        # Upper bound of the bucket holding the q-th observation.
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return math.inf
+
+    def render(self, name: str) -> List[str]:
+        lines = []
+        seen = 0
+        for bound, count in zip(self.buckets + (math.inf,), self.counts):
+            seen += count
+            le = ("le", format_value(bound))
+            lines.append(f"{name}_bucket{format_labels(self.labels, le)} {seen}")
+        lines.append(f"{name}_sum{format_labels(self.labels)} {self.sum!r}")
+        lines.append(f"{name}_count{format_labels(self.labels)} {self.count}")
+        return lines
+
+    def as_dict(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+        }
+
+
+Metric = Union[Counter, Gauge, Histogram]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Dict[Labels, Metric]] = {}
+        self.help: Dict[str, str] = {}
+
+    def _get(self, cls, name: str, help: str, labels: Dict[str, str], **kwargs) -> Metric:
+        key = tuple(sorted(labels.items()))
+        series = self.metrics.setdefault(name, {})
+        metric = series.get(key)
+        if metric is None:
+            metric = cls(key, **kwargs)
+            series[key] = metric
+            self.help[name] = help
+        return metric
+
+    def counter(self, name: str, help: str = "", **labels: str) -> Counter:
+        return self._get(Counter, name, help, labels)
+
+    def histogram(
+        self, name: str, help: str = "", buckets: Tuple[float, ...] = TIME_BUCKETS, **labels: str
+    ) -> Histogram:
+        return self._get(Histogram, name, help, labels, buckets=buckets)
+
+    def gauge(
+        self, name: str, help: str = "", fn: Optional[Callable[[], float]] = None, **labels: str
+    ) -> Gauge:
+        gauge = self._get(Gauge, name, help, labels)
+        if fn is not None:
+            gauge.fn = fn
+        return gauge
+
+    def render(self) -> str:
+        lines = []
+        for name, series in self.metrics.items():
+            kind = next(iter(series.values())).kind
+            if self.help.get(name):
+                lines.append(f"# HELP {name} {self.help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+            for metric in series.values():
+                lines += metric.render(name)
+        return "\n".join(lines) + "\n"
+
+    def as_dict(self) -> Dict:
+        stats = {}
+        for name, series in self.metrics.items():
+            for labels, metric in series.items():
+                key = name + "".join(f".{v}" for _, v in labels)
+                stats[key] = metric.as_dict()
+        return stats
+
+
+# One registry per process: the server and the client each expose their own.
+registry = Registry()
@@ -0,0 +1,248 @@
+from typing import Optional, List, Tuple, Callable, Awaitable
+from dataclasses import dataclass
+from enum import IntEnum
+import asyncio
+import logging
+import struct
+
+from .gateway import ConnectionClosedError, InvalidToken
+
+logger = logging.getLogger(__name__)
+
+# type, token length, request seq, data seq, payload length
+FRAME_HEADER = struct.Struct("!BBqqI")
+PULL_SIZE = struct.Struct("!I")
+
+HOLD_TIME = 2.0
+SHORT_HOLD_TIME = 0.02
+MIN_PULL_SIZE = 64 * 1024
+
+
+class FrameType(IntEnum):
+    # client -> server
+    PUSH = 1
+    PULL = 2
+    KEEP_ALIVE = 3
+    # server -> client
+    ACK = 16
+    DATA = 17
+    CLOSED = 18
+    INVALID = 19
+
+
+@dataclass
+class Frame:
+    type: FrameType
+    token: str
+    rid: int = -1
+    seq: int = -1
+    payload: bytes = b""
+
+
+def encode_frames(frames: List[Frame]) -> bytes:
+    buf = bytearray()
+    for frame in frames:
+        token = frame.token.encode()
+        buf += FRAME_HEADER.pack(frame.type, len(token), frame.rid, frame.seq, len(frame.payload))
+        buf += token
+        buf += frame.payload
+    return bytes(buf)
+
+
+def decode_frames(data: bytes) -> List[Frame]:
+    frames = []
+    view = memoryview(data)
+    offset = 0
+    while offset < len(view):
+        type_, token_len, rid, seq, length = FRAME_HEADER.unpack_from(view, offset)
+        offset += FRAME_HEADER.size
+        token = bytes(view[offset:offset + token_len]).decode()
+        offset += token_len
+        payload = bytes(view[offset:offset + length])
+        offset += length
+        frames.append(Frame(FrameType(type_), token, rid, seq, payload))
+    return frames
+
+
+# (body, hold) -> response body
+MuxRequest = Callable[[bytes, float], Awaitable[bytes]]
+
+
+class MuxScheduler:
+    def __init__(
+        self,
+        request: MuxRequest,
+        *,
+        max_inflight: int = 4,
+        max_size: int = 1024 * 1024,
+    ):
+        self.request = request
+        # At least one slot is always left for short batches, carrying pushes and
+        # keep-alives, so uploads never queue behind parked long-polls.
+        self.max_inflight = max(2, max_inflight)
+        self.max_size = max_size
+
+        self.requests = 0
+        self.frames = 0
+
+        self._pending: List[Tuple[Frame, asyncio.Future]] = []
+        self._inflight = 0
+        self._held = 0
+        self._changed = asyncio.Event()
+        self._runner: Optional[asyncio.Task] = None
+
+    async def call(self, frame: Frame) -> Frame:
+        if self._runner is None:
+            self._runner = asyncio.ensure_future(self._run())
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((frame, future))
+        self._changed.set()
+        return await future
+
+    def _take(self) -> Tuple[List[Tuple[Frame, asyncio.Future]], bool]:
+        # Pulls alone are held, unless every held slot is parked already: then they go
+        # in a short batch too rather than wait out another batch's hold.
+        held = self._held < self.max_inflight - 1 and all(
+            frame.type == FrameType.PULL for frame, _ in self._pending
+        )
+
+        # Both the batch and its response stay within max_size. The pulls waiting
+        # share the response evenly, each cut down to its share but to no less than
+        # MIN_PULL_SIZE; what does not fit waits for the next batch, in order.
+        min_pull = min(MIN_PULL_SIZE, self.max_size)
+        pulls = sum(1 for frame, future in self._pending if frame.type == FrameType.PULL and not future.done())
+        share = max(self.max_size // max(pulls, 1), min_pull)
+
+        batch, rest = [], []
+        size, pulled = 0, 0
+        full = {FrameType.PULL: False, FrameType.PUSH: False}
+        for frame, future in self._pending:
+            if future.done():   # cancelled by the caller
+                continue
+            kind = FrameType.PULL if frame.type == FrameType.PULL else FrameType.PUSH
+            frame_size = FRAME_HEADER.size + len(frame.token) + len(frame.payload)
+            if batch and (full[kind] or size + frame_size > self.max_size):
+                full[kind] = True
+                rest.append((frame, future))
+                continue
+
+            if kind == FrameType.PULL:
+                n, = PULL_SIZE.unpack(frame.payload)
+                cut = min(n, share, self.max_size - pulled)
+                if batch and cut < min(n, min_pull):
+                    full[kind] = True
+                    rest.append((frame, future))
+                    continue
+                cut = max(cut, 1)
+                frame.payload = PULL_SIZE.pack(cut)
+                pulled += cut
+
+            batch.append((frame, future))
+            size += frame_size
+        self._pending = rest
+        return batch, held
+
+    async def _run(self):
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+
+            while self._pending and self._inflight < self.max_inflight:
+                batch, held = self._take()
+                if not batch:
+                    break
+
+                self._inflight += 1
+                if held:
+                    self._held += 1
+                asyncio.ensure_future(self._send(batch, held))
+
+    async def _send(self, batch: List[Tuple[Frame, asyncio.Future]], held: bool):
+        hold = HOLD_TIME if held else SHORT_HOLD_TIME
+        try:
+            self.requests += 1
+            self.frames += len(batch)
+            data = await self.request(encode_frames([frame for frame, _ in batch]), hold)
+            responses = decode_frames(data)
+            if len(responses) != len(batch):
+                raise RuntimeError("Mismatched mux response")
+
+            for (_, future), response in zip(batch, responses):
+                if not future.done():
+                    future.set_result(response)
+        except Exception as e:
+            if not isinstance(e, ConnectionClosedError):
+                logger.error(f"Mux request failed: {e!r}")
+            # A request that ran out of retries says so, so that tunnels can resume.
+            error = e if isinstance(e, ConnectionClosedError) else ConnectionClosedError()
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+        finally:
+            self._inflight -= 1
+            if held:
+                self._held -= 1
+            self._changed.set()
+
+    def close(self):
+        if self._runner is not None:
+            self._runner.cancel()
+            self._runner = None
+        for _, future in self._pending:
+            if not future.done():
+                future.set_exception(ConnectionClosedError())
+        self._pending.clear()
+
+
+async def handle_frames(gateway, frames: List[Frame], hold: float) -> List[Frame]:
+    async def run(frame: Frame) -> Frame:
+        try:
+            if frame.type == FrameType.PUSH:
+                if not await gateway.push(frame.token, frame.payload, frame.rid):
+                    return Frame(FrameType.CLOSED, frame.token, frame.rid)
+                # The data seq of a push ACK carries the advertised send window.
+                window = gateway.get_send_window(frame.token)
+                return Frame(FrameType.ACK, frame.token, frame.rid, window)
+            elif frame.type == FrameType.KEEP_ALIVE:
+                ok = await gateway.keep_alive(frame.token)
+                return Frame(FrameType.ACK if ok else FrameType.CLOSED, frame.token, frame.rid)
+            else:
+                # The data seq of a PULL acknowledges every chunk below it, if set.
+                n, = PULL_SIZE.unpack(frame.payload)
+                ack = frame.seq if frame.seq >= 0 else None
+                chunk = await gateway.pull_chunk(frame.token, frame.rid, n, hold, ack)
+                if chunk is None:
+                    return Frame(FrameType.CLOSED, frame.token, frame.rid)
+                return Frame(FrameType.DATA, frame.token, frame.rid, chunk.seq, chunk.data)
+        except InvalidToken:
+            return Frame(FrameType.INVALID, frame.token, frame.rid)
+
+    responses: List[Optional[Frame]] = [None] * len(frames)
+
+    # Pushes and keep-alives are applied first, in request order.
+    pulls = {}
+    for i, frame in enumerate(frames):
+        if frame.type == FrameType.PULL:
+            pulls[asyncio.ensure_future(run(frame))] = i
+        else:
+            responses[i] = await run(frame)
+
+    if pulls:
+        done, pending = await asyncio.wait(pulls, return_when=asyncio.FIRST_COMPLETED)
+        if pending:
+            # Give pulls that became ready at the same time a chance to finish, then
+            # cancel the rest and wait for them: a pull that already took data off
+            # the buffer must still report it.
+            await asyncio.sleep(0)
+            for task in pending:
+                task.cancel()
+            await asyncio.wait(pending)
+
+        for task, i in pulls.items():
+            if task.cancelled():
+                responses[i] = Frame(FrameType.DATA, frames[i].token, frames[i].rid)
+            else:
+                responses[i] = task.result()
+
+    return responses
@@ -0,0 +1,331 @@
+from typing import Optional, Deque, Dict, List, Set, Tuple, Callable, Awaitable, Union
+from collections import deque
+import asyncio
+import logging
+import math
+import time
+
+from .gateway import ConnectionClosedError
+
+logger = logging.getLogger(__name__)
+
+MIN_PULL_SIZE = 16 * 1024
+
+# (request seq, n) -> (data seq, data)
+PullRequest = Callable[[int, int], Awaitable[Tuple[int, bytes]]]
+
+
+class PullWindow:
+    def __init__(
+        self,
+        request: PullRequest,
+        *,
+        min_window: int = 1,
+        max_window: int = 8,
+        recv_window: int = 4 * 1024 * 1024,
+    ):
+        self.request = request
+        self.min_window = max(1, min_window)
+        self.max_window = max(self.min_window, max_window)
+        # Credit: bytes we are prepared to hold, counting both outstanding requests
+        # and out-of-order chunks waiting for reassembly.
+        self.recv_window = recv_window
+
+        self.window = self.min_window
+        self.rtt: Optional[float] = None        # seconds, EWMA
+        self.bandwidth: Optional[float] = None  # bytes per second, EWMA
+
+        self.chunk_size = 1024
+        self.closed = False
+
+        self._next_rid = 0
+        self._next_seq = 0
+        self._pending: Dict[int, bytes] = {}
+        self._pending_size = 0
+        self._inflight: Set[asyncio.Task] = set()
+        self._requested = 0
+        self._delivered_at: Optional[float] = None
+
+        # Pulls piggybacked on exchange requests stand in for our own long-poll.
+        self._external = 0
+        self._linger_until = 0.0
+        self._wakeup = asyncio.Event()
+
+    async def _fetch(self, rid: int, n: int) -> Tuple[int, bytes, float]:
+        started_at = time.monotonic()
+        try:
+            seq, data = await self.request(rid, n)
+        finally:
+            self._requested -= n
+        return seq, data, time.monotonic() - started_at
+
+    @property
+    def credit(self) -> int:
+        return self.recv_window - self._requested - self._pending_size
+
+    def _fill(self, n: int):
+        if self._external or time.monotonic() < self._linger_until:
+            return
+
+        while not self.closed and len(self._inflight) < self.window:
+            size = min(n, self.credit)
+            if size < MIN_PULL_SIZE:
+                if self._inflight:
+                    break
+                size = MIN_PULL_SIZE
+
+            self._requested += size
+            task = asyncio.ensure_future(self._fetch(self._next_rid, size))
+            self._next_rid += 1
+            self._inflight.add(task)
+
+    def _adapt(self, nbytes: int, rtt: float, n: int):
+        if nbytes == 0:
+            # Idle tunnel: collapse to a single long-poll.
+            self.window = max(self.min_window, self.window - 1)
+            return
+
+        self.rtt = rtt if self.rtt is None else 0.875 * self.rtt + 0.125 * rtt
+
+        now = time.monotonic()
+        if self._delivered_at is not None:
+            rate = nbytes / max(now - self._delivered_at, 1e-3)
+            self.bandwidth = rate if self.bandwidth is None else 0.75 * self.bandwidth + 0.25 * rate
+        self._delivered_at = now
+
+        window = self.window + 1 if nbytes >= n else self.window
+        if self.bandwidth is not None:
+            # Keep roughly one bandwidth-delay product of pulls outstanding.
+            window = max(window, math.ceil(self.bandwidth * self.rtt / n) + 1)
+        self.window = min(self.max_window, max(self.min_window, window))
+
+    @property
+    def ack(self) -> int:
+        # The first data seq not received yet; the server may forget everything below it.
+        seq = self._next_seq
+        while seq in self._pending:
+            seq += 1
+        return seq
+
+    def feed(self, seq: int, data: bytes):
+        if data and seq >= self._next_seq and seq not in self._pending:
+            self._pending[seq] = data
+            self._pending_size += len(data)
+            self._wakeup.set()
+
+    def begin_external(self) -> int:
+        rid = self._next_rid
+        self._next_rid += 1
+        self._external += 1
+        return rid
+
+    def end_external(self, linger: float = 0.0):
+        self._external -= 1
+        self._linger_until = max(self._linger_until, time.monotonic() + linger)
+        self._wakeup.set()
+
+    async def get(self, n: int) -> Optional[bytes]:
+        self.chunk_size = n
+
+        while True:
+            data = self._pending.pop(self._next_seq, None)
+            if data is not None:
+                self._next_seq += 1
+                self._pending_size -= len(data)
+                return data
+
+            if self.closed and not self._inflight:
+                return None
+
+            self._fill(n)
+
+            self._wakeup.clear()
+            wakeup = asyncio.ensure_future(self._wakeup.wait())
+            timeout = None
+            if not self._inflight and not self._external:
+                timeout = max(self._linger_until - time.monotonic(), 0)
+
+            done, _ = await asyncio.wait(
+                self._inflight | {wakeup}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+            wakeup.cancel()
+
+            received = 0
+            for task in done:
+                if task is wakeup:
+                    continue
+                self._inflight.discard(task)
+                if task.cancelled():    # by close()
+                    self.closed = True
+                    continue
+                try:
+                    seq, data, rtt = task.result()
+                except ConnectionClosedError:
+                    self.closed = True
+                    continue
+                except Exception as e:
+                    logger.error(f"Pull failed: {e!r}")
+                    self.closed = True
+                    continue
+
+                self.feed(seq, data)
+                self._adapt(len(data), rtt, n)
+                received += len(data)
+
+            if not received and self._next_seq not in self._pending and not self.closed:
+                return b""
+
+    def close(self):
+        self.closed = True
+        for task in self._inflight:
+            task.cancel()
+        self._inflight.clear()
+        self._pending.clear()
+        self._pending_size = 0
+
+
+Segment = Union[bytes, memoryview]
+
+# (request seq, body chunks) -> advertised send window, if any
+PushRequest = Callable[[int, List[Segment]], Awaitable[Optional[int]]]
+
+
+class PushPipeline:
+    def __init__(
+        self,
+        request: PushRequest,
+        *,
+        max_inflight: int = 4,
+        coalesce_delay: float = 0.002,
+        max_size: int = 1024 * 1024,
+        immediate_size: int = 64,
+    ):
+        self.request = request
+        self.max_inflight = max(1, max_inflight)
+        self.coalesce_delay = coalesce_delay
+        self.max_size = max_size
+        self.immediate_size = immediate_size
+
+        # Credit advertised by the server: how many unacknowledged bytes it will take.
+        self.window = self.max_size * self.max_inflight
+        self.failed = False
+
+        self._next_seq = 0
+        # Writes are queued as they came in and handed to requests without joining.
+        self._chunks: Deque[Segment] = deque()
+        self._buffered = 0
+        self._inflight: Set[asyncio.Task] = set()
+        self._inflight_size = 0
+        self._acked = asyncio.Event()
+        self._slots = asyncio.Semaphore(self.max_inflight)
+        self._ready = asyncio.Event()
+        self._writable = asyncio.Event()
+        self._writable.set()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._sender: Optional[asyncio.Task] = None
+
+    async def put(self, data: bytes):
+        if self.failed:
+            raise ConnectionClosedError()
+
+        if self._sender is None:
+            self._sender = asyncio.ensure_future(self._send_loop())
+
+        self._chunks.append(data)
+        self._buffered += len(data)
+        self._idle.clear()
+        self._ready.set()
+
+        if self._buffered >= self.max_size:
+            self._writable.clear()
+            await self._writable.wait()
+            if self.failed:
+                raise ConnectionClosedError()
+
+    async def _send_loop(self):
+        while not self.failed:
+            await self._ready.wait()
+
+            # A lone keystroke on an otherwise quiet tunnel goes out at once; anything
+            # else waits briefly so that back-to-back writes share one request.
+            quiet = not self._inflight and self._buffered <= self.immediate_size
+            if not quiet and self._buffered < self.max_size and self.coalesce_delay > 0:
+                await asyncio.sleep(self.coalesce_delay)
+
+            await self._slots.acquire()
+
+            # Out of credit: wait for an acknowledgement (one push may always be in flight).
+            while self._inflight_size and self._inflight_size >= self.window and not self.failed:
+                self._acked.clear()
+                await self._acked.wait()
+            if self.failed:
+                self._slots.release()
+                break
+
+            size = self.max_size
+            if self._inflight_size:
+                size = max(min(size, self.window - self._inflight_size), 1)
+            chunks, size = self._take(size)
+            if not self._buffered:
+                self._ready.clear()
+            if self._buffered < self.max_size:
+                self._writable.set()
+
+            task = asyncio.ensure_future(self._send(self._next_seq, chunks, size))
+            self._next_seq += 1
+            self._inflight.add(task)
+            self._inflight_size += size
+
+    def _take(self, size: int) -> Tuple[List[Segment], int]:
+        chunks = []
+        taken = 0
+        while taken < size and self._chunks:
+            chunk = self._chunks[0]
+            if taken + len(chunk) <= size:
+                chunks.append(self._chunks.popleft())
+                taken += len(chunk)
+            else:
+                # Split without copying; the rest stays queued as a view.
+                view = memoryview(chunk)
+                chunks.append(view[:size - taken])
+                self._chunks[0] = view[size - taken:]
+                taken = size
+        self._buffered -= taken
+        return chunks, taken
+
+    async def _send(self, seq: int, chunks: List[Segment], size: int):
+        try:
+            window = await self.request(seq, chunks)
+            if window is not None:
+                self.window = window
+        except Exception as e:
+            if not isinstance(e, ConnectionClosedError):
+                logger.error(f"Push failed: {e!r}")
+            self._fail()
+        finally:
+            self._inflight.discard(asyncio.current_task())
+            self._inflight_size -= size
+            self._acked.set()
+            self._slots.release()
+            if not self._inflight and not self._buffered:
+                self._idle.set()
+
+    def _fail(self):
+        self.failed = True
+        self._chunks.clear()
+        self._buffered = 0
+        self._acked.set()
+        self._writable.set()
+        self._idle.set()
+
+    async def flush(self) -> bool:
+        await self._idle.wait()
+        return not self.failed
+
+    async def close(self):
+        self._fail()
+        if self._sender is not None:
+            self._sender.cancel()
+        for task in self._inflight:
+            task.cancel()
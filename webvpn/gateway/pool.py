@@ -0,0 +1,147 @@
+from typing import Optional, Dict, Set
+from dataclasses import dataclass, asdict
+import asyncio
+import logging
+import time
+
+import aiohttp
+
+from .gateway import ConnectionClosedError
+
+logger = logging.getLogger(__name__)
+
+# seconds a replaced session is kept open for the requests still using it
+RETIRE_DELAY = 30.0
+
+
+@dataclass
+class PoolStats:
+    requests: int = 0
+    failed: int = 0
+    created: int = 0
+    reused: int = 0
+    queued: int = 0
+
+    def as_dict(self) -> Dict[str, int]:
+        return asdict(self)
+
+
+class SessionPool:
+    def __init__(
+        self,
+        *,
+        limit: int = 100,
+        limit_per_host: int = 0,
+        keepalive_timeout: float = 15.0,
+        cookie_jar: Optional[aiohttp.CookieJar] = None,
+        unsafe_cookies: bool = False,
+    ):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        # Only for an IP or localhost proxy (see is_local_url); a real one keeps aiohttp's checks.
+        self.unsafe_cookies = unsafe_cookies
+
+        self.stats = PoolStats()
+
+        self._cookie_jar = cookie_jar
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._created_at = 0.0
+        self._retired: Set[aiohttp.ClientSession] = set()
+        self.closed = False
+
+    @property
+    def cookie_jar(self) -> aiohttp.CookieJar:
+        if self._cookie_jar is None:
+            self._cookie_jar = self.create_cookie_jar()
+        return self._cookie_jar
+
+    def create_cookie_jar(self) -> aiohttp.CookieJar:
+        return aiohttp.CookieJar(unsafe=self.unsafe_cookies)
+
+    def set_cookie_jar(self, cookie_jar: aiohttp.CookieJar):
+        # Requests from here on use `cookie_jar`; those under way finish on the old session.
+        self._cookie_jar = cookie_jar
+        if self._session is not None:
+            self._retire()
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        # Created lazily: aiohttp sessions and cookie jars must be bound to the running loop.
+        # Once closed, requests still finishing get no new one.
+        if self.closed:
+            raise ConnectionClosedError("Session pool closed")
+        if self._session is None or self._session.closed:
+            self._session = self._create_session()
+            self._created_at = time.monotonic()
+        return self._session
+
+    def recycle(self, before: float):
+        # Replaces the session if it is older than `before`: after an outage its pooled
+        # connections may be half-open. Requests already on it are left to finish.
+        if self._session is not None and self._created_at < before:
+            logger.info("Session pool recycled.")
+            self._retire()
+
+    def _retire(self):
+        session, self._session = self._session, None
+        self._retired.add(session)
+        asyncio.get_running_loop().call_later(RETIRE_DELAY, self._close_retired, session)
+
+    def _close_retired(self, session: aiohttp.ClientSession):
+        if session in self._retired:
+            self._retired.discard(session)
+            asyncio.ensure_future(session.close())
+
+    def _create_session(self) -> aiohttp.ClientSession:
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(self._on_request_start)
+        trace_config.on_request_exception.append(self._on_request_exception)
+        trace_config.on_connection_create_end.append(self._on_connection_create)
+        trace_config.on_connection_reuseconn.append(self._on_connection_reuse)
+        trace_config.on_connection_queued_start.append(self._on_connection_queued)
+
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+        )
+        logger.debug(
+            f"Session pool created: limit={self.limit}, "
+            f"limit_per_host={self.limit_per_host}, keepalive_timeout={self.keepalive_timeout}"
+        )
+        return aiohttp.ClientSession(
+            connector=connector,
+            cookie_jar=self.cookie_jar,
+            timeout=aiohttp.ClientTimeout(total=None),
+            trace_configs=[trace_config],
+        )
+
+    async def _on_request_start(self, session, ctx, params):
+        self.stats.requests += 1
+
+    async def _on_request_exception(self, session, ctx, params):
+        self.stats.failed += 1
+
+    async def _on_connection_create(self, session, ctx, params):
+        self.stats.created += 1
+
+    async def _on_connection_reuse(self, session, ctx, params):
+        self.stats.reused += 1
+
+    async def _on_connection_queued(self, session, ctx, params):
+        self.stats.queued += 1
+
+    def get_stats(self) -> Dict[str, int]:
+        stats = self.stats.as_dict()
+        stats["limit"] = self.limit
+        stats["limit_per_host"] = self.limit_per_host
+        return stats
+
+    async def close(self):
+        self.closed = True
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        while self._retired:
+            await self._retired.pop().close()
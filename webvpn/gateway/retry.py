@@ -0,0 +1,291 @@
+from typing import Optional, Awaitable, Callable, Deque, TypeVar
+from collections import deque
+from enum import Enum
+import asyncio
+import logging
+import random
+import time
+
+import aiohttp
+
+from .gateway import ConnectionClosedError
+from .metrics import registry
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+OPERATIONS = ("token", "push", "pull", "exchange", "keep_alive", "mux", "resume", "close")
+REQUEST_TIME = {
+    op: registry.histogram("webvpn_request_seconds", "Round trip of answered requests", op=op)
+    for op in OPERATIONS
+}
+RETRIES = {
+    op: registry.counter("webvpn_retries_total", "Requests retried after a timeout, redirect or error", op=op)
+    for op in OPERATIONS
+}
+HEDGES = registry.counter("webvpn_hedged_pulls_total", "Duplicate pulls sent for a late one")
+HEDGE_WINS = registry.counter("webvpn_hedged_pull_wins_total", "Hedged pulls answered before the original")
+BREAKER_OPENS = registry.counter("webvpn_breaker_opens_total", "Times the circuit breaker opened")
+
+# Errors of the proxy or the path to it, as opposed to answers.
+FAILURES = (asyncio.TimeoutError, aiohttp.ClientError)
+
+
+class RetriesExhausted(ConnectionClosedError):
+    # No attempt got an answer: the tunnel may well be alive, only out of reach
+    # since `since` (see WebVPNConnection.resume).
+    def __init__(self, op: str, since: float):
+        super().__init__(f"No answer to {op}")
+        self.op = op
+        self.since = since
+
+
+class LatencyTracker:
+    # Recent samples, for quantiles over the last `size` requests.
+    def __init__(self, size: int = 128, min_samples: int = 16):
+        self.samples: Deque[float] = deque(maxlen=size)
+        self.min_samples = min_samples
+
+    def observe(self, seconds: float):
+        self.samples.append(seconds)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if len(self.samples) < self.min_samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+class BreakerState(str, Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    # Shared by every tunnel of a gateway. After `threshold` failures in a row the
+    # proxy is taken to be down: requests wait instead of retrying, and one probe
+    # per `reset_timeout` finds out whether it is back.
+    def __init__(self, threshold: int = 5, reset_timeout: float = 5.0):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+
+        self.state = BreakerState.CLOSED
+        self.failures = 0
+        self._retry_at = 0.0
+        # Made on first wait, in the running loop: breakers may be built before it.
+        self._changed: Optional[asyncio.Event] = None
+
+    def _set_state(self, state: BreakerState):
+        if state != self.state:
+            logger.info(f"Circuit breaker {state.value}.")
+        self.state = state
+        if self._changed is not None:
+            self._changed.set()
+            self._changed = None
+
+    async def allow(self) -> bool:
+        # Whether a request may go out now. While open, waits until the next probe
+        # is due or the state changes, and says no if the proxy is still down.
+        if self.state == BreakerState.CLOSED:
+            return True
+        now = time.monotonic()
+        if now < self._retry_at:
+            if self._changed is None:
+                self._changed = asyncio.Event()
+            try:
+                await asyncio.wait_for(self._changed.wait(), self._retry_at - now)
+            except asyncio.TimeoutError:
+                ...
+            if self.state == BreakerState.CLOSED:
+                return True
+        if time.monotonic() >= self._retry_at:
+            # This caller is the probe; the rest wait for its outcome, or for the next
+            # probe should this one never report.
+            self._retry_at = time.monotonic() + self.reset_timeout
+            self._set_state(BreakerState.HALF_OPEN)
+            return True
+        return False
+
+    def on_success(self):
+        self.failures = 0
+        if self.state != BreakerState.CLOSED:
+            self._set_state(BreakerState.CLOSED)
+
+    def on_failure(self):
+        self.failures += 1
+        if self.state == BreakerState.HALF_OPEN or (
+            self.state == BreakerState.CLOSED and self.failures >= self.threshold
+        ):
+            BREAKER_OPENS.inc()
+            self._retry_at = time.monotonic() + self.reset_timeout
+            self._set_state(BreakerState.OPEN)
+
+
+class RetryPolicy:
+    # One per gateway: retries back off with full jitter, timeouts follow the
+    # proxy's recent round trips, and late long-polls get a hedged duplicate.
+    def __init__(
+        self,
+        *,
+        base_delay: float = 0.02,
+        max_delay: float = 5.0,
+        min_timeout: float = 1.0,
+        max_timeout: float = 5.0,
+        timeout_factor: float = 4.0,
+        hedge: bool = True,
+        hedge_quantile: float = 0.95,
+        min_hedge_delay: float = 0.05,
+        breaker_threshold: int = 5,
+        breaker_reset: float = 5.0,
+    ):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.min_timeout = min_timeout
+        self.max_timeout = max(max_timeout, min_timeout)
+        self.timeout_factor = timeout_factor
+        self.hedge_enabled = hedge
+        self.hedge_quantile = hedge_quantile
+        self.min_hedge_delay = min_hedge_delay
+
+        # Round trips net of any server-side hold.
+        self.rtt = LatencyTracker()
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_reset)
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def get_timeout(self, hold: float = 0.0) -> float:
+        p99 = self.rtt.quantile(0.99)
+        if p99 is None:
+            return hold + self.max_timeout
+        return hold + min(max(p99 * self.timeout_factor, self.min_timeout), self.max_timeout)
+
+    def get_hedge_delay(self, hold: float) -> Optional[float]:
+        # A long-poll answers within its hold plus a round trip; past that it is late.
+        if not self.hedge_enabled or self.breaker.state != BreakerState.CLOSED:
+            return None
+        rtt = self.rtt.quantile(self.hedge_quantile)
+        if rtt is None:
+            return None
+        return hold + max(rtt, self.min_hedge_delay)
+
+    def attempts(
+        self, op: str, limit: int, hold: float = 0.0, deadline: Optional[float] = None
+    ) -> "Attempts":
+        return Attempts(self, op, limit, hold, deadline)
+
+    async def hedge(
+        self,
+        primary: Callable[[], Awaitable[T]],
+        backup: Callable[[], Awaitable[T]],
+        delay: float,
+    ) -> T:
+        # Both calls must be idempotent: whichever answers first is used and the
+        # other is cancelled.
+        tasks = [asyncio.ensure_future(primary())]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                HEDGES.inc()
+                tasks.append(asyncio.ensure_future(backup()))
+
+            pending = set(tasks)
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not tasks[0]:
+                            HEDGE_WINS.inc()
+                        return task.result()
+                    # An answer saying the tunnel is gone is final; only a call that
+                    # got no answer leaves the other one to wait for.
+                    if not isinstance(task.exception(), RetriesExhausted):
+                        raise task.exception()
+                    error = error or task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                if task.done():
+                    _consume(task)
+                else:
+                    task.cancel()
+                    task.add_done_callback(_consume)
+
+
+def _consume(task: asyncio.Future):
+    # Marks a losing or abandoned call's error as retrieved.
+    if not task.cancelled():
+        task.exception()
+
+
+class Attempts:
+    # The attempts of one request:
+    #   while await attempts.next(): send, then answered(status) or failed(error)
+    #   raise attempts.error()
+    def __init__(
+        self, policy: RetryPolicy, op: str, limit: int, hold: float = 0.0, deadline: Optional[float] = None
+    ):
+        self.policy = policy
+        self.op = op
+        self.limit = limit
+        self.hold = hold
+        self.deadline = deadline
+
+        self.count = 0
+        self.since = time.monotonic()
+        self.started_at = 0.0
+        self.exhausted = False
+
+    def _expired(self) -> bool:
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    async def next(self) -> bool:
+        # Time spent waiting on an open breaker uses up attempts, so a request still
+        # gives up in bounded time while the proxy is down.
+        while self.count < self.limit and not self._expired():
+            if self.count > 0:
+                RETRIES[self.op].inc()
+                await asyncio.sleep(self.policy.backoff(self.count - 1))
+            self.count += 1
+            if await self.policy.breaker.allow():
+                self.started_at = time.monotonic()
+                return True
+        self.exhausted = True
+        return False
+
+    def error(self) -> ConnectionClosedError:
+        # Out of attempts, as opposed to an answer saying the tunnel is gone.
+        if self.exhausted:
+            return RetriesExhausted(self.op, self.since)
+        return ConnectionClosedError()
+
+    @property
+    def timeout(self) -> aiohttp.ClientTimeout:
+        # A slow answer is caught by sock_read, which a large body streaming in keeps
+        # resetting; `total` stays as the backstop.
+        return aiohttp.ClientTimeout(
+            total=self.hold + self.policy.max_timeout, sock_read=self.policy.get_timeout(self.hold)
+        )
+
+    def answered(self, status: int) -> bool:
+        # Errors of the proxy in front of the server count against it; our own 503
+        # is an answer (the tunnel is closed).
+        if status >= 500 and status != 503:
+            self.failed(f"HTTP {status}")
+            return False
+        self.policy.breaker.on_success()
+        return True
+
+    def succeeded(self, waited: Optional[float] = 0.0):
+        # `waited`: how long the server may have held the request, None if unknown.
+        elapsed = time.monotonic() - self.started_at
+        REQUEST_TIME[self.op].observe(elapsed)
+        if waited is not None:
+            self.policy.rtt.observe(max(elapsed - waited, 0.0))
+
+    def failed(self, error: object):
+        logger.debug(f"{self.op} attempt {self.count} failed: {error!r}")
+        self.policy.breaker.on_failure()
@@ -1,62 +1,620 @@
-from typing import Optional
+from typing import Optional, AsyncIterator, Deque, Dict, Set
+from collections import OrderedDict, deque
 import asyncio
+import logging
 import time
+import weakref
 
-from .gateway import Gateway, Connection, ConnectionClosedError
+from webvpn.runtime import SocketOptions
+from .buffer import RecvBuffer
+from .buffered import open_connection
+from .compression import TunnelCodec
+from .fair import FairScheduler, Flow, DIRECTIONS
+from .gateway import (
+    Gateway, Connection, Chunk, ConnectionClosedError, InvalidToken, PULL_WAIT, PULLS, PULL_BYTES
+)
+from .metrics import registry
+
+logger = logging.getLogger(__name__)
+
+UPSTREAM_PAUSES = registry.counter(
+    "webvpn_upstream_paused_total", "Upstream reads paused at the receive buffer's high watermark"
+)
+LAZY_ISSUED = registry.counter("webvpn_lazy_tokens_issued_total", "Tokens issued without an upstream yet")
+LAZY_CLAIMED = registry.counter("webvpn_lazy_tokens_claimed_total", "Lazy tokens connected on first use")
+REDELIVERED = registry.counter("webvpn_redelivered_chunks_total", "Unacknowledged chunks sent again after a resume")
+UNACKED_EVICTED = registry.counter(
+    "webvpn_unacked_evicted_total", "Unacknowledged chunks dropped from a full resume buffer"
+)
+
+# Occupancy is summed on scrape only, over every gateway of the process.
+TCP_GATEWAYS: "weakref.WeakSet[TCPGateway]" = weakref.WeakSet()
+registry.gauge(
+    "webvpn_recv_buffered_bytes", "Upstream bytes waiting to be pulled",
+    fn=lambda: sum(conn.recv_buffer.size for gateway in TCP_GATEWAYS for conn in gateway._connected()),
+)
+registry.gauge(
+    "webvpn_send_buffered_bytes", "Pushed bytes not yet written upstream",
+    fn=lambda: sum(conn.get_send_buffered() for gateway in TCP_GATEWAYS for conn in gateway._connected()),
+)
+registry.gauge(
+    "webvpn_unacked_bytes", "Pulled bytes kept until the client acknowledges them",
+    fn=lambda: sum(conn.unacked_size for gateway in TCP_GATEWAYS for conn in gateway._connected()),
+)
+registry.gauge(
+    "webvpn_lazy_tokens", "Lazy tokens waiting to be claimed",
+    fn=lambda: sum(
+        len(gateway.connections) - sum(1 for _ in gateway._connected()) for gateway in TCP_GATEWAYS
+    ),
+)
+
+PULL_REPLAY_SIZE = 64
+READ_SIZE = 256 * 1024
+
+
+def _time_out(waiter: asyncio.Future):
+    if not waiter.done():
+        waiter.set_result(False)
 
 
 class TCPConnection(Connection):
+    __slots__ = (
+        "reader", "writer", "username", "codec", "pull_flow", "push_flow", "recv_buffer", "reader_task",
+        "pull_seq", "pull_replay", "pull_parked", "pull_epoch",
+        "acking", "unacked", "unacked_size", "unacked_from", "resume_buffer", "redeliver", "resumes",
+        "push_seq", "push_pending", "push_pending_size", "send_window", "push_lock", "push_offset",
+    )
+
     def __init__(
         self,
         reader: asyncio.StreamReader,
         writer: asyncio.StreamWriter,
         username: str,
+        *,
+        recv_buffer_high: int = 4 * 1024 * 1024,
+        recv_buffer_low: int = 1024 * 1024,
+        send_window: int = 4 * 1024 * 1024,
+        resume_buffer: int = 4 * 1024 * 1024,
+        pull_flow: Optional[Flow] = None,
+        push_flow: Optional[Flow] = None,
+        codec: Optional[TunnelCodec] = None,
     ):
         super().__init__(closed=False)
 
         self.reader = reader
         self.writer = writer
         self.username = username
+        # Negotiated at /token: push bodies arrive and pulled chunks leave encoded.
+        self.codec = codec
+        # This tunnel's share of the server's bandwidth (see FairScheduler).
+        self.pull_flow = pull_flow
+        self.push_flow = push_flow
 
-    async def push(self, data: bytes):
+        # Upstream is drained continuously into a bounded buffer; reads pause at the
+        # high watermark so a slow client back-pressures the upstream socket.
+        self.recv_buffer = RecvBuffer(recv_buffer_high, recv_buffer_low)
+        self.reader_task = asyncio.ensure_future(self._read_upstream())
+
+        # Downstream chunks are numbered in the order they leave the buffer, and
+        # recent responses are remembered per request seq so that retries are idempotent.
+        self.pull_seq = 0
+        self.pull_replay: "OrderedDict[int, Chunk]" = OrderedDict()
+        self.pull_parked: Set[asyncio.Future] = set()
+        self.pull_epoch = 0
+
+        # Chunks pulled but not yet acknowledged, kept (up to `resume_buffer` bytes) so
+        # that a client that lost its session can resume without losing them. Nothing
+        # is kept until the client first acknowledges: older clients never do.
+        self.acking = False
+        self.unacked: "OrderedDict[int, bytes]" = OrderedDict()
+        self.unacked_size = 0
+        self.unacked_from = 0
+        self.resume_buffer = resume_buffer
+        self.redeliver: Optional[Deque[Chunk]] = None     # only after a resume
+        self.resumes = 0
+
+        # Pushes may arrive out of order; they are applied strictly by seq. Bytes held
+        # here or in the upstream transport count against the advertised window.
+        self.push_seq = 0
+        self.push_pending: Dict[int, bytes] = {}
+        self.push_pending_size = 0
+        self.send_window = send_window
+        # The push next in line may be streamed upstream over several writes; the lock
+        # keeps a retry of it from interleaving, and the offset lets the retry skip
+        # what an interrupted attempt already wrote.
+        self.push_lock = asyncio.Lock()
+        self.push_offset = 0
+
+    async def _read_upstream(self):
+        try:
+            while True:
+                if not self.recv_buffer.writable:
+                    UPSTREAM_PAUSES.inc()
+                await self.recv_buffer.wait_writable()
+                data = await self.reader.read(READ_SIZE)
+                if not data:
+                    break
+                self.recv_buffer.feed(data)
+        except (ConnectionError, OSError) as e:
+            logger.debug(f"Upstream read failed: {e!r}")
+        finally:
+            self.recv_buffer.feed_eof()
+
+    async def push(self, data: bytes, seq: Optional[int] = None):
         self.update()
         if self.closed:
             raise ConnectionClosedError()
+
+        if seq is None or seq >= self.push_seq:
+            if self.codec is not None:
+                data = self.codec.decode(data)
+            if self.push_flow is not None:
+                await self.push_flow.acquire(len(data), partial=False)
+
+        if seq is None:
+            self.writer.write(data)
+        elif seq == self.push_seq and self.push_lock.locked():
+            # Being streamed by another request; wait for it and drop what it wrote.
+            async with self.push_lock:
+                if seq == self.push_seq:
+                    self._write_pushed(data[self.push_offset:])
+        elif seq >= self.push_seq and seq not in self.push_pending:
+            if seq == self.push_seq:
+                data = data[self.push_offset:]
+            self.push_pending[seq] = data
+            self.push_pending_size += len(data)
+            self._flush_pending()
+
+        await self._drain()
+
+    def _write_pushed(self, data: bytes):
         self.writer.write(data)
+        self.push_seq += 1
+        self.push_offset = 0
+        self._flush_pending()
+
+    def _flush_pending(self):
+        while self.push_seq in self.push_pending:
+            data = self.push_pending.pop(self.push_seq)
+            self.push_pending_size -= len(data)
+            self.writer.write(data)
+            self.push_seq += 1
+
+    async def _drain(self):
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            self.closed = True
+            raise ConnectionClosedError()
+
+    async def push_stream(self, chunks: AsyncIterator[bytes], seq: Optional[int] = None) -> int:
+        self.update()
+        if self.closed:
+            raise ConnectionClosedError()
 
-    async def pull(self, n: int) -> bytes:
+        if seq is not None and seq != self.push_seq:
+            # Out of order: it has to wait in push_pending as a whole anyway.
+            return await super().push_stream(chunks, seq)
+        if self.codec is not None:
+            chunks = self.codec.decode_stream(chunks)
+
+        # Next in line: each chunk goes upstream as it arrives, and the request body is
+        # only read as fast as upstream drains.
+        async with self.push_lock:
+            if seq is not None and seq != self.push_seq:
+                # A retry of a push that another request has finished meanwhile.
+                async for _ in chunks:
+                    ...
+                return 0
+
+            skip = self.push_offset if seq is not None else 0
+            size = 0
+            async for chunk in chunks:
+                size += len(chunk)
+                if skip >= len(chunk):
+                    skip -= len(chunk)
+                    continue
+                if skip:
+                    chunk, skip = chunk[skip:], 0
+                if self.push_flow is not None:
+                    await self.push_flow.acquire(len(chunk), partial=False)
+                self.writer.write(chunk)
+                if seq is not None:
+                    self.push_offset += len(chunk)
+                await self._drain()
+
+            if seq is not None:
+                self._write_pushed(b"")
+        await self._drain()
+        return size
+
+    def get_send_buffered(self) -> int:
+        return self.writer.transport.get_write_buffer_size() + self.push_pending_size
+
+    def get_send_window(self) -> int:
+        return max(self.send_window - self.get_send_buffered(), 0)
+
+    async def _wait_readable(self, epoch: int, hold: Optional[float]):
+        loop = asyncio.get_running_loop()
+        deadline = None if hold is None else loop.time() + hold
+
+        while not self.recv_buffer.ready and epoch == self.pull_epoch:
+            timeout = None if deadline is None else deadline - loop.time()
+            if timeout is not None and timeout <= 0:
+                return
+
+            # The hold is a timer on the waiter itself (its result False), which is
+            # cheaper than wait_for's wrapper future and callbacks on every parked pull.
+            waiter = loop.create_future()
+            timer = None if timeout is None else loop.call_at(deadline, _time_out, waiter)
+            self.pull_parked.add(waiter)
+            self.recv_buffer.add_waiter(waiter)
+            try:
+                if await waiter is False:
+                    return
+            finally:
+                if timer is not None:
+                    timer.cancel()
+                self.pull_parked.discard(waiter)
+                self.recv_buffer.remove_waiter(waiter)
+                if (
+                    waiter.done() and not waiter.cancelled() and waiter.result() is None
+                    and self.recv_buffer.ready
+                ):
+                    # Woken but going away without reading: pass the turn on.
+                    self.recv_buffer.wake_one()
+
+    async def pull(self, n: int, hold: Optional[float] = None) -> bytes:
         self.update()
         if self.closed:
             raise ConnectionClosedError()
 
-        data = await self.reader.read(n)
-        if not data:
+        await self._wait_readable(self.pull_epoch, hold)
+        if self.pull_flow is not None and self.recv_buffer.size:
+            n = await self.pull_flow.acquire(min(n, self.recv_buffer.size))
+
+        data = self.recv_buffer.read(n)
+        if not data and self.recv_buffer.eof:
             self.closed = True
+        if self.codec is not None:
+            data = self.codec.encode(data)
         return data
 
+    def ack(self, seq: int):
+        # The client has every chunk below `seq`.
+        self.acking = True
+        seq = min(seq, self.pull_seq)
+        while self.unacked and next(iter(self.unacked)) < seq:
+            _, data = self.unacked.popitem(last=False)
+            self.unacked_size -= len(data)
+        self.unacked_from = max(self.unacked_from, seq)
+
+    def _retain(self, chunk: Chunk):
+        if not self.acking:
+            self.unacked_from = self.pull_seq
+            return
+        self.unacked[chunk.seq] = chunk.data
+        self.unacked_size += len(chunk.data)
+        while self.unacked_size > self.resume_buffer:
+            # Past the bound the oldest chunks go, and with them resuming from before them.
+            _, data = self.unacked.popitem(last=False)
+            self.unacked_size -= len(data)
+            UNACKED_EVICTED.inc()
+            self.unacked_from = next(iter(self.unacked), self.pull_seq)
+
+    def resume(self, ack: int) -> Optional[int]:
+        if self.closed and not self.unacked:
+            return None
+        if not self.unacked_from <= ack <= self.pull_seq:
+            return None
+
+        self.ack(ack)
+        # Whatever was answered to the old session is sent again, in order, to the pulls
+        # that follow; pulls still parked for the old session leave empty-handed.
+        self.redeliver = deque(Chunk(seq, data) for seq, data in self.unacked.items())
+        REDELIVERED.inc(len(self.redeliver))
+        self.pull_replay.clear()
+        self.resumes += 1
+        self.supersede()
+        return self.push_seq
+
+    async def pull_chunk(
+        self, n: int, seq: int, hold: Optional[float] = None, ack: Optional[int] = None
+    ) -> Chunk:
+        self.update()
+        if ack is not None:
+            self.ack(ack)
+
+        chunk = self.pull_replay.get(seq)
+        if chunk is not None:
+            return chunk
+
+        while self.redeliver and self.redeliver[0].seq < self.unacked_from:
+            self.redeliver.popleft()    # acknowledged since, through the old session
+        if self.redeliver:
+            chunk = self._encode(self.redeliver.popleft())
+            self.pull_replay[seq] = chunk
+            return chunk
+
+        if self.closed:
+            raise ConnectionClosedError()
+
+        resumes = self.resumes
+        await self._wait_readable(self.pull_epoch, hold)
+        if self.pull_flow is not None and self.recv_buffer.size:
+            # Bulk transfers take turns with other users' here.
+            n = await self.pull_flow.acquire(min(n, self.recv_buffer.size))
+        if resumes != self.resumes:
+            return Chunk(-1, b"")
+
+        # Another pull may have answered this seq (a retry) while we were parked.
+        chunk = self.pull_replay.get(seq)
+        if chunk is not None:
+            return chunk
+
+        data = self.recv_buffer.read(n)
+        if not data and self.recv_buffer.eof:
+            self.closed = True
+            return Chunk(-1, data)
+
+        if data:
+            chunk = Chunk(self.pull_seq, data)
+            self.pull_seq += 1
+            self._retain(chunk)
+            chunk = self._encode(chunk)
+        else:
+            chunk = Chunk(-1, data)
+
+        # Empty answers are kept too: a duplicate of this request (a retry, or a hedged
+        # pull sent while it was late) must not take data the client will never see.
+        self.pull_replay[seq] = chunk
+        if len(self.pull_replay) > PULL_REPLAY_SIZE:
+            self.pull_replay.popitem(last=False)
+
+        return chunk
+
+    def _encode(self, chunk: Chunk) -> Chunk:
+        # Kept raw for resuming, answered (and replayed) encoded.
+        if self.codec is None:
+            return chunk
+        return Chunk(chunk.seq, self.codec.encode(chunk.data))
+
+    def supersede(self):
+        # Release parked pulls so the caller's exchange can take the next data.
+        self.pull_epoch += 1
+        for waiter in self.pull_parked:
+            if not waiter.done():
+                waiter.set_result(None)
+
     async def close(self):
+        if self.codec is not None:
+            logger.info(f"Compression of {self.username}'s tunnel: {self.codec.get_stats()}")
         self.closed = True
+        for flow in (self.pull_flow, self.push_flow):
+            if flow is not None:
+                flow.close()
+        self.reader_task.cancel()
         if not self.writer.is_closing():
             await self.writer.drain()
             self.writer.close()
         await self.writer.wait_closed()
 
 
+class LazyConnection(Connection):
+    # A token issued ahead of use. Until its first push or pull it holds no socket,
+    # task or buffer, only where to connect; keep-alives just stamp it.
+    __slots__ = ("host", "port", "username", "compression", "claim")
+
+    def __init__(self, host: str, port: int, username: str, ttl: float, compression: Optional[str] = None):
+        super().__init__(closed=False, ttl=ttl)
+
+        self.host = host
+        self.port = port
+        self.username = username
+        self.compression = compression
+        self.claim: Optional[asyncio.Future] = None
+
+    async def push(self, data: bytes, seq: Optional[int] = None):
+        raise ConnectionClosedError()
+
+    async def pull(self, n: int, hold: Optional[float] = None) -> bytes:
+        raise ConnectionClosedError()
+
+    def supersede(self):
+        ...
+
+    async def close(self):
+        self.closed = True
+
+
 class TCPGateway(Gateway):
-    def __init__(self):
-        super().__init__(expire_time=20)
+    def __init__(
+        self,
+        *,
+        recv_buffer_high: int = 4 * 1024 * 1024,
+        recv_buffer_low: int = 1024 * 1024,
+        send_window: int = 4 * 1024 * 1024,
+        token_prefix: str = "",
+        socket_options: SocketOptions = SocketOptions(),
+        io: str = "stream",
+        lazy_ttl: float = 600.0,
+        expire_time: float = 120.0,
+        resume_buffer: int = 4 * 1024 * 1024,
+        schedulers: Optional[Dict[str, FairScheduler]] = None,
+    ):
+        super().__init__(expire_time=expire_time, token_prefix=token_prefix)
+
+        self.recv_buffer_high = recv_buffer_high
+        self.recv_buffer_low = recv_buffer_low
+        self.send_window = send_window
+        self.resume_buffer = resume_buffer
+        self.socket_options = socket_options
+        self.io = io
+        self.lazy_ttl = lazy_ttl
+        self.draining = False
+        # One per direction, shared by every tunnel; without limits they only count.
+        self.schedulers = schedulers or {direction: FairScheduler(direction) for direction in DIRECTIONS}
+        TCP_GATEWAYS.add(self)
+
+    def _connected(self):
+        return (conn for conn in self.connections.values() if isinstance(conn, TCPConnection))
+
+    async def open_connection(
+        self, host: str, port: int, username: str, lazy: bool = False, compression: Optional[str] = None
+    ) -> Optional[str]:
+        if self.draining:
+            return None
+
+        if lazy:
+            LAZY_ISSUED.inc()
+            return super().open_connection(LazyConnection(host, port, username, self.lazy_ttl, compression))
+
+        conn = await self._connect(host, port, username, compression)
+        if conn is None:
+            return None
+        return super().open_connection(conn)
+
+    async def _connect(
+        self, host: str, port: int, username: str, compression: Optional[str] = None
+    ) -> Optional[TCPConnection]:
+        if self.draining:
+            return None
 
-    async def open_connection(self, host: str, port: int, username: str) -> Optional[str]:
         try:
-            future = asyncio.open_connection(host, port)
+            future = open_connection(host, port, io=self.io)
             reader, writer = await asyncio.wait_for(future, timeout=5)
-        except ConnectionRefusedError:
+        except (OSError, asyncio.TimeoutError) as e:
+            # Refused, unreachable, unresolvable or timed out alike.
+            logger.debug(f"Failed to connect to {host}:{port}: {e!r}")
             return None
-        except asyncio.TimeoutError:
+        self.socket_options.apply(writer.get_extra_info("socket"))
+
+        return TCPConnection(
+            reader, writer, username,
+            recv_buffer_high=self.recv_buffer_high,
+            recv_buffer_low=self.recv_buffer_low,
+            send_window=self.send_window,
+            resume_buffer=self.resume_buffer,
+            pull_flow=self.schedulers["pull"].flow(username),
+            push_flow=self.schedulers["push"].flow(username),
+            codec=TunnelCodec(compression) if compression else None,
+        )
+
+    async def _claim(self, token: str) -> bool:
+        conn = self.connections.get(token)
+        if not isinstance(conn, LazyConnection):
+            return True
+        # Concurrent first requests (a pull and a push) share one connect, which runs
+        # to the end even if they are cancelled.
+        if conn.claim is None:
+            conn.claim = asyncio.ensure_future(self._connect_lazy(token, conn))
+        return await asyncio.shield(conn.claim)
+
+    async def _connect_lazy(self, token: str, lazy: LazyConnection) -> bool:
+        conn = await self._connect(lazy.host, lazy.port, lazy.username, lazy.compression)
+        if self.connections.get(token) is not lazy:
+            # Expired or closed while connecting.
+            if conn is not None:
+                await conn.close()
+            return False
+        if conn is None:
+            logger.info(f"Lazy connection failed: {lazy.username}:{token} -> {lazy.host}:{lazy.port}")
+            await self.close(token)
+            return False
+
+        LAZY_CLAIMED.inc()
+        self.connections[token] = conn
+        self._schedule(token, conn)
+        return True
+
+    async def push(self, token: str, data: bytes, seq: Optional[int] = None) -> bool:
+        if not await self._claim(token):
+            return False
+        return await super().push(token, data, seq)
+
+    async def push_stream(
+        self, token: str, chunks: AsyncIterator[bytes], seq: Optional[int] = None
+    ) -> bool:
+        if not await self._claim(token):
+            return False
+        return await super().push_stream(token, chunks, seq)
+
+    async def pull(self, token: str, n: int = 1024, hold: Optional[float] = None) -> Optional[bytes]:
+        if not await self._claim(token):
             return None
+        return await super().pull(token, n, hold)
 
-        conn = TCPConnection(reader, writer, username)
-        return super().open_connection(conn)
+    async def pull_chunk(
+        self, token: str, seq: int, n: int = 1024, hold: Optional[float] = None, ack: Optional[int] = None
+    ) -> Optional[Chunk]:
+        # Sequenced pulls are the server's alone: a claimed token is a TCPConnection.
+        if not await self._claim(token):
+            return None
+        if token not in self.connections:
+            raise InvalidToken()
+
+        conn = self.connections[token]
+        started_at = time.monotonic()
+        try:
+            chunk = await conn.pull_chunk(n, seq, hold, ack)
+        except ConnectionClosedError:
+            await self.close(token)
+            return None
+
+        PULL_WAIT.observe(time.monotonic() - started_at)
+        if chunk.data:
+            PULLS.inc()
+            PULL_BYTES.inc(len(chunk.data))
+        return chunk
+
+    async def resume(self, token: str, ack: int) -> Optional[int]:
+        if not await self._claim(token):
+            return None
+        return await super().resume(token, ack)
+
+    async def drain(self, timeout: float):
+        self.draining = True
+        # Pushed bytes still queued for upstream get until `timeout` to go out.
+        flushes = [conn.writer.drain() for conn in self._connected() if not conn.closed]
+        try:
+            await asyncio.wait_for(asyncio.gather(*flushes, return_exceptions=True), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Drain timed out.")
+        for token in list(self.connections):
+            await self.close(token)
+        for scheduler in self.schedulers.values():
+            scheduler.close()
+
+    def supersede(self, token: str):
+        if token in self.connections:
+            self.connections[token].supersede()
+
+    def get_send_window(self, token: str) -> int:
+        conn = self.connections.get(token)
+        if not isinstance(conn, TCPConnection):
+            return 0
+        return conn.get_send_window()
+
+    def get_buffered(self, token: str) -> int:
+        conn = self.connections.get(token)
+        if not isinstance(conn, TCPConnection):
+            return 0
+        return conn.recv_buffer.size
+
+    def get_usage(self) -> Dict[str, Dict[str, float]]:
+        # Per user with live tunnels, for capacity planning: live tokens, bytes moved,
+        # current rates and time spent throttled, per direction.
+        usage: Dict[str, Dict[str, float]] = {}
+        for conn in self.connections.values():
+            stats = usage.setdefault(conn.username, {"tokens": 0})
+            stats["tokens"] += 1
+        for direction, scheduler in self.schedulers.items():
+            for user in scheduler.users.values():
+                stats = usage.setdefault(user.name, {"tokens": 0})
+                stats[f"{direction}_bytes"] = user.bytes
+                stats[f"{direction}_rate"] = round(user.meter.get())
+                stats[f"{direction}_throttled"] = round(user.throttled, 3)
+        return usage
 
     def get_username(self, token: str) -> Optional[str]:
         if token not in self.connections:
@@ -0,0 +1,118 @@
+from typing import Dict
+from enum import Enum
+import logging
+import math
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class TrafficMode(str, Enum):
+    INTERACTIVE = "interactive"
+    BULK = "bulk"
+
+
+class TunnelTuner:
+    def __init__(
+        self,
+        *,
+        max_body_size: int = 1024 * 1024,
+        interactive_size: int = 64 * 1024,
+        bulk_rate: float = 256 * 1024,
+        max_hold: float = 5.0,
+        bulk_hold: float = 1.0,
+        coalesce_delay: float = 0.002,
+        bulk_coalesce_delay: float = 0.01,
+        tau: float = 1.0,
+    ):
+        self.max_body_size = max_body_size
+        self.interactive_size = min(interactive_size, max_body_size)
+        self.bulk_rate = bulk_rate
+        self.max_hold = max_hold
+        self.bulk_hold = min(bulk_hold, max_hold)
+        self.base_coalesce_delay = coalesce_delay
+        self.bulk_coalesce_delay = max(bulk_coalesce_delay, coalesce_delay)
+        self.tau = tau
+
+        self.mode = TrafficMode.INTERACTIVE
+        self.rate = 0.0     # bytes per second, exponentially decayed
+        self.counters: Dict[str, int] = {
+            "pushes": 0,
+            "push_bytes": 0,
+            "pulls": 0,
+            "pull_bytes": 0,
+            "mode_switches": 0,
+        }
+
+        self._updated_at = time.monotonic()
+
+    def refresh(self):
+        # Let the rate decay while the tunnel is quiet so an idle bulk tunnel falls back.
+        self._observe(0)
+
+    @property
+    def pull_size(self) -> int:
+        return self.max_body_size if self.mode == TrafficMode.BULK else self.interactive_size
+
+    @property
+    def read_size(self) -> int:
+        return self.pull_size
+
+    @property
+    def push_size(self) -> int:
+        return self.max_body_size
+
+    @property
+    def hold(self) -> float:
+        # Idle and interactive tunnels park long to save requests; bulk tunnels cycle
+        # faster so the pull window can follow the transfer.
+        return self.bulk_hold if self.mode == TrafficMode.BULK else self.max_hold
+
+    @property
+    def coalesce_delay(self) -> float:
+        if self.mode == TrafficMode.BULK:
+            return self.bulk_coalesce_delay
+        return self.base_coalesce_delay
+
+    def _observe(self, n: int):
+        now = time.monotonic()
+        decay = math.exp(-(now - self._updated_at) / self.tau)
+        self.rate = self.rate * decay + n / self.tau
+        self._updated_at = now
+
+        if self.mode == TrafficMode.INTERACTIVE:
+            if n and (self.rate >= self.bulk_rate or n >= self.interactive_size):
+                self._switch(TrafficMode.BULK)
+        elif self.rate < self.bulk_rate / 4:
+            self._switch(TrafficMode.INTERACTIVE)
+
+    def _switch(self, mode: TrafficMode):
+        self.mode = mode
+        self.counters["mode_switches"] += 1
+        logger.debug(
+            f"Tunnel switched to {mode.value}: rate={self.rate:.0f}B/s, "
+            f"pull_size={self.pull_size}, hold={self.hold}, coalesce_delay={self.coalesce_delay}"
+        )
+
+    def on_push(self, n: int):
+        self.counters["pushes"] += 1
+        self.counters["push_bytes"] += n
+        self._observe(n)
+
+    def on_pull(self, n: int):
+        if n == 0:
+            return
+        self.counters["pulls"] += 1
+        self.counters["pull_bytes"] += n
+        self._observe(n)
+
+    def get_stats(self) -> Dict:
+        stats = dict(self.counters)
+        stats.update(
+            mode=self.mode.value,
+            rate=round(self.rate),
+            pull_size=self.pull_size,
+            hold=self.hold,
+            coalesce_delay=self.coalesce_delay,
+        )
+        return stats
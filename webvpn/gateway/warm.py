@@ -0,0 +1,96 @@
+from typing import Optional, Awaitable, Callable, Deque, Tuple
+from collections import deque
+import asyncio
+import logging
+import time
+
+from .metrics import registry
+
+logger = logging.getLogger(__name__)
+
+HITS = registry.counter("webvpn_prewarm_hits_total", "Connections opened from a pre-issued token")
+MISSES = registry.counter("webvpn_prewarm_misses_total", "Connections opened while no token was ready")
+ISSUED = registry.counter("webvpn_prewarm_issued_total", "Tokens issued ahead of use")
+DISCARDED = registry.counter("webvpn_prewarm_discarded_total", "Pre-issued tokens that went stale unused")
+
+RETRY_DELAY = (1, 2, 5, 10, 30, 60)     # seconds
+
+
+class WarmPool:
+    # Connections to one destination, logged in and holding a lazy token, kept
+    # ready to be claimed. The server keeps such tokens for LAZY_TOKEN_TTL without
+    # an upstream socket; ones older than `ttl` are replaced before that.
+    def __init__(self, factory: Callable[[], Awaitable], *, size: int = 2, ttl: float = 300.0):
+        self.factory = factory
+        self.size = size
+        self.ttl = ttl
+
+        self.ready: Deque[Tuple[float, object]] = deque()     # (issued at, connection)
+        self.disabled = False
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+
+    def take(self):
+        self._drop_stale()
+        if self.ready:
+            HITS.inc()
+            _, conn = self.ready.popleft()
+        else:
+            MISSES.inc()
+            conn = None
+        self.start()
+        return conn
+
+    def start(self):
+        if self.disabled:
+            return
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._refill())
+        self._wakeup.set()
+
+    def _drop_stale(self):
+        now = time.monotonic()
+        while self.ready and self.ready[0][0] + self.ttl <= now:
+            _, conn = self.ready.popleft()
+            DISCARDED.inc()
+            asyncio.ensure_future(conn.close())
+
+    async def _refill(self):
+        failures = 0
+        while not self.disabled:
+            self._drop_stale()
+            while len(self.ready) < self.size and not self.disabled:
+                try:
+                    conn = await self.factory()
+                except Exception as e:
+                    logger.warning(f"Pre-issuing a token failed: {e!r}")
+                    await asyncio.sleep(RETRY_DELAY[min(failures, len(RETRY_DELAY) - 1)])
+                    failures += 1
+                    continue
+
+                failures = 0
+                if not conn.lazy:
+                    # An eager token pins an upstream socket and expires within seconds
+                    # unless used: not worth keeping around.
+                    logger.warning("The server does not issue lazy tokens; pre-warming is off.")
+                    self.disabled = True
+                    await conn.close()
+                    break
+                ISSUED.inc()
+                self.ready.append((time.monotonic(), conn))
+
+            # Sleep until the oldest token goes stale or a claim wants a replacement.
+            delay = self.ready[0][0] + self.ttl - time.monotonic() if self.ready else self.ttl
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(delay, 0))
+            except asyncio.TimeoutError:
+                ...
+
+    async def close(self):
+        self.disabled = True
+        if self._task is not None:
+            self._task.cancel()
+        while self.ready:
+            _, conn = self.ready.popleft()
+            await conn.close()
@@ -1,212 +1,760 @@
-from typing import Optional
+from typing import Optional, Dict, List, Tuple
+from dataclasses import dataclass
+from functools import partial
 import asyncio
 import logging
+import time
 
 import aiohttp
+from aiohttp.payload import Payload
 
-from webvpn.login import buaa_webvpn_login, get_cookie_jar_path
+from webvpn.login import LOGIN_URL_1, LOGIN_URL_2, is_local_url
+from .auth import Credentials
+from .compression import TunnelCodec, parse_codecs
 from .gateway import Gateway, Connection, ConnectionClosedError
+from .metrics import registry
+from .mux import MuxScheduler, Frame, FrameType, PULL_SIZE
+from .pipeline import PullWindow, PushPipeline, Segment
+from .pool import SessionPool, PoolStats
+from .retry import RetryPolicy, RetriesExhausted, BreakerState, FAILURES
+from .tuning import TunnelTuner
+from .warm import WarmPool
 
 logger = logging.getLogger(__name__)
 
-TEST_MODE = False
+DEFAULT_BASE_URL = "https://d.buaa.edu.cn/http-23381/77726476706e69737468656265737421a1a70fce72612600305add"
 
-if TEST_MODE:
-    TOKEN_URL = "http://127.0.0.1:8000/token"
-    PUSH_URL = "http://127.0.0.1:8000/push"
-    PULL_URL = "http://127.0.0.1:8000/pull"
-    KEEP_ALIVE_URL = "http://127.0.0.1:8000/keep-alive"
-else:
-    BASE_URL = "https://d.buaa.edu.cn"
-    TOKEN_URL = BASE_URL + "/http-23381/77726476706e69737468656265737421a1a70fce72612600305add/token"
-    PUSH_URL = BASE_URL + "/http-23381/77726476706e69737468656265737421a1a70fce72612600305add/push"
-    PULL_URL = BASE_URL + "/http-23381/77726476706e69737468656265737421a1a70fce72612600305add/pull"
-    KEEP_ALIVE_URL = BASE_URL + "/http-23381/77726476706e69737468656265737421a1a70fce72612600305add/keep-alive"
 
-RETRY_DELAY = [10, 20, 30, 100, 200, 1000, 2000, 3000, 4000, 5000]    # ms
+@dataclass(frozen=True)
+class Endpoints:
+    token: str
+    push: str
+    pull: str
+    keep_alive: str
+    mux: str
+    exchange: str
+    resume: str
+    close: str
+
+    @classmethod
+    def from_base_url(cls, base_url: str) -> "Endpoints":
+        base_url = base_url.rstrip("/")
+        return cls(
+            token=base_url + "/token",
+            push=base_url + "/push",
+            pull=base_url + "/pull",
+            keep_alive=base_url + "/keep-alive",
+            mux=base_url + "/mux",
+            exchange=base_url + "/exchange",
+            resume=base_url + "/resume",
+            close=base_url + "/close",
+        )
+
+
+REDIRECTS = registry.counter("webvpn_redirects_total", "Requests redirected to the login page")
+RESUMES = registry.counter("webvpn_tunnel_resumes_total", "Tunnels reattached after their requests went unanswered")
+RESUME_FAILURES = registry.counter("webvpn_tunnel_resume_failures_total", "Tunnels that could not be reattached")
+
+# Resumes one request may trigger before its tunnel is given up.
+MAX_RESUMES = 3
+
+
+def get_window(rsp: aiohttp.ClientResponse) -> Optional[int]:
+    window = rsp.headers.get("X-Window")
+    return int(window) if window is not None else None
+
+
+async def get_code(rsp: aiohttp.ClientResponse) -> int:
+    # Servers with the ASGI fast path send the status in a header; older ones only in JSON.
+    code = rsp.headers.get("X-Code")
+    if code is not None:
+        return int(code)
+    return (await rsp.json())["code"]
+
+
+class ChunksPayload(Payload):
+    # A push body written out chunk by chunk with a known Content-Length, so it is
+    # never joined into one buffer and can be resent on retry.
+    def __init__(self, chunks: List[Segment]):
+        super().__init__(chunks, content_type="application/octet-stream")
+        self._size = sum(len(chunk) for chunk in chunks)
+
+    def decode(self, encoding: str = "utf-8", errors: str = "strict") -> str:
+        return b"".join(self._value).decode(encoding, errors)
+
+    async def write(self, writer):
+        for chunk in self._value:
+            await writer.write(chunk)
 
 
 class WebVPNConnection(Connection):
-    def __init__(self, username: str, password: str, host: str, port: str):
+    def __init__(
+        self,
+        credentials: Credentials,
+        host: str,
+        port: str,
+        pool: SessionPool,
+        endpoints: Endpoints,
+        *,
+        pull_window: Tuple[int, int] = (1, 8),
+        recv_window: int = 4 * 1024 * 1024,
+        push_inflight: int = 4,
+        push_coalesce_delay: float = 0.002,
+        mux: Optional[MuxScheduler] = None,
+        exchange_hold: Optional[float] = None,
+        tuner: Optional[TunnelTuner] = None,
+        push_stream: bool = True,
+        retry: Optional[RetryPolicy] = None,
+        resume_timeout: Optional[float] = None,
+        compression: str = "",
+    ):
         super().__init__(closed=False)
 
-        self.username = username
-        self.password = password
+        self.credentials = credentials
+        self.username = credentials.username
         self.host = host
         self.port = port
 
-        timeout = aiohttp.ClientTimeout(total=0)
-        self.cookie_jar = aiohttp.CookieJar()
-        self.cookie_jar.load(get_cookie_jar_path())
-        self.session = aiohttp.ClientSession(timeout=timeout, cookie_jar=self.cookie_jar)
-        self.timeout = aiohttp.ClientTimeout(total=5)
+        self.pool = pool
+        self.endpoints = endpoints
+        self.mux = mux
+        self.exchange_hold = exchange_hold
+        self.push_stream = push_stream
+        self.retry = retry if retry is not None else RetryPolicy()
+        self.tuner = tuner if tuner is not None else TunnelTuner(coalesce_delay=push_coalesce_delay)
 
         self.token: Optional[str] = None
+        self.lazy = False
+        # Codecs offered at /token, and the one the server picked, if any.
+        self.compression = compression
+        self.codec: Optional[TunnelCodec] = None
+
+        # How long a tunnel whose requests gave up keeps trying to reattach; None never does.
+        self.resume_timeout = resume_timeout
+        self.resumes = 0
+        self._resumed_at = 0.0
+        self._resuming: Optional[asyncio.Future] = None
+
+        min_window, max_window = pull_window
+        self.pull_window = PullWindow(
+            partial(self._resumable, self._pull_request),
+            min_window=min_window, max_window=max_window, recv_window=recv_window,
+        )
+        push_request = self._push_request
+        if mux is None and exchange_hold is not None:
+            push_request = self._exchange_request
+        self.push_pipeline = PushPipeline(
+            partial(self._resumable, push_request),
+            max_inflight=push_inflight,
+            coalesce_delay=self.tuner.coalesce_delay,
+            max_size=self.tuner.push_size,
+        )
+
+    async def login(self, generation: int) -> bool:
+        # Concurrent redirects from many tunnels collapse into one shared login.
+        return await self.credentials.refresh(generation)
+
+    async def _mux_call(self, type_: FrameType, rid: int, payload: bytes = b"", seq: int = -1) -> Frame:
+        frame = await self.mux.call(Frame(type_, self.token, rid, seq, payload))
+        if frame.type == FrameType.INVALID:
+            logger.error("invalid token.")
+            raise ConnectionClosedError()
+        elif frame.type == FrameType.CLOSED:
+            logger.error("Connection closed. (mux)")
+            raise ConnectionClosedError()
+        return frame
 
-    async def login(self) -> bool:
-        if not await buaa_webvpn_login(self.username, self.password):
-            return False
-
-        self.cookie_jar.load(get_cookie_jar_path())
-        logger.debug("Cookie loaded.")
-
-        return True
-
-    async def get_token(self):
+    async def get_token(self, lazy: bool = False):
         params = {
             "username": self.username,
             "host": self.host,
             "port": self.port,
         }
-
-        retry_count = 0
-        while retry_count < 5:
+        if lazy:
+            params["lazy"] = 1
+        codecs = parse_codecs(self.compression)
+        if codecs:
+            params["compress"] = ",".join(codecs)
+
+        attempts = self.retry.attempts("token", 5)
+        while await attempts.next():
+            generation = self.credentials.generation
             try:
                 async with self.session.get(
-                    TOKEN_URL, params=params, timeout=self.timeout, allow_redirects=False
+                    self.endpoints.token, params=params, timeout=attempts.timeout, allow_redirects=False
                 ) as rsp:
+                    if not attempts.answered(rsp.status):
+                        continue
                     if rsp.status == 302:   # redirect
-                        await self.login()
+                        REDIRECTS.inc()
+                        await self.login(generation)
                     elif rsp.status == 200:
+                        attempts.succeeded()
                         data = await rsp.json()
                         if data["code"] == 0:
                             self.token = data["data"]["token"]
+                            # Older servers ignore `lazy` and connect upstream at once,
+                            # and `compress`, leaving bodies as they are.
+                            self.lazy = data["data"].get("lazy", False)
+                            compression = data["data"].get("compression")
+                            self.codec = TunnelCodec(compression) if compression else None
                             logger.info(f"Token: {self.token}")
                             return
                         else:
                             logger.error(data["message"])
                             break
-            except asyncio.TimeoutError:
-                ...
-
-            await asyncio.sleep(1)
-            retry_count += 1
+            except FAILURES as e:
+                attempts.failed(e)
 
         raise RuntimeError("Failed to get token")
 
-    async def push(self, data: bytes):
+    async def _resumable(self, request, *args):
+        # Pulls and pushes are idempotent per seq, so one that got no answer is sent
+        # again as it was once the tunnel is reattached.
+        resumes = 0
+        while True:
+            try:
+                return await request(*args)
+            except RetriesExhausted as e:
+                if resumes >= MAX_RESUMES or not await self.resume(e.since):
+                    raise
+                resumes += 1
+
+    async def resume(self, since: float) -> bool:
+        # One resume at a time, shared by every request that failed before it began.
+        if self.resume_timeout is None or self.closed:
+            return False
+        if self._resumed_at > since:
+            return True
+        if self._resuming is None:
+            self._resuming = asyncio.ensure_future(self._resume(since))
+        return await asyncio.shield(self._resuming)
+
+    async def _resume(self, since: float) -> bool:
+        started_at = time.monotonic()
+        try:
+            # Connections pooled before the outage may be stuck on the dead path.
+            self.pool.recycle(since)
+
+            # Bounded by the deadline rather than a count.
+            attempts = self.retry.attempts("resume", 1000, deadline=started_at + self.resume_timeout)
+            while await attempts.next():
+                generation = self.credentials.generation
+                # Everything received so far is acknowledged; the rest is sent again.
+                params = {"token": self.token, "ack": self.pull_window.ack}
+                try:
+                    async with self.session.get(
+                        self.endpoints.resume, params=params, timeout=attempts.timeout, allow_redirects=False
+                    ) as rsp:
+                        if not attempts.answered(rsp.status):
+                            continue
+                        if rsp.status == 302:   # redirect
+                            REDIRECTS.inc()
+                            if not await self.login(generation):
+                                break
+                        elif rsp.status == 200:
+                            attempts.succeeded()
+                            if await get_code(rsp) == 0:
+                                push_seq = (await rsp.json())["data"]["push_seq"]
+                                logger.info(f"Tunnel resumed: {self.token} (ack {params['ack']}, push {push_seq})")
+                                self.resumes += 1
+                                self._resumed_at = started_at
+                                RESUMES.inc()
+                                return True
+                            break
+                        else:   # 400: expired; 404: a server without /resume
+                            break
+                except FAILURES as e:
+                    attempts.failed(e)
+
+            logger.info(f"Failed to resume tunnel {self.token}.")
+            RESUME_FAILURES.inc()
+            return False
+        finally:
+            self._resuming = None
+
+    async def push(self, data: bytes, seq: Optional[int] = None):
+        # Sequence numbers are assigned by the push pipeline.
         self.update()
 
         if self.closed:
             raise ConnectionClosedError()
 
-        params = {"token": self.token}
+        self.tuner.on_push(len(data))
+        self.push_pipeline.coalesce_delay = self.tuner.coalesce_delay
 
-        retry_count = 0
-        done = False
-        while retry_count < 10:
+        try:
+            await self.push_pipeline.put(data)
+        except ConnectionClosedError:
+            self.closed = True
+            logger.info("Connection closed. (push)")
+            raise
+
+    def _decode(self, data: bytes) -> bytes:
+        return data if self.codec is None else self.codec.decode(data)
+
+    async def _push_request(self, seq: int, chunks: List[Segment]) -> Optional[int]:
+        if self.codec is not None:
+            chunks = [self.codec.encode(b"".join(chunks))]
+        if self.mux is not None:
+            frame = await self._mux_call(FrameType.PUSH, seq, b"".join(chunks))
+            return frame.seq if frame.seq >= 0 else None
+
+        params = {"token": self.token, "seq": seq}
+        size = sum(len(chunk) for chunk in chunks)
+
+        attempts = self.retry.attempts("push", 10)
+        while await attempts.next():
+            generation = self.credentials.generation
             try:
+                # A fresh payload per attempt: aiohttp may close the one it sent.
+                data = ChunksPayload(chunks) if self.push_stream else b"".join(chunks)
                 async with self.session.post(
-                    PUSH_URL, params=params, data=data,
-                    timeout=self.timeout, allow_redirects=False
+                    self.endpoints.push, params=params, data=data,
+                    timeout=attempts.timeout, allow_redirects=False
                 ) as rsp:
+                    if not attempts.answered(rsp.status):
+                        continue
                     if rsp.status == 302:   # redirect
+                        REDIRECTS.inc()
                         logger.info("Redirect to login.")
-                        await self.login()
+                        await self.login(generation)
                     elif rsp.status == 200:
-                        data = await rsp.json()
-                        if data["code"] == 0:
-                            logger.debug(f"Push successfully. {len(data)} bytes.")
-                            done = True
+                        attempts.succeeded()
+                        if await get_code(rsp) == 0:
+                            logger.debug(f"Push successfully. {size} bytes.")
+                            return get_window(rsp)
                         break
-            except asyncio.TimeoutError:
-                ...
-
-            await asyncio.sleep(RETRY_DELAY[retry_count] / 1000)
-            retry_count += 1
+            except FAILURES as e:
+                attempts.failed(e)
+
+        raise attempts.error()
+
+    async def _exchange_request(self, seq: int, chunks: List[Segment]) -> Optional[int]:
+        data = b"".join(chunks)
+        if self.codec is not None:
+            data = self.codec.encode(data)
+        pseq = self.pull_window.begin_external()
+        try:
+            params = {
+                "token": self.token,
+                "seq": seq,
+                "pseq": pseq,
+                "n": self.pull_window.chunk_size,
+                "hold": self.exchange_hold,
+                "ack": self.pull_window.ack,
+            }
+
+            attempts = self.retry.attempts("exchange", 10, hold=self.exchange_hold)
+            while await attempts.next():
+                generation = self.credentials.generation
+                try:
+                    async with self.session.post(
+                        self.endpoints.exchange, params=params, data=data,
+                        timeout=attempts.timeout, allow_redirects=False
+                    ) as rsp:
+                        if not attempts.answered(rsp.status):
+                            continue
+                        if rsp.status == 302:   # redirect
+                            REDIRECTS.inc()
+                            logger.info("Redirect to login.")
+                            await self.login(generation)
+                        elif rsp.status == 200:
+                            rsp_data = await rsp.read()
+                            attempts.succeeded(waited=None if rsp_data else self.exchange_hold)
+                            logger.debug(
+                                f"Exchange successfully. {len(data)} bytes up, {len(rsp_data)} bytes down."
+                            )
+                            self.pull_window.feed(int(rsp.headers.get("X-Seq", -1)), self._decode(rsp_data))
+                            return get_window(rsp)
+                        elif rsp.status == 400:
+                            logger.error("invalid token.")
+                            break
+                        elif rsp.status == 503:
+                            logger.error("Connection closed. (503)")
+                            break
+                except FAILURES as e:
+                    attempts.failed(e)
 
-        if not done:
-            self.closed = True
-            logger.info("Connection closed. (push)")
-            raise ConnectionClosedError()
+            raise attempts.error()
+        finally:
+            # Hold off our own long-poll briefly: a follow-up exchange is likely.
+            self.pull_window.end_external(linger=self.exchange_hold)
 
-    async def pull(self, n: int) -> bytes:
+    async def pull(self, n: int, hold: Optional[float] = None) -> bytes:
+        # The pull window long-polls the server by itself; `hold` is not used here.
         self.update()
 
         if self.closed:
             raise ConnectionClosedError()
 
-        params = {"token": self.token, "n": n}
+        self.tuner.refresh()
+        data = await self.pull_window.get(min(n, self.tuner.pull_size))
+        if data is None:
+            self.closed = True
+            logger.info("Connection closed. (pull)")
+            raise ConnectionClosedError()
+
+        self.tuner.on_pull(len(data))
+        return data
 
-        retry_count = 0
-        done = False
-        while retry_count < 10:
+    async def _pull_request(self, seq: int, n: int) -> Tuple[int, bytes]:
+        if self.mux is not None:
+            frame = await self._mux_call(FrameType.PULL, seq, PULL_SIZE.pack(n), self.pull_window.ack)
+            return frame.seq, self._decode(frame.payload)
+
+        hold = self.tuner.hold
+        delay = self.retry.get_hedge_delay(hold)
+        if delay is None:
+            return await self._pull_once(seq, n, hold)
+        # Late past its hold: ask again without holding. The server answers a request
+        # id once (see TCPConnection.pull_chunk), so both get the same chunk.
+        return await self.retry.hedge(
+            lambda: self._pull_once(seq, n, hold), lambda: self._pull_once(seq, n, 0), delay
+        )
+
+    async def _pull_once(self, seq: int, n: int, hold: float) -> Tuple[int, bytes]:
+        params = {"token": self.token, "n": n, "seq": seq, "hold": hold, "ack": self.pull_window.ack}
+
+        attempts = self.retry.attempts("pull", 10, hold=hold)
+        while await attempts.next():
+            generation = self.credentials.generation
             try:
                 async with self.session.get(
-                    PULL_URL, params=params, timeout=self.timeout, allow_redirects=False
+                    self.endpoints.pull, params=params, timeout=attempts.timeout, allow_redirects=False
                 ) as rsp:
+                    if not attempts.answered(rsp.status):
+                        continue
                     if rsp.status == 302:   # redirect
+                        REDIRECTS.inc()
                         logger.info("Redirect to login.")
-                        await self.login()
+                        await self.login(generation)
                     elif rsp.status == 200:
                         data = await rsp.read()
-                        done = True
+                        # An empty answer waited out the hold; how long one with data
+                        # waited is not known.
+                        attempts.succeeded(waited=None if data else hold)
                         logger.debug(f"Pull successfully. {len(data)} bytes.")
-                        break
+                        return int(rsp.headers.get("X-Seq", -1)), self._decode(data)
                     elif rsp.status == 400:
                         logger.error("invalid token.")
                         break
                     elif rsp.status == 503:
                         logger.error("Connection closed. (503)")
                         break
-            except asyncio.TimeoutError:
-                ...
-
-            await asyncio.sleep(RETRY_DELAY[retry_count] / 1000)
-            retry_count += 1
+            except FAILURES as e:
+                attempts.failed(e)
 
-        if not done:
-            self.closed = True
-            logger.info("Connection closed. (pull)")
-            raise ConnectionClosedError()
-
-        return data
+        raise attempts.error()
 
     async def keep_alive(self) -> bool:
         if self.closed:
             return False
 
+        if self.mux is not None:
+            try:
+                await self._mux_call(FrameType.KEEP_ALIVE, -1)
+            except ConnectionClosedError:
+                self.closed = True
+            return await super().keep_alive()
+
         params = {"token": self.token}
 
-        retry_count = 0
-        while retry_count < 5:
+        attempts = self.retry.attempts("keep_alive", 5)
+        while await attempts.next():
+            generation = self.credentials.generation
             try:
                 async with self.session.get(
-                    KEEP_ALIVE_URL, params=params, timeout=self.timeout, allow_redirects=False
+                    self.endpoints.keep_alive, params=params, timeout=attempts.timeout, allow_redirects=False
                 ) as rsp:
+                    if not attempts.answered(rsp.status):
+                        continue
                     if rsp.status == 302:   # redirect
+                        REDIRECTS.inc()
                         logger.info("Redirect to login.")
-                        await self.login()
+                        await self.login(generation)
                     elif rsp.status == 200:
-                        data = await rsp.json()
+                        attempts.succeeded()
+                        code = await get_code(rsp)
                         logger.debug("Keep alive successfully.")
-                        if data["code"] != 0:
+                        if code != 0:
                             logger.info("Failed to keep alive.")
                             self.closed = True
                         break
-            except asyncio.TimeoutError:
-                ...
+            except FAILURES as e:
+                attempts.failed(e)
 
-            await asyncio.sleep(1)
-            retry_count += 1
+        return await super().keep_alive()
 
-        return super().keep_alive()
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        return self.pool.session
+
+    async def release(self):
+        # Best effort: a tunnel the server does not hear about expires after its TUNNEL_TTL.
+        if self.pool.closed or self.retry.breaker.state != BreakerState.CLOSED:
+            return
+        attempts = self.retry.attempts("close", 1)
+        while await attempts.next():
+            try:
+                async with self.session.get(
+                    self.endpoints.close, params={"token": self.token},
+                    timeout=attempts.timeout, allow_redirects=False
+                ) as rsp:
+                    # Anything else (a redirect, or 404 from a server without /close) is left be.
+                    if attempts.answered(rsp.status) and rsp.status == 200:
+                        attempts.succeeded()
+                        logger.debug(f"Tunnel released: {self.token}")
+                    return
+            except FAILURES as e:
+                attempts.failed(e)
 
     async def close(self):
+        # The session is owned by the gateway's pool and shared with other tunnels.
+        release = False
+        if not self.closed:
+            # Ended on this side: once its pushes are through, the server need not
+            # keep the tunnel around for a resume.
+            release = await self.push_pipeline.flush() and self.token is not None
         self.closed = True
-        await self.session.close()
+        await self.push_pipeline.close()
+        self.pull_window.close()
+        if release:
+            await self.release()
 
 
 class WebVPNGateway(Gateway):
+    def __init__(
+        self,
+        *,
+        base_url: str = DEFAULT_BASE_URL,
+        require_login: bool = True,
+        login_url: str = LOGIN_URL_1,
+        submit_url: str = LOGIN_URL_2,
+        pool_size: int = 100,
+        pool_limit_per_host: int = 0,
+        pool_keepalive_timeout: float = 15.0,
+        login_ttl: float = 1800.0,
+        pull_window: Tuple[int, int] = (1, 8),
+        recv_window: int = 4 * 1024 * 1024,
+        push_inflight: int = 4,
+        push_coalesce_delay: float = 0.002,
+        mux: bool = False,
+        mux_inflight: int = 4,
+        exchange: bool = False,
+        exchange_hold: float = 0.1,
+        max_body_size: int = 1024 * 1024,
+        max_hold: float = 5.0,
+        push_stream: bool = True,
+        prewarm: int = 0,
+        prewarm_ttl: float = 300.0,
+        retry: Optional[RetryPolicy] = None,
+        resume_timeout: Optional[float] = None,
+        compression: str = "",
+    ):
+        super().__init__()
+
+        self.endpoints = Endpoints.from_base_url(base_url)
+        # A local server (tests, benchmarks) is reached directly, without the SSO login.
+        self.require_login = require_login
+        self.login_url = login_url
+        self.submit_url = submit_url
+
+        # One per user: the SSO session lives in the cookies, so each user's requests
+        # go out on a session, and cookie jar, of their own.
+        self.pool_size = pool_size
+        self.pool_limit_per_host = pool_limit_per_host
+        self.pool_keepalive_timeout = pool_keepalive_timeout
+        self.unsafe_cookies = is_local_url(base_url) or is_local_url(login_url)
+        self.pools: Dict[str, SessionPool] = {}
+        self.login_ttl = login_ttl
+        self.pull_window = pull_window
+        self.recv_window = recv_window
+        self.push_inflight = push_inflight
+        self.push_coalesce_delay = push_coalesce_delay
+        self.credentials: Dict[str, Credentials] = {}
+
+        self.use_mux = mux
+        self.mux_inflight = mux_inflight
+        # One per user: a batch goes out on the session of the user of its tunnels.
+        self.muxes: Dict[str, MuxScheduler] = {}
+
+        self.exchange_hold = exchange_hold if exchange else None
+
+        self.max_body_size = max_body_size
+        self.max_hold = max_hold
+        self.push_stream = push_stream
+        # Shared by all tunnels: their latencies and failures all describe the same proxy.
+        self.retry = retry if retry is not None else RetryPolicy()
+        self.resume_timeout = resume_timeout
+        self.compression = compression
+
+        # Connections with a token issued ahead of use, per (username, host, port).
+        self.prewarm = prewarm
+        self.prewarm_ttl = prewarm_ttl
+        self.warm_pools: Dict[Tuple[str, str, int], WarmPool] = {}
+
+    def get_pool(self, username: str) -> SessionPool:
+        pool = self.pools.get(username)
+        if pool is None:
+            pool = SessionPool(
+                limit=self.pool_size,
+                limit_per_host=self.pool_limit_per_host,
+                keepalive_timeout=self.pool_keepalive_timeout,
+                unsafe_cookies=self.unsafe_cookies,
+            )
+            self.pools[username] = pool
+        return pool
+
+    def get_credentials(self, username: str, password: str) -> Credentials:
+        credentials = self.credentials.get(username)
+        if credentials is None or credentials.password != password:
+            credentials = Credentials(
+                username, password, self.get_pool(username),
+                ttl=self.login_ttl, login_url=self.login_url, submit_url=self.submit_url,
+            )
+            self.credentials[username] = credentials
+        return credentials
+
+    def get_warm_pool(self, host: str, port: int, username: str, password: str) -> WarmPool:
+        key = (username, host, port)
+        pool = self.warm_pools.get(key)
+        if pool is None:
+            pool = WarmPool(
+                lambda: self._create_connection(host, port, username, password, lazy=True),
+                size=self.prewarm, ttl=self.prewarm_ttl,
+            )
+            self.warm_pools[key] = pool
+        return pool
+
+    def warm_up(self, host: str, port: int, username: str, password: str):
+        if self.prewarm > 0:
+            self.get_warm_pool(host, port, username, password).start()
+
     async def open_connection(
         self, host: str, port: int, username: str, password: str
     ) -> Optional[str]:
-        conn = WebVPNConnection(username, password, host, port)
+        conn = None
+        if self.prewarm > 0:
+            conn = self.get_warm_pool(host, port, username, password).take()
+        if conn is None:
+            conn = await self._create_connection(host, port, username, password)
+
+        return super().open_connection(conn)
 
-        if not TEST_MODE:
-            if not await conn.login():
+    async def _create_connection(
+        self, host: str, port: int, username: str, password: str, lazy: bool = False
+    ) -> WebVPNConnection:
+        credentials = self.get_credentials(username, password)
+
+        mux = None
+        if self.use_mux:
+            mux = self.muxes.get(username)
+            if mux is None:
+                mux = MuxScheduler(
+                    partial(self._mux_request, username),
+                    max_inflight=self.mux_inflight, max_size=self.max_body_size,
+                )
+                self.muxes[username] = mux
+
+        conn = WebVPNConnection(
+            credentials, host, port, credentials.pool, self.endpoints,
+            pull_window=self.pull_window,
+            recv_window=self.recv_window,
+            push_inflight=self.push_inflight,
+            push_coalesce_delay=self.push_coalesce_delay,
+            mux=mux,
+            exchange_hold=self.exchange_hold,
+            tuner=TunnelTuner(
+                max_body_size=self.max_body_size,
+                max_hold=self.max_hold,
+                coalesce_delay=self.push_coalesce_delay,
+            ),
+            push_stream=self.push_stream,
+            retry=self.retry,
+            resume_timeout=self.resume_timeout,
+            compression=self.compression,
+        )
+
+        if self.require_login:
+            if not await credentials.ensure():
                 await conn.close()
                 raise RuntimeError("Failed to login")
-        await conn.get_token()
+        await conn.get_token(lazy)
 
-        return super().open_connection(conn)
+        return conn
+
+    async def _mux_request(self, username: str, body: bytes, hold: float) -> bytes:
+        credentials = self.credentials[username]
+        params = {"hold": hold}
+
+        attempts = self.retry.attempts("mux", 10, hold=hold)
+        while await attempts.next():
+            generation = credentials.generation
+            try:
+                async with credentials.pool.session.post(
+                    self.endpoints.mux, params=params, data=body, timeout=attempts.timeout, allow_redirects=False
+                ) as rsp:
+                    if not attempts.answered(rsp.status):
+                        continue
+                    if rsp.status == 302:   # redirect
+                        REDIRECTS.inc()
+                        logger.info("Redirect to login.")
+                        await credentials.refresh(generation)
+                    elif rsp.status == 200:
+                        # How long a batch was held is not known here.
+                        attempts.succeeded(waited=None)
+                        return await rsp.read()
+            except FAILURES as e:
+                attempts.failed(e)
+
+        raise attempts.error()
+
+    def get_read_size(self, token: str) -> int:
+        if token not in self.connections:
+            return self.max_body_size
+        return self.connections[token].tuner.read_size
+
+    def get_tuning_stats(self) -> Dict[str, Dict]:
+        return {token: conn.tuner.get_stats() for token, conn in self.connections.items()}
+
+    def get_compression_stats(self) -> Dict[str, Dict]:
+        return {
+            token: conn.codec.get_stats() for token, conn in self.connections.items() if conn.codec is not None
+        }
+
+    def get_pool_stats(self):
+        stats = PoolStats().as_dict()
+        for pool in self.pools.values():
+            for key, value in pool.stats.as_dict().items():
+                stats[key] += value
+        stats["limit"] = self.pool_size
+        stats["limit_per_host"] = self.pool_limit_per_host
+        stats["sessions"] = len(self.pools)
+        stats["connections"] = len(self.connections)
+        stats["logins"] = sum(c.logins for c in self.credentials.values())
+        stats["logins_coalesced"] = sum(c.coalesced for c in self.credentials.values())
+        if self.muxes:
+            stats["mux_requests"] = sum(mux.requests for mux in self.muxes.values())
+            stats["mux_frames"] = sum(mux.frames for mux in self.muxes.values())
+        return stats
+
+    async def drain(self, timeout: float):
+        flushes = [
+            conn.push_pipeline.flush()
+            for conn in self.connections.values() if not conn.closed
+        ]
+        try:
+            await asyncio.wait_for(asyncio.gather(*flushes, return_exceptions=True), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Drain timed out.")
+
+    async def shutdown(self):
+        for pool in self.warm_pools.values():
+            await pool.close()
+        # Each releases its tunnel with a request of its own.
+        await asyncio.gather(*[self.close(token) for token in list(self.connections)])
+        for mux in self.muxes.values():
+            mux.close()
+        for pool in self.pools.values():
+            await pool.close()
@@ -1,8 +1,14 @@
+from typing import Optional
+from urllib.parse import quote
+import asyncio
+import copy
+import ipaddress
 import logging
 from pathlib import Path
 
 import aiohttp
 from bs4 import BeautifulSoup
+from yarl import URL
 
 logger = logging.getLogger(__name__)
 
@@ -10,40 +16,112 @@ LOGIN_URL_1 = r"https://sso.buaa.edu.cn/login?service=https%3A%2F%2Fd.buaa.edu.c
 LOGIN_URL_2 = r"https://sso.buaa.edu.cn/login"
 
 
-def get_cookie_jar_path() -> Path:
+def is_local_url(url: str) -> bool:
+    # An IP or localhost, e.g. a local simulator: its cookies need an `unsafe` jar.
+    host = URL(url).host or ""
+    if host == "localhost":
+        return True
+    try:
+        ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return True
+
+
+def get_cookie_jar_path(login_url: str = LOGIN_URL_1, username: Optional[str] = None) -> Path:
     config_dir = Path.home() / ".config" / "webvpn-py"
     if not config_dir.exists():
         config_dir.mkdir(parents=True)
-    return config_dir / "buaa-webvpn.cookie"
+    if login_url == LOGIN_URL_1:
+        name = "buaa-webvpn"
+    else:
+        # Any other SSO (e.g. the simulator) keeps its cookies apart from the real ones.
+        url = URL(login_url)
+        name = f"webvpn-{url.host}-{url.port}"
+    # Each user has a session of their own, so a file of their own too.
+    if username is not None:
+        name = f"{name}-{quote(username, safe='')}"
+    return config_dir / f"{name}.cookie"
+
+
+def snapshot_cookie_jar(cookie_jar: aiohttp.CookieJar) -> aiohttp.CookieJar:
+    # A copy of the jar as it is now, for a worker thread to save while requests
+    # under way go on updating the original.
+    snapshot = copy.copy(cookie_jar)
+    for name, value in vars(cookie_jar).items():
+        if isinstance(value, (dict, set, list)):
+            setattr(snapshot, name, copy.copy(value))
+    for key, cookie in cookie_jar._cookies.items():
+        snapshot._cookies[key] = copy.copy(cookie)
+    return snapshot
+
+
+async def save_cookie_jar(
+    cookie_jar: aiohttp.CookieJar, login_url: str = LOGIN_URL_1, username: Optional[str] = None
+):
+    path = get_cookie_jar_path(login_url, username)
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, snapshot_cookie_jar(cookie_jar).save, path)
+
+
+async def load_cookie_jar(
+    cookie_jar: aiohttp.CookieJar, login_url: str = LOGIN_URL_1, username: Optional[str] = None
+) -> bool:
+    # Filled in a worker thread, so `cookie_jar` must not be in use yet.
+    path = get_cookie_jar_path(login_url, username)
+    if not path.exists():
+        return False
 
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, cookie_jar.load, path)
+    return True
 
-async def buaa_webvpn_login(username: str, password: str) -> bool:
+
+async def _login(
+    session: aiohttp.ClientSession, username: str, password: str, login_url: str, submit_url: str
+) -> bool:
     timeout = aiohttp.ClientTimeout(total=5)
-    cookie_jar = aiohttp.CookieJar()
-
-    async with aiohttp.ClientSession(timeout=timeout, cookie_jar=cookie_jar) as session:
-        # Get `execution`
-        async with session.get(LOGIN_URL_1) as rsp:
-            soup = BeautifulSoup(await rsp.text(), "html.parser")
-            tag = soup.find("input", {"name": "execution"})
-            assert tag is not None
-            execution = tag["value"]
-
-        data = {
-            "username": username,
-            "password": password,
-            "submit": "登录",
-            "type": "username_password",
-            "execution": execution,
-            "_eventId": "submit",
-        }
-        async with session.post(LOGIN_URL_2, data=data) as rsp:
-            ok = rsp.status == 200
-
-        if ok:
-            cookie_jar.save(get_cookie_jar_path())
-            logger.info(f"Successfully logged in: {username}")
-        else:
-            logger.error(f"Failed to login: {username}")
-
-        return ok
+
+    # Get `execution`
+    async with session.get(login_url, timeout=timeout) as rsp:
+        soup = BeautifulSoup(await rsp.text(), "html.parser")
+        tag = soup.find("input", {"name": "execution"})
+        assert tag is not None
+        execution = tag["value"]
+
+    data = {
+        "username": username,
+        "password": password,
+        "submit": "登录",
+        "type": "username_password",
+        "execution": execution,
+        "_eventId": "submit",
+    }
+    async with session.post(submit_url, data=data, timeout=timeout) as rsp:
+        return rsp.status == 200
+
+
+async def buaa_webvpn_login(
+    username: str,
+    password: str,
+    session: Optional[aiohttp.ClientSession] = None,
+    *,
+    login_url: str = LOGIN_URL_1,
+    submit_url: str = LOGIN_URL_2,
+) -> bool:
+    if session is None:
+        cookie_jar = aiohttp.CookieJar(unsafe=is_local_url(login_url))
+        async with aiohttp.ClientSession(cookie_jar=cookie_jar) as session:
+            return await buaa_webvpn_login(
+                username, password, session, login_url=login_url, submit_url=submit_url
+            )
+
+    ok = await _login(session, username, password, login_url, submit_url)
+
+    if ok:
+        await save_cookie_jar(session.cookie_jar, login_url, username)
+        logger.info(f"Successfully logged in: {username}")
+    else:
+        logger.error(f"Failed to login: {username}")
+
+    return ok
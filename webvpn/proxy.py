@@ -0,0 +1,218 @@
+from typing import Optional, Tuple
+from dataclasses import dataclass
+import asyncio
+import ipaddress
+import logging
+import struct
+
+from .client import Client
+from .gateway.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+PROTOCOLS = ("socks5", "http")
+REQUESTS = {
+    protocol: registry.counter(
+        "webvpn_proxy_requests_total", "Proxy requests per protocol", protocol=protocol
+    )
+    for protocol in PROTOCOLS
+}
+FAILURES = registry.counter("webvpn_proxy_failures_total", "Proxy requests that got no tunnel")
+
+SOCKS_VERSION = 5
+SOCKS_NO_AUTH = 0
+SOCKS_NO_METHOD = 0xFF
+SOCKS_CONNECT = 1
+SOCKS_IPV4, SOCKS_DOMAIN, SOCKS_IPV6 = 1, 3, 4
+# reply codes
+SOCKS_OK = 0
+SOCKS_REFUSED = 5
+SOCKS_BAD_COMMAND = 7
+SOCKS_BAD_ADDRESS = 8
+
+HTTP_OK = b"HTTP/1.1 200 Connection Established\r\n\r\n"
+HTTP_BAD_REQUEST = b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n"
+HTTP_NOT_ALLOWED = b"HTTP/1.1 405 Method Not Allowed\r\nAllow: CONNECT\r\nContent-Length: 0\r\n\r\n"
+HTTP_BAD_GATEWAY = b"HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\n\r\n"
+
+
+class HandshakeError(Exception):
+    # Carries the reply to send before closing, if any.
+    def __init__(self, message: str, reply: bytes = b""):
+        super().__init__(message)
+        self.reply = reply
+
+
+class HandshakeReader:
+    # Exact reads on top of `read()`, which both socket I/O kinds provide. Bytes
+    # the client sent past its request are handed over to the tunnel.
+    def __init__(self, reader, limit: int = 8192):
+        self.reader = reader
+        self.limit = limit
+        self.buffer = bytearray()
+        self.consumed = 0
+
+    async def _fill(self):
+        if self.consumed > self.limit:
+            raise HandshakeError("Request too large")
+        data = await self.reader.read(self.limit)
+        if not data:
+            raise HandshakeError("Connection closed during handshake")
+        self.buffer += data
+
+    async def readexactly(self, n: int) -> bytes:
+        while len(self.buffer) < n:
+            await self._fill()
+        data = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        self.consumed += n
+        return data
+
+    async def readline(self) -> bytes:
+        while True:
+            end = self.buffer.find(b"\n")
+            if end >= 0:
+                return await self.readexactly(end + 1)
+            if len(self.buffer) > self.limit:
+                raise HandshakeError("Request too large")
+            await self._fill()
+
+    def rest(self) -> bytes:
+        return bytes(self.buffer)
+
+
+@dataclass
+class ProxyRequest:
+    protocol: str
+    host: str
+    port: int
+
+
+def socks_reply(code: int) -> bytes:
+    # The bound address is meaningless through the tunnel; report 0.0.0.0:0.
+    return struct.pack("!BBBB4sH", SOCKS_VERSION, code, 0, SOCKS_IPV4, bytes(4), 0)
+
+
+def split_host_port(authority: str) -> Tuple[str, int]:
+    host, sep, port = authority.rpartition(":")
+    if not sep or not port.isdigit():
+        raise ValueError(authority)
+    if host.startswith("[") and host.endswith("]"):
+        host = host[1:-1]
+    if not host or not 0 < int(port) < 65536:
+        raise ValueError(authority)
+    return host, int(port)
+
+
+class ProxyClient(Client):
+    # A dynamic forwarder: every SOCKS5 or HTTP CONNECT request names its own
+    # destination, and all of them share this client's gateway, login and sessions.
+    def __init__(self, *, handshake_timeout: float = 10.0, **kwargs):
+        super().__init__(**kwargs)
+        self.handshake_timeout = handshake_timeout
+
+    def describe(self) -> str:
+        return f"{self.host}:{self.port} (SOCKS5 / HTTP CONNECT proxy)"
+
+    def warm_up(self):
+        # Destinations are only known per request; pools fill once they are used.
+        ...
+
+    async def handshake(self, reader: HandshakeReader, writer: asyncio.StreamWriter) -> ProxyRequest:
+        version = await reader.readexactly(1)
+        if version[0] == SOCKS_VERSION:
+            return await self._socks5_request(reader, writer)
+        return await self._http_request(reader, version)
+
+    async def _socks5_request(self, reader: HandshakeReader, writer: asyncio.StreamWriter) -> ProxyRequest:
+        n_methods = (await reader.readexactly(1))[0]
+        methods = await reader.readexactly(n_methods)
+        if SOCKS_NO_AUTH not in methods:
+            raise HandshakeError("No supported SOCKS5 auth method", bytes([SOCKS_VERSION, SOCKS_NO_METHOD]))
+        # Method selection is answered at once: the client waits for it before its request.
+        writer.write(bytes([SOCKS_VERSION, SOCKS_NO_AUTH]))
+
+        version, command, _, address_type = await reader.readexactly(4)
+        if version != SOCKS_VERSION:
+            raise HandshakeError("Bad SOCKS5 request")
+        if address_type == SOCKS_IPV4:
+            host = str(ipaddress.IPv4Address(await reader.readexactly(4)))
+        elif address_type == SOCKS_IPV6:
+            host = str(ipaddress.IPv6Address(await reader.readexactly(16)))
+        elif address_type == SOCKS_DOMAIN:
+            length = (await reader.readexactly(1))[0]
+            host = (await reader.readexactly(length)).decode("idna")
+        else:
+            raise HandshakeError(f"Unsupported address type: {address_type}", socks_reply(SOCKS_BAD_ADDRESS))
+        port, = struct.unpack("!H", await reader.readexactly(2))
+
+        if command != SOCKS_CONNECT:
+            raise HandshakeError(f"Unsupported SOCKS5 command: {command}", socks_reply(SOCKS_BAD_COMMAND))
+        return ProxyRequest("socks5", host, port)
+
+    async def _http_request(self, reader: HandshakeReader, first: bytes) -> ProxyRequest:
+        line = (first + await reader.readline()).decode("latin-1").strip()
+        # Headers are read and ignored: the request line carries the destination.
+        while (await reader.readline()).strip():
+            ...
+
+        parts = line.split()
+        if len(parts) != 3 or not parts[2].startswith("HTTP/"):
+            raise HandshakeError(f"Bad request: {line!r}", HTTP_BAD_REQUEST)
+        method, authority, _ = parts
+        if method != "CONNECT":
+            raise HandshakeError(f"Unsupported method: {method}", HTTP_NOT_ALLOWED)
+        try:
+            host, port = split_host_port(authority)
+        except ValueError:
+            raise HandshakeError(f"Bad authority: {authority!r}", HTTP_BAD_REQUEST)
+        return ProxyRequest("http", host, port)
+
+    async def conn_handler(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        addr = writer.get_extra_info("peername")
+        self.socket_options.apply(writer.get_extra_info("socket"))
+
+        handshake = HandshakeReader(reader)
+        request: Optional[ProxyRequest] = None
+        try:
+            request = await asyncio.wait_for(
+                self.handshake(handshake, writer), timeout=self.handshake_timeout
+            )
+        except HandshakeError as e:
+            logger.warning(f"Proxy handshake from {addr!r} failed: {e}")
+            if e.reply:
+                writer.write(e.reply)
+        except (asyncio.TimeoutError, ConnectionError, UnicodeError, ValueError) as e:
+            logger.warning(f"Proxy handshake from {addr!r} failed: {e!r}")
+
+        token = None
+        if request is not None:
+            REQUESTS[request.protocol].inc()
+            logger.info(f"Connection established: {addr!r} -> {request.host}:{request.port}")
+            token = await self.open_connection(request.host, request.port)
+            if token is None:
+                FAILURES.inc()
+            if request.protocol == "socks5":
+                writer.write(socks_reply(SOCKS_OK if token is not None else SOCKS_REFUSED))
+            else:
+                writer.write(HTTP_OK if token is not None else HTTP_BAD_GATEWAY)
+
+        if token is None:
+            try:
+                await writer.drain()
+            except ConnectionError:
+                ...
+            writer.close()
+            await writer.wait_closed()
+            return
+
+        rest = handshake.rest()
+        if rest and not await self.gateway.push(token, rest):
+            await self.gateway.close(token)
+            writer.close()
+            await writer.wait_closed()
+            return
+
+        await self.relay(reader, writer, token)
+
+        logger.info(f"Connection closed: {addr!r} -> {request.host}:{request.port}")
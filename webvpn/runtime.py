@@ -0,0 +1,51 @@
+from dataclasses import dataclass
+import logging
+import socket
+
+logger = logging.getLogger(__name__)
+
+LOOPS = ("auto", "asyncio", "uvloop")
+HTTP_PARSERS = ("auto", "h11", "httptools")
+
+
+@dataclass(frozen=True)
+class SocketOptions:
+    nodelay: bool = True
+    sndbuf: int = 0     # 0 keeps the OS default
+    rcvbuf: int = 0
+
+    def apply(self, sock):
+        if sock is None:
+            return
+        if self.nodelay and sock.family in (socket.AF_INET, socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.sndbuf > 0:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+        if self.rcvbuf > 0:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+
+
+def use_uvloop(loop: str) -> bool:
+    if loop not in LOOPS:
+        raise ValueError(f"Unknown event loop: {loop}")
+    if loop == "asyncio":
+        return False
+
+    try:
+        import uvloop   # noqa: F401
+    except ImportError:
+        if loop == "uvloop":
+            raise RuntimeError("uvloop is not installed: pip install 'webvpn[speedups]'")
+        return False
+    return True
+
+
+def get_http_parser(http: str) -> str:
+    if http not in HTTP_PARSERS:
+        raise ValueError(f"Unknown HTTP parser: {http}")
+    if http == "httptools":
+        try:
+            import httptools    # noqa: F401
+        except ImportError:
+            raise RuntimeError("httptools is not installed: pip install 'webvpn[speedups]'")
+    return http
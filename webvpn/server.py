@@ -1,36 +1,127 @@
 from typing import Optional
 import asyncio
+import hmac
 import logging
 
-from fastapi import FastAPI, Response, Depends, Request
+from fastapi import FastAPI, HTTPException, Response, Depends, Request
+from fastapi.responses import PlainTextResponse
 import sentry_sdk
 
-from .gateway import TCPGateway, InvalidToken
+from .config import settings
+from .dataplane import DataPlane, FastPath, Result, REQUESTS
+from .gateway import TCPGateway
+from .gateway.compression import parse_codecs, negotiate
+from .gateway.fair import FairScheduler, DIRECTIONS
+from .gateway.metrics import registry
 from .logger import setup_logger
+from .runtime import SocketOptions
+from .shard import ShardRouter
 
 setup_logger(is_server=True)
 logger = logging.getLogger(__name__)
 
-sentry_sdk.init(
-    "https://e8a30444dfe04196bc925f1c36fffce0@o246548.ingest.sentry.io/6464341",
-    traces_sample_rate=0.5,
+if settings.SENTRY:
+    sentry_sdk.init(
+        "https://e8a30444dfe04196bc925f1c36fffce0@o246548.ingest.sentry.io/6464341",
+        traces_sample_rate=0.5,
+    )
+
+api = FastAPI()
+router = ShardRouter(settings.SHARD, settings.SHARDS, settings.SHARD_SOCKET_DIR)
+gateway = TCPGateway(
+    recv_buffer_high=settings.RECV_BUFFER_HIGH,
+    recv_buffer_low=settings.RECV_BUFFER_LOW,
+    send_window=settings.SEND_WINDOW,
+    token_prefix=router.token_prefix,
+    socket_options=SocketOptions(settings.TCP_NODELAY, settings.SO_SNDBUF, settings.SO_RCVBUF),
+    io=settings.SOCKET_IO,
+    lazy_ttl=settings.LAZY_TOKEN_TTL,
+    expire_time=settings.TUNNEL_TTL,
+    resume_buffer=settings.RESUME_BUFFER,
+    schedulers={
+        direction: FairScheduler(
+            direction,
+            rate=settings.SCHED_RATE,
+            user_rate=settings.USER_RATE,
+            user_burst=settings.USER_BURST,
+            user_rates=settings.USER_RATES,
+            weights=settings.USER_WEIGHTS,
+            quantum=settings.SCHED_QUANTUM,
+            interactive_rate=settings.INTERACTIVE_RATE,
+            interactive_size=settings.INTERACTIVE_SIZE,
+            max_user_labels=settings.USER_LABELS,
+        )
+        for direction in DIRECTIONS
+    },
 )
-
-app = FastAPI()
-gateway = TCPGateway()
-
-asyncio.create_task(gateway.clean())
-
-
-@app.get("/token")
-async def get_token(username: str, host: str, port: int):
-    token = await gateway.open_connection(host, port, username)
-    logger.info(f"new connection: {username}:{token} -> {host}:{port}")
+plane = DataPlane(
+    gateway, router, pull_hold=settings.PULL_HOLD, pull_max_hold=settings.PULL_MAX_HOLD
+)
+fast_path = FastPath(api, plane)
+codecs = parse_codecs(settings.SERVER_COMPRESSION)
+LOOP_LAG = registry.histogram("webvpn_loop_lag_seconds", "How late the event loop woke a periodic timer")
+LOOPBACK = ("127.0.0.1", "::1")
+
+
+async def monitor_loop_lag(interval: float = 0.1):
+    loop = asyncio.get_running_loop()
+    while True:
+        started_at = loop.time()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(loop.time() - started_at - interval, 0.0))
+
+
+@api.on_event("startup")
+async def startup():
+    asyncio.create_task(gateway.clean())
+    asyncio.create_task(monitor_loop_lag())
+    if router.shards > 1:
+        await router.serve(fast_path.serve_forwarded)
+
+
+@api.on_event("shutdown")
+async def shutdown():
+    # uvicorn has stopped accepting and finished in-flight requests by now.
+    await gateway.drain(settings.DRAIN_TIMEOUT)
+    await router.close()
+
+
+async def require_admin(request: Request):
+    # Routes about users and the server are not for the public port: they answer
+    # loopback clients, and others only with the admin token.
+    client = request.client
+    if client is not None and client.host in LOOPBACK:
+        return
+    token = settings.ADMIN_TOKEN
+    if token and hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+        return
+    raise HTTPException(status_code=403)
+
+
+def to_response(result: Result) -> Response:
+    status, headers, body = result
+    return Response(body, status_code=status, headers=headers)
+
+
+@api.get("/token")
+async def get_token(
+    username: str, host: str, port: int, lazy: bool = False, compress: Optional[str] = None
+):
+    # Lazy tokens are issued ahead of use and connect upstream on their first push or pull.
+    # `compress` lists the codecs the client can use, preferred first; the answer names
+    # the one picked, which then encodes every body of the token (see TunnelCodec).
+    REQUESTS["token"].inc()
+    compression = negotiate(compress, codecs)
+    token = await gateway.open_connection(host, port, username, lazy, compression)
+    logger.info(
+        f"new connection: {username}:{token} -> {host}:{port}{' (lazy)' if lazy else ''}"
+        f"{f' ({compression})' if compression else ''}"
+    )
 
     if token:
         return {
             "code": 0,
-            "data": {"token": token},
+            "data": {"token": token, "lazy": lazy, "compression": compression},
         }
     else:
         return {
@@ -39,55 +130,89 @@ async def get_token(username: str, host: str, port: int):
         }
 
 
-@app.get("/keep-alive")
+# The data-plane routes below are served by FastPath unless FAST_PATH is off; they
+# stay here as the fallback and as the baseline `webvpn bench-rps` compares with.
+@api.get("/keep-alive")
 async def keep_alive(token: str):
-    try:
-        if await gateway.keep_alive(token):
-            logger.info(f"keep-alive: {gateway.get_username(token)}:{token}")
-            return {"code": 0}
-        else:
-            return {"code": 2000, "message": "Connection closed (keep_alive)"}
-    except InvalidToken:
-        return Response(status_code=400)
+    return to_response(await plane.keep_alive(token))
 
 
-@app.get(
+@api.get(
     "/pull",
     response_class=Response,
     responses={
         200: {"content": {"application/octet-stream": {}}}
     },
 )
-async def pull(token: str, n: int = 1024):
-    future = gateway.pull(token, n)
+async def pull(
+    token: str,
+    n: int = 1024,
+    seq: Optional[int] = None,
+    hold: Optional[float] = None,
+    ack: Optional[int] = None,
+):
+    return to_response(await plane.pull(token, n, seq, hold, ack))
+
 
-    data = b""
-    try:
-        data = await asyncio.wait_for(future, timeout=2)
-    except asyncio.TimeoutError:
-        ...
-    except InvalidToken:
-        return Response(status_code=400)
+@api.get("/resume")
+async def resume(token: str, ack: int):
+    # Reattaches a tunnel after its client lost its session (see TCPConnection.resume).
+    return to_response(await plane.resume(token, ack))
 
-    if data is None:
-        return Response(status_code=503)    # Connection closed
 
-    if len(data) > 0:
-        logger.info(f"pull {len(data)} bytes: {gateway.get_username(token)}:{token}")
-    return Response(data, media_type="application/octet-stream")
+@api.get("/close")
+async def close(token: str):
+    return to_response(await plane.close(token))
 
 
 async def parse_body(request: Request):
     return await request.body()
 
 
-@app.post("/push")
-async def push(token: str, data: bytes = Depends(parse_body)):
-    try:
-        if await gateway.push(token, data):
-            logger.info(f"push {len(data)} bytes: {gateway.get_username(token)}:{token}")
-            return {"code": 0}
-        else:
-            return {"code": 2000, "message": "Connection closed (push)"}
-    except InvalidToken:
-        return Response(status_code=400)
+@api.post("/push")
+async def push(request: Request, token: str, seq: Optional[int] = None):
+    return to_response(await plane.push(token, request.stream(), seq))
+
+
+@api.post(
+    "/exchange",
+    response_class=Response,
+    responses={
+        200: {"content": {"application/octet-stream": {}}}
+    },
+)
+async def exchange(
+    token: str,
+    pseq: int,
+    seq: Optional[int] = None,
+    n: int = 1024,
+    hold: float = 0.1,
+    ack: Optional[int] = None,
+    data: bytes = Depends(parse_body),
+):
+    return to_response(await plane.exchange(token, pseq, data, seq, n, hold, ack))
+
+
+@api.post(
+    "/mux",
+    response_class=Response,
+    responses={
+        200: {"content": {"application/octet-stream": {}}}
+    },
+)
+async def mux(hold: Optional[float] = None, data: bytes = Depends(parse_body)):
+    return to_response(await plane.mux(data, hold))
+
+
+@api.get("/usage", dependencies=[Depends(require_admin)])
+async def usage():
+    # Per-user totals of this worker; `webvpn_user_*` metrics carry the same.
+    return {"code": 0, "data": gateway.get_usage()}
+
+
+@api.get("/metrics", response_class=PlainTextResponse, dependencies=[Depends(require_admin)])
+async def metrics():
+    return registry.render()
+
+
+app = fast_path if settings.FAST_PATH else api
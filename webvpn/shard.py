@@ -0,0 +1,226 @@
+from typing import Optional, Any, AsyncIterator, Awaitable, Callable, Deque, Dict, List, Tuple, Mapping, Union
+from collections import deque
+import asyncio
+import json
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import shutil
+import signal
+import socket
+import struct
+import tempfile
+
+from .gateway.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+FORWARDED = registry.counter(
+    "webvpn_shard_forwarded_total", "Requests forwarded to the shard owning their token"
+)
+
+# Forwarded requests skip HTTP: over a shard's unix socket, a request is a head
+# (method, path and query as JSON) and its body as length-prefixed chunks ending
+# with an empty one; the answer is a status, headers as JSON, and the body.
+REQUEST_HEAD = struct.Struct("!I")
+CHUNK = struct.Struct("!I")
+RESPONSE_HEAD = struct.Struct("!HII")
+
+# (method, path, query, body chunks) -> (status, headers, body)
+Handler = Callable[
+    [str, str, Dict[str, str], AsyncIterator[bytes]], Awaitable[Tuple[int, Dict[str, str], bytes]]
+]
+Stream = Tuple[asyncio.StreamReader, asyncio.StreamWriter]
+
+
+def get_shard(token: str) -> Optional[int]:
+    prefix, sep, _ = token.partition(".")
+    if not sep or not prefix.isdigit():
+        return None
+    return int(prefix)
+
+
+def get_socket_path(socket_dir: str, shard: int) -> str:
+    return os.path.join(socket_dir, f"shard-{shard}.sock")
+
+
+class ShardRouter:
+    def __init__(self, shard: int = 0, shards: int = 1, socket_dir: str = ""):
+        self.shard = shard
+        self.shards = shards
+        self.socket_dir = socket_dir
+
+        # Idle connections to each shard, reused like keep-alive ones.
+        self._idle: Dict[int, Deque[Stream]] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    @property
+    def token_prefix(self) -> str:
+        return f"{self.shard}." if self.shards > 1 else ""
+
+    @property
+    def socket_path(self) -> str:
+        return get_socket_path(self.socket_dir, self.shard)
+
+    def owner(self, token: str) -> int:
+        shard = get_shard(token)
+        if self.shards <= 1 or shard is None or shard >= self.shards:
+            # Not ours to route: the local gateway reports it as invalid.
+            return self.shard
+        return shard
+
+    def is_local(self, token: str) -> bool:
+        return self.owner(token) == self.shard
+
+    async def _connect(self, shard: int) -> Stream:
+        idle = self._idle.get(shard)
+        while idle:
+            reader, writer = idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer
+            writer.close()
+        return await asyncio.open_unix_connection(get_socket_path(self.socket_dir, shard))
+
+    async def forward(
+        self,
+        shard: int,
+        method: str,
+        path: str,
+        params: Mapping[str, str],
+        body: Union[bytes, AsyncIterator[bytes]],
+    ) -> Tuple[int, Dict[str, str], bytes]:
+        FORWARDED.inc()
+        reader, writer = await self._connect(shard)
+        try:
+            head = json.dumps([method, path, dict(params)]).encode()
+            writer.write(REQUEST_HEAD.pack(len(head)) + head)
+            if isinstance(body, bytes):
+                if body:
+                    writer.write(CHUNK.pack(len(body)) + body)
+            else:
+                # Streamed on as it arrives, as pushes are (see TCPConnection.push_stream).
+                async for chunk in body:
+                    if chunk:   # an empty one would end the body
+                        writer.write(CHUNK.pack(len(chunk)))
+                        writer.write(chunk)
+                        await writer.drain()
+            writer.write(CHUNK.pack(0))
+
+            code, headers_size, size = RESPONSE_HEAD.unpack(await reader.readexactly(RESPONSE_HEAD.size))
+            headers = json.loads(await reader.readexactly(headers_size))
+            data = await reader.readexactly(size)
+        except BaseException:
+            # Cut off mid-request (e.g. cancelled): the stream cannot be reused.
+            writer.close()
+            raise
+        self._idle.setdefault(shard, deque()).append((reader, writer))
+        return code, headers, data
+
+    async def serve(self, handler: Handler):
+        # Requests forwarded to this shard; `handler` answers them as it would over HTTP.
+        async def serve_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            try:
+                while True:
+                    try:
+                        size, = REQUEST_HEAD.unpack(await reader.readexactly(REQUEST_HEAD.size))
+                    except asyncio.IncompleteReadError:
+                        break
+                    method, path, params = json.loads(await reader.readexactly(size))
+                    body = read_chunks(reader)
+                    code, headers, data = await handler(method, path, params, body)
+                    # Whatever of the body the handler left unread goes before the next request.
+                    async for _ in body:
+                        ...
+                    headers = json.dumps(headers).encode()
+                    writer.write(RESPONSE_HEAD.pack(code, len(headers), len(data)) + headers)
+                    writer.write(data)
+                    await writer.drain()
+            except (asyncio.IncompleteReadError, ConnectionError):
+                ...
+            except Exception as e:
+                logger.error(f"Forwarded request failed: {e!r}")
+            finally:
+                writer.close()
+
+        self._server = await asyncio.start_unix_server(serve_connection, self.socket_path)
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        for idle in self._idle.values():
+            for _, writer in idle:
+                writer.close()
+        self._idle.clear()
+
+
+async def read_chunks(reader: asyncio.StreamReader) -> AsyncIterator[bytes]:
+    while True:
+        size, = CHUNK.unpack(await reader.readexactly(CHUNK.size))
+        if not size:
+            return
+        yield await reader.readexactly(size)
+
+
+def create_reuseport_socket(host: str, port: int) -> socket.socket:
+    # IPPROTO_TCP as getaddrinfo would give: asyncio only sets TCP_NODELAY on
+    # connections accepted from a socket that says it is TCP.
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    # Every worker binds the public port; the kernel spreads connections among them.
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    return sock
+
+
+def run_worker(
+    shard: int, shards: int, host: str, port: int, socket_dir: str, options: Dict[str, Any]
+):
+    import uvicorn
+    from .config import settings
+
+    # Must be set before webvpn.server is imported: it builds the gateway from them.
+    settings.set("SHARD", shard)
+    settings.set("SHARDS", shards)
+    settings.set("SHARD_SOCKET_DIR", socket_dir)
+
+    # The shard's unix socket is served by webvpn.server itself (ShardRouter.serve).
+    config = uvicorn.Config("webvpn.server:app", **options)
+    uvicorn.Server(config).run(sockets=[create_reuseport_socket(host, port)])
+
+
+def run_sharded(host: str, port: int, shards: int, options: Dict[str, Any]):
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise RuntimeError("Sharding needs SO_REUSEPORT")
+
+    socket_dir = tempfile.mkdtemp(prefix="webvpn-shards-")
+    ctx = multiprocessing.get_context("spawn")
+    workers: List[multiprocessing.Process] = []
+    for shard in range(shards):
+        worker = ctx.Process(
+            target=run_worker, args=(shard, shards, host, port, socket_dir, options),
+            name=f"webvpn-shard-{shard}",
+        )
+        worker.start()
+        workers.append(worker)
+    logger.info(f"Started {shards} shards on {host}:{port}")
+
+    def stop(signum, frame):
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    try:
+        # A shard that dies takes its tokens with it; stop the rest so the server is
+        # restarted as a whole rather than running with unroutable tokens.
+        while all(worker.is_alive() for worker in workers):
+            multiprocessing.connection.wait([worker.sentinel for worker in workers])
+        stop(None, None)
+        for worker in workers:
+            worker.join()
+    finally:
+        shutil.rmtree(socket_dir, ignore_errors=True)
@@ -0,0 +1,246 @@
+from typing import Optional, Dict, Set
+from dataclasses import dataclass, asdict
+import asyncio
+import logging
+import random
+import secrets
+import time
+
+import aiohttp
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Same shape as the real rewritten URLs: /http-<port>/<encrypted host>/<path>
+REWRITE_PREFIX = "/http-23381/77726476706e69737468656265737421a1a70fce72612600305add"
+SESSION_COOKIE = "wengine_vpn_ticketd_buaa_edu_cn"
+SSO_PATH = "/sso/login?service=%2Flogin%3Fcas_login%3Dtrue"
+
+# Response headers of the tunnel server that the proxy passes through.
+FORWARDED_HEADERS = ("Content-Type", "X-Code", "X-Seq", "X-Window", "X-Buffered")
+
+SSO_PAGE = """<html><body>
+<form method="post" action="/sso/login">
+<input name="username"><input name="password" type="password">
+<input type="hidden" name="execution" value="{execution}">
+<input type="hidden" name="_eventId" value="submit">
+</form>
+</body></html>"""
+
+
+@dataclass
+class SimulatorConfig:
+    upstream: str = "http://127.0.0.1:8000"
+    latency: float = 0.03           # seconds added to every proxied request
+    jitter: float = 0.01            # +/- uniform
+    drop_rate: float = 0.0          # requests that hang until the proxy times out
+    error_rate: float = 0.0         # requests answered with 502
+    session_ttl: float = 600.0      # sessions expire after this; requests then get a 302
+    redirect_rate: float = 0.0      # requests that get a 302 anyway, ending the session
+    max_body_size: int = 4 * 1024 * 1024
+    rate_limit: float = 0.0         # requests per second per client, 0 for unlimited
+    rate_burst: int = 100
+    proxy_timeout: float = 60.0
+    seed: Optional[int] = None
+
+
+@dataclass
+class SimulatorStats:
+    requests: int = 0
+    proxied: int = 0
+    redirects: int = 0
+    logins: int = 0
+    dropped: int = 0
+    errors: int = 0
+    limited: int = 0
+    too_large: int = 0
+    timeouts: int = 0
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+
+    def take(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class WebVPNSimulator:
+    def __init__(self, config: SimulatorConfig):
+        self.config = config
+        self.stats = SimulatorStats()
+        self.random = random.Random(config.seed)
+
+        self.sessions: Dict[str, float] = {}    # session id -> expires at
+        self.executions: Set[str] = set()
+        self.tickets: Set[str] = set()
+        self.buckets: Dict[str, TokenBucket] = {}
+
+        self._client: Optional[aiohttp.ClientSession] = None
+
+        self.app = web.Application(client_max_size=config.max_body_size)
+        self.app.router.add_get("/sso/login", self.sso_page)
+        self.app.router.add_post("/sso/login", self.sso_submit)
+        self.app.router.add_get("/login", self.cas_login)
+        self.app.router.add_get("/", self.index)
+        self.app.router.add_get("/simulator/stats", self.get_stats)
+        self.app.router.add_route("*", REWRITE_PREFIX + "/{path:.*}", self.proxy)
+        self.app.on_cleanup.append(self.cleanup)
+
+    @property
+    def client(self) -> aiohttp.ClientSession:
+        if self._client is None:
+            self._client = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self.config.proxy_timeout)
+            )
+        return self._client
+
+    async def cleanup(self, app: web.Application):
+        if self._client is not None:
+            await self._client.close()
+
+    def _redirect(self, location: str) -> web.Response:
+        return web.Response(status=302, headers={"Location": location})
+
+    def _redirect_to_sso(self) -> web.Response:
+        self.stats.redirects += 1
+        return self._redirect(SSO_PATH)
+
+    async def sso_page(self, request: web.Request) -> web.Response:
+        execution = secrets.token_hex(16)
+        self.executions.add(execution)
+        return web.Response(text=SSO_PAGE.format(execution=execution), content_type="text/html")
+
+    async def sso_submit(self, request: web.Request) -> web.Response:
+        data = await request.post()
+        execution = data.get("execution")
+        if execution not in self.executions or not data.get("username"):
+            return web.Response(status=401, text="Invalid login")
+        self.executions.discard(execution)
+
+        ticket = "ST-" + secrets.token_hex(8)
+        self.tickets.add(ticket)
+        return self._redirect(f"/login?cas_login=true&ticket={ticket}")
+
+    async def cas_login(self, request: web.Request) -> web.Response:
+        ticket = request.query.get("ticket")
+        if ticket not in self.tickets:
+            return self._redirect_to_sso()
+        self.tickets.discard(ticket)
+
+        self.stats.logins += 1
+        session_id = secrets.token_hex(16)
+        self.sessions[session_id] = time.monotonic() + self.config.session_ttl
+
+        rsp = self._redirect("/")
+        rsp.set_cookie(SESSION_COOKIE, session_id, path="/")
+        return rsp
+
+    async def index(self, request: web.Request) -> web.Response:
+        return web.Response(text="WebVPN simulator")
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        stats = asdict(self.stats)
+        stats["sessions"] = len(self.sessions)
+        return web.json_response(stats)
+
+    def _check_session(self, request: web.Request) -> bool:
+        session_id = request.cookies.get(SESSION_COOKIE)
+        expires_at = self.sessions.get(session_id)
+        if expires_at is None:
+            return False
+        if expires_at < time.monotonic() or self.random.random() < self.config.redirect_rate:
+            del self.sessions[session_id]
+            return False
+        return True
+
+    def _check_rate(self, request: web.Request) -> bool:
+        if self.config.rate_limit <= 0:
+            return True
+        bucket = self.buckets.get(request.remote)
+        if bucket is None:
+            bucket = TokenBucket(self.config.rate_limit, self.config.rate_burst)
+            self.buckets[request.remote] = bucket
+        return bucket.take()
+
+    async def proxy(self, request: web.Request) -> web.StreamResponse:
+        self.stats.requests += 1
+
+        if not self._check_rate(request):
+            self.stats.limited += 1
+            return web.Response(status=429, text="Too many requests")
+
+        if not self._check_session(request):
+            return self._redirect_to_sso()
+
+        try:
+            body = await request.read()
+        except web.HTTPRequestEntityTooLarge:
+            self.stats.too_large += 1
+            raise
+
+        delay = self.config.latency + self.random.uniform(-self.config.jitter, self.config.jitter)
+        await asyncio.sleep(max(delay, 0))
+
+        roll = self.random.random()
+        if roll < self.config.drop_rate:
+            self.stats.dropped += 1
+            await asyncio.sleep(self.config.proxy_timeout)
+            return web.Response(status=504, text="Gateway timeout")
+        if roll < self.config.drop_rate + self.config.error_rate:
+            self.stats.errors += 1
+            return web.Response(status=502, text="Bad gateway")
+
+        url = self.config.upstream.rstrip("/") + "/" + request.match_info["path"]
+        try:
+            async with self.client.request(
+                request.method, url, params=request.query, data=body or None,
+                allow_redirects=False,
+            ) as rsp:
+                data = await rsp.read()
+                headers = {k: rsp.headers[k] for k in FORWARDED_HEADERS if k in rsp.headers}
+                self.stats.proxied += 1
+                return web.Response(status=rsp.status, body=data, headers=headers)
+        except asyncio.TimeoutError:
+            self.stats.timeouts += 1
+            return web.Response(status=504, text="Gateway timeout")
+        except aiohttp.ClientError as e:
+            logger.error(f"Upstream request failed: {e!r}")
+            self.stats.errors += 1
+            return web.Response(status=502, text="Bad gateway")
+
+
+def get_urls(host: str, port: int) -> Dict[str, str]:
+    base = f"http://{host}:{port}"
+    return {
+        "BASE_URL": base + REWRITE_PREFIX,
+        "LOGIN_URL": base + SSO_PATH,
+        "LOGIN_SUBMIT_URL": base + "/sso/login",
+    }
+
+
+async def run_simulator(config: SimulatorConfig, host: str = "127.0.0.1", port: int = 8080):
+    simulator = WebVPNSimulator(config)
+    runner = web.AppRunner(simulator.app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+
+    logger.info(f"WebVPN simulator listening on {host}:{port} -> {config.upstream}")
+    for key, value in get_urls(host, port).items():
+        logger.info(f"{key}: {value}")
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        logger.info(f"Simulator stats: {asdict(simulator.stats)}")
+        await runner.cleanup()